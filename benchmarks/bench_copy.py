@@ -0,0 +1,104 @@
+"""Compare track splitting with wave and with flackup.convert.copy.
+
+Creates a CD image of random PCM samples and splits it into tracks twice:
+with the wave module (the previous implementation) and with the WAV header
+plus kernel-side copies used by decode_tracks.
+
+Usage: python benchmarks/bench_copy.py [--minutes 74] [--tracks 12] [--dir DIR]
+"""
+import argparse
+import os
+import tempfile
+import time
+import wave
+
+import flackup.convert as fc
+from flackup.fileinfo import StreamInfo
+
+
+CD = StreamInfo(2, 16, 44100, 0)
+
+
+def create_image(path, sample_count):
+    """Write a raw and a WAV image with random samples."""
+    sample_bytes = fc.pcm_sample_bytes(CD)
+    remaining = sample_count * sample_bytes
+    with open(path + '.raw', 'wb') as raw, open(path + '.wav', 'wb') as wav:
+        wav.write(fc.wav_header(CD, sample_count))
+        while remaining:
+            chunk = os.urandom(min(remaining, 1 << 20))
+            raw.write(chunk)
+            wav.write(chunk)
+            remaining -= len(chunk)
+
+
+def split_wave(path, ranges, out_dir):
+    """Split the WAV image with the wave module."""
+    sample_bytes = fc.pcm_sample_bytes(CD)
+    b_size = 65536 // sample_bytes
+    with wave.open(path + '.wav', 'rb') as wave_in:
+        for number, (start, end) in enumerate(ranges, start=1):
+            out_path = os.path.join(out_dir, fc.TRACK_WAV.format(number))
+            wave_in.setpos(start)
+            with wave.open(out_path, 'wb') as wave_out:
+                wave_out.setnchannels(CD.channels)
+                wave_out.setsampwidth(CD.sample_bits // 8)
+                wave_out.setframerate(CD.sample_rate)
+                sample_count = end - start
+                while sample_count:
+                    b = wave_in.readframes(min(b_size, sample_count))
+                    sample_count -= len(b) // sample_bytes
+                    wave_out.writeframes(b)
+
+
+def split_copy(path, ranges, out_dir):
+    """Split the raw image with flackup.convert.copy."""
+    sample_bytes = fc.pcm_sample_bytes(CD)
+    with open(path + '.raw', 'rb') as raw_in:
+        for number, (start, end) in enumerate(ranges, start=1):
+            out_path = os.path.join(out_dir, fc.TRACK_WAV.format(number))
+            with open(out_path, 'wb') as wav_out:
+                wav_out.write(fc.wav_header(CD, end - start))
+                wav_out.flush()
+                offset = start * sample_bytes
+                fc.copy(raw_in, wav_out, offset, (end - start) * sample_bytes)
+
+
+def measure(function, path, ranges, out_dir, size):
+    """Return the throughput of the split function in MB/s."""
+    start = time.perf_counter()
+    function(path, ranges, out_dir)
+    elapsed = time.perf_counter() - start
+    for name in os.listdir(out_dir):
+        os.remove(os.path.join(out_dir, name))
+    return size / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--minutes', type=float, default=74)
+    parser.add_argument('--tracks', type=int, default=12)
+    parser.add_argument('--dir', help='Directory for temporary files')
+    args = parser.parse_args()
+
+    sample_count = int(args.minutes * 60 * CD.sample_rate)
+    step = sample_count // args.tracks
+    starts = [n * step for n in range(args.tracks)]
+    ends = starts[1:] + [sample_count]
+    ranges = list(zip(starts, ends))
+    size = sample_count * fc.pcm_sample_bytes(CD)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tempdir:
+        image = os.path.join(tempdir, 'image')
+        out_dir = os.path.join(tempdir, 'tracks')
+        os.mkdir(out_dir)
+        create_image(image, sample_count)
+        print('Image: {:.1f} MB, {} tracks'.format(size / 1e6, args.tracks))
+        old = measure(split_wave, image, ranges, out_dir, size)
+        print('wave: {:8.1f} MB/s'.format(old))
+        new = measure(split_copy, image, ranges, out_dir, size)
+        print('copy: {:8.1f} MB/s ({:.1f}x)'.format(new, new / old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""Time flackup on synthetic FLAC files and compare with earlier results.
+
+Creates FLAC files with cue sheets, tags and covers across a range of track
+counts, durations, sample formats and picture sizes (see synthflac.py) and
+times metadata parsing, MusicBrainz disc IDs, decoding, splitting and cover
+export. Results are saved as JSON, keyed by benchmark and case, so that the
+files of two releases can be compared.
+
+Usage: python benchmarks/bench_suite.py [--quick] [--output FILE]
+       [--compare FILE] [--repeat 5] [--filter NAME] [--dir DIR]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from mutagen.flac import FLAC, VCFLACDict
+
+from flackup import VERSION
+import flackup.convert as fc
+from flackup.fileinfo import FileInfo, HeaderInfo, Tags
+from flackup.musicbrainz import MusicBrainzDisc
+import synthflac
+
+
+"""Results file format version."""
+RESULTS_VERSION = 1
+
+"""Track counts of the metadata benchmarks."""
+TRACK_COUNTS = [1, 12, 99]
+
+"""Picture sizes of the metadata and cover benchmarks, None for no picture."""
+PICTURE_SIZES = [None, 500, 1500, 3000]
+
+"""Sample formats of the audio benchmarks (bits, rate, channels)."""
+FORMATS = [(16, 44100, 2), (24, 96000, 2)]
+
+"""Durations of the audio benchmarks in minutes, normal and quick."""
+MINUTES = [1, 10]
+QUICK_MINUTES = [0.25]
+
+"""Relative slowdown reported as a regression by --compare."""
+THRESHOLD = 0.1
+
+
+class Suite(object):
+    """Run benchmarks and collect their timings.
+
+    Variables:
+    - results: Dictionary of "name[case]" keys to timing dictionaries.
+    """
+
+    def __init__(self, workdir, repeat, name_filter=None):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.name_filter = name_filter
+        self.results = {}
+        self._files = {}
+
+    def flac(self, seconds, tracks=12, fmt=FORMATS[0], picture_size=None):
+        """Return the path of a synthetic FLAC file, creating it once."""
+        bits, rate, channels = fmt
+        key = (seconds, tracks, fmt, picture_size)
+        if key not in self._files:
+            name = 'synth-{}.flac'.format(len(self._files))
+            path = os.path.join(self.workdir, name)
+            synthflac.write_flac(
+                path, seconds, tracks=tracks, sample_rate=rate,
+                channels=channels, sample_bits=bits,
+                picture_size=picture_size)
+            self._files[key] = path
+        return self._files[key]
+
+    def run(self, name, case, function, teardown=None, audio=None):
+        """Time function, calling teardown with its result after each run.
+
+        Pass the processed audio duration in seconds to also report the
+        real-time speed.
+        """
+        key = '{}[{}]'.format(name, case)
+        if self.name_filter and self.name_filter not in key:
+            return
+        times = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - start)
+            if teardown is not None:
+                teardown(result)
+        result = {
+            'median': statistics.median(times),
+            'min': min(times),
+            'runs': len(times),
+        }
+        if audio:
+            result['speed'] = audio / result['median']
+        self.results[key] = result
+        line = '{:50} {:10.6f} s'.format(key, result['median'])
+        if audio:
+            line += ' {:8.1f}x'.format(result['speed'])
+        print(line, flush=True)
+
+
+def bench_metadata(suite):
+    """Benchmark FileInfo, HeaderInfo, Summary, Tags and MusicBrainzDisc."""
+    for tracks in TRACK_COUNTS:
+        for size in PICTURE_SIZES:
+            path = suite.flac(10, tracks, picture_size=size)
+            case = 'tracks={},picture={}'.format(tracks, size or 0)
+            suite.run('fileinfo', case, lambda: FileInfo(path))
+            suite.run('headerinfo', case, lambda: HeaderInfo(path))
+            info = FileInfo(path)
+            suite.run('summary', case, lambda: info.summary)
+
+        info = FileInfo(suite.flac(10, tracks))
+        numbers = [t.number for t in info.cuesheet.audio_tracks]
+        case = 'tracks={}'.format(tracks)
+
+        def lookup_tags():
+            info.tags.album_tags()
+            for number in numbers:
+                info.tags.track_tags(number)
+
+        suite.run('tags', case, lookup_tags)
+
+        original = FLAC(info.path).tags
+
+        def update_tags():
+            comments = VCFLACDict()
+            comments.extend(original)
+            tags = Tags(comments)
+            tags.update_album({'ALBUM': 'Updated'})
+            for number in numbers:
+                tags.update_track(number, {'TITLE': 'Updated'})
+            tags.save(comments)
+
+        suite.run('tags_update', case, update_tags)
+        suite.run('musicbrainz_disc', case,
+                  lambda: MusicBrainzDisc(info.cuesheet))
+
+
+def bench_audio(suite, minutes):
+    """Benchmark decode_tracks and copy."""
+    has_flac = shutil.which('flac') is not None
+    if not has_flac:
+        print('flac not found, skipping decode_tracks', file=sys.stderr)
+    for fmt in FORMATS:
+        for length in minutes:
+            seconds = length * 60
+            path = suite.flac(seconds, 12, fmt)
+            info = FileInfo(path)
+            case = '{}bit/{}Hz,minutes={:g}'.format(fmt[0], fmt[1], length)
+            audio = info.streaminfo.sample_count / fmt[1]
+            if has_flac:
+                suite.run(
+                    'decode_tracks', case,
+                    lambda: fc.decode_tracks(info, jobs=fc.cpu_count()),
+                    teardown=lambda tempdir: tempdir.cleanup(),
+                    audio=audio)
+            raw = os.path.join(suite.workdir, 'image.raw')
+            write_raw(raw, info.streaminfo)
+            suite.run('copy', case, lambda: split(raw, info), audio=audio)
+            os.remove(raw)
+
+
+def bench_cover(suite):
+    """Benchmark export_cover."""
+    for size in PICTURE_SIZES:
+        if size is None:
+            continue
+        info = FileInfo(suite.flac(1, 1, picture_size=size))
+        front = info.get_picture(3)
+        out_dir = os.path.join(suite.workdir, 'cover')
+        os.makedirs(out_dir, exist_ok=True)
+        suite.run('export_cover', 'picture={}'.format(size),
+                  lambda: fc.export_cover(front, out_dir))
+
+
+def write_raw(path, streaminfo):
+    """Write a raw PCM image of the StreamInfo's size."""
+    remaining = streaminfo.sample_count * fc.pcm_sample_bytes(streaminfo)
+    with open(path, 'wb') as f:
+        while remaining:
+            chunk = os.urandom(min(remaining, 1 << 20))
+            f.write(chunk)
+            remaining -= len(chunk)
+
+
+def split(raw, info):
+    """Split a raw PCM image into WAV files like decode_tracks."""
+    stream = info.streaminfo
+    sample_bytes = fc.pcm_sample_bytes(stream)
+    out_dir = os.path.dirname(raw)
+    with open(raw, 'rb') as raw_in:
+        for number, (start, end) in fc.track_ranges(info).items():
+            out_path = os.path.join(out_dir, fc.TRACK_WAV.format(number))
+            with open(out_path, 'wb') as wav_out:
+                wav_out.write(fc.wav_header(stream, end - start))
+                wav_out.flush()
+                offset = start * sample_bytes
+                fc.copy(raw_in, wav_out, offset, (end - start) * sample_bytes)
+            os.remove(out_path)
+
+
+def compare(old, new, threshold=THRESHOLD):
+    """Print the median times of two results and flag regressions.
+
+    Returns the number of regressions.
+    """
+    regressions = 0
+    print('{:50} {:>10} {:>10} {:>7}'.format('benchmark', 'old', 'new', 'ratio'))
+    for key in sorted(set(old['results']) & set(new['results'])):
+        before = old['results'][key]['median']
+        after = new['results'][key]['median']
+        ratio = after / before if before else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print('{:50} {:10.6f} {:10.6f} {:7.2f}{}'.format(
+            key, before, after, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='Use short durations for the audio benchmarks')
+    parser.add_argument('--output', help='Save the results to this file')
+    parser.add_argument('--compare', help='Compare with earlier results')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', help='Run only matching benchmarks')
+    parser.add_argument('--dir', help='Directory for temporary files')
+    args = parser.parse_args()
+
+    minutes = QUICK_MINUTES if args.quick else MINUTES
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        suite = Suite(workdir, args.repeat, args.filter)
+        bench_metadata(suite)
+        bench_audio(suite, minutes)
+        bench_cover(suite)
+    results = {
+        'version': RESULTS_VERSION,
+        'flackup': VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': fc.cpu_count(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'quick': args.quick,
+        'results': suite.results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, results):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""Write synthetic FLAC files for tests and benchmarks, without the flac tool.
+
+The audio is stored in verbatim (uncompressed) subframes, cycling through a
+few blocks of noise, so even long files are written at disk speed. The files
+have a STREAMINFO block with an MD5 signature, a CD cue sheet, Flackup album
+and track tags and an optional front cover.
+
+See: https://xiph.org/flac/format.html
+"""
+import hashlib
+import io
+import struct
+
+from mutagen.flac import Picture as MutagenPicture, VCFLACDict
+import numpy as np
+from PIL import Image
+
+
+"""Number of samples per FLAC frame."""
+BLOCK_SIZE = 4096
+
+"""Number of distinct noise blocks cycled through."""
+NOISE_BLOCKS = 16
+
+"""CD sector size in samples, cue sheet offsets are multiples of it."""
+SECTOR = 588
+
+STREAMINFO, PADDING, VORBIS_COMMENT, CUESHEET, PICTURE = 0, 1, 4, 5, 6
+
+
+def crc8(data, crc=0):
+    """Return the FLAC frame header CRC-8 (polynomial 0x07)."""
+    for byte in data:
+        crc = _CRC8[crc ^ byte]
+    return crc
+
+
+def crc16(data, crc=0):
+    """Return the FLAC frame CRC-16 (polynomial 0x8005)."""
+    for byte in data:
+        crc = ((crc << 8) & 0xffff) ^ _CRC16[(crc >> 8) ^ byte]
+    return crc
+
+
+def _crc_table(bits, poly):
+    top = 1 << (bits - 1)
+    mask = (1 << bits) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (bits - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & top else crc << 1) & mask
+        table.append(crc)
+    return table
+
+
+_CRC8 = _crc_table(8, 0x07)
+_CRC16 = _crc_table(16, 0x8005)
+
+
+def crc16_shift(length):
+    """Return a function advancing a CRC-16 over "length" zero bytes.
+
+    CRC-16 is linear, so crc16(a + b) == shift(crc16(a)) ^ crc16(b) with
+    the shift for len(b). The shift is computed for each state bit once.
+    """
+    basis = [crc16(bytes(length), 1 << bit) for bit in range(16)]
+
+    def shift(crc):
+        result = 0
+        for bit in range(16):
+            if crc >> bit & 1:
+                result ^= basis[bit]
+        return result
+
+    return shift
+
+
+def utf8_number(value):
+    """Return the "UTF-8" coding of a frame number."""
+    if value < 0x80:
+        return bytes([value])
+    length = 2
+    while value >= 1 << (5 * length + 1):
+        length += 1
+    tail = []
+    for _ in range(length - 1):
+        tail.insert(0, 0x80 | value & 0x3f)
+        value >>= 6
+    first = (0xff << (8 - length)) & 0xff | value
+    return bytes([first] + tail)
+
+
+def frame(number, body, sample_count, channels, shift=None, body_crc=None):
+    """Return a fixed-blocksize frame with the subframes in body.
+
+    Sample rate and sample size are taken from STREAMINFO. For repeated
+    bodies, pass the body's CRC-16 and a crc16_shift for its length.
+    """
+    if sample_count == BLOCK_SIZE:
+        header = bytes([0xff, 0xf8, 0xc0])
+        extra = b''
+    else:
+        header = bytes([0xff, 0xf8, 0x70])
+        extra = struct.pack('>H', sample_count - 1)
+    header += bytes([(channels - 1) << 4]) + utf8_number(number) + extra
+    header += bytes([crc8(header)])
+    if shift is None:
+        crc = crc16(header + body)
+    else:
+        crc = shift(crc16(header)) ^ body_crc
+    return header + body + struct.pack('>H', crc)
+
+
+def subframes(samples, sample_bits):
+    """Return verbatim subframes of a (count, channels) sample array."""
+    sample_bytes = sample_bits // 8
+    data = io.BytesIO()
+    for channel in samples.T:
+        data.write(b'\x02')
+        be = channel.astype('>i4').view(np.uint8).reshape(-1, 4)
+        data.write(be[:, 4 - sample_bytes:].tobytes())
+    return data.getvalue()
+
+
+def pcm_bytes(samples, sample_bits):
+    """Return little-endian interleaved PCM bytes, as used for the MD5."""
+    sample_bytes = sample_bits // 8
+    le = samples.astype('<i4').view(np.uint8).reshape(-1, 4)
+    return le[:, :sample_bytes].tobytes()
+
+
+def noise(count, channels, sample_bits, seed):
+    """Return a (count, channels) array of noise at about -20 dBFS."""
+    rng = np.random.default_rng(seed)
+    limit = 1 << (sample_bits - 1)
+    samples = rng.standard_normal((count, channels)) * limit / 10
+    return np.clip(samples, -limit, limit - 1).astype(np.int32)
+
+
+def block(type_, data, last=False):
+    """Return a metadata block."""
+    header = (0x80 if last else 0) | type_
+    return bytes([header]) + len(data).to_bytes(3, 'big') + data
+
+
+def streaminfo(sample_rate, channels, sample_bits, sample_count, md5):
+    """Return the data of a STREAMINFO block."""
+    packed = (
+        sample_rate << 44 |
+        (channels - 1) << 41 |
+        (sample_bits - 1) << 36 |
+        sample_count
+    )
+    return (
+        struct.pack('>HH', BLOCK_SIZE, BLOCK_SIZE) +
+        bytes(6) +
+        struct.pack('>Q', packed) +
+        md5
+    )
+
+
+def cuesheet(offsets, sample_count, lead_in=88200):
+    """Return the data of a CD CUESHEET block for the track offsets."""
+    data = bytes(128) + struct.pack('>Q', lead_in)
+    data += b'\x80' + bytes(258) + bytes([len(offsets) + 1])
+    for number, offset in enumerate(offsets, start=1):
+        data += struct.pack('>QB', offset, number) + bytes(12)
+        data += bytes(14) + bytes([1])
+        data += struct.pack('>QB', 0, 1) + bytes(3)
+    data += struct.pack('>QB', sample_count, 170) + bytes(12)
+    data += bytes(14) + bytes([0])
+    return data
+
+
+def vorbis_comment(tags):
+    """Return the data of a VORBIS_COMMENT block for a tag dictionary."""
+    comment = VCFLACDict()
+    for key, value in tags.items():
+        comment[key] = value
+    return comment.write(framing=False)
+
+
+def cover(size, quality=90):
+    """Return JPEG data of a size x size test image."""
+    image = Image.effect_mandelbrot((size, size), (-2, -1.5, 1, 1.5), 100)
+    image = Image.merge('RGB', (image, image.transpose(Image.FLIP_LEFT_RIGHT),
+                                image.transpose(Image.FLIP_TOP_BOTTOM)))
+    data = io.BytesIO()
+    image.save(data, format='JPEG', quality=quality)
+    return data.getvalue()
+
+
+def picture(size):
+    """Return the data of a front cover PICTURE block."""
+    pic = MutagenPicture()
+    pic.type = 3
+    pic.mime = 'image/jpeg'
+    pic.width = size
+    pic.height = size
+    pic.depth = 24
+    pic.data = cover(size)
+    return pic.write()
+
+
+def album_tags(track_count):
+    """Return Flackup album and track tags for a number of tracks."""
+    tags = {
+        'ARTIST': 'Synthetic Artist',
+        'ALBUM': 'Synthetic Album ({} tracks)'.format(track_count),
+        'DATE': '2000-01-01',
+        'GENRE': 'Noise',
+        'FLACKUP_VERSION': '1',
+    }
+    for number in range(1, track_count + 1):
+        tags['TRACK_{:02d}_TITLE'.format(number)] = 'Track {}'.format(number)
+    return tags
+
+
+def track_offsets(sample_count, track_count):
+    """Return evenly spaced track offsets, aligned to CD sectors."""
+    step = sample_count // track_count // SECTOR * SECTOR
+    return [n * step for n in range(track_count)]
+
+
+def write_flac(path, seconds, tracks=12, sample_rate=44100, channels=2,
+               sample_bits=16, picture_size=None, padding=8192):
+    """Write a synthetic FLAC file and return its sample count.
+
+    The duration is rounded to whole CD sectors, so that each track is at
+    least one sector long.
+    """
+    if sample_bits not in (8, 16, 24):
+        raise ValueError('Unsupported sample size: {}'.format(sample_bits))
+    sample_count = max(int(seconds * sample_rate), tracks * SECTOR)
+    sample_count = sample_count // SECTOR * SECTOR
+    blocks = [
+        noise(BLOCK_SIZE, channels, sample_bits, seed)
+        for seed in range(NOISE_BLOCKS)
+    ]
+    bodies = [subframes(b, sample_bits) for b in blocks]
+    crcs = [crc16(body) for body in bodies]
+    shift = crc16_shift(len(bodies[0]))
+    pcm = [pcm_bytes(b, sample_bits) for b in blocks]
+
+    md5 = hashlib.md5()
+    full, rest = divmod(sample_count, BLOCK_SIZE)
+    for number in range(full):
+        md5.update(pcm[number % NOISE_BLOCKS])
+    last = blocks[full % NOISE_BLOCKS][:rest]
+    if rest:
+        md5.update(pcm_bytes(last, sample_bits))
+
+    metadata = [
+        (STREAMINFO, streaminfo(
+            sample_rate, channels, sample_bits, sample_count, md5.digest())),
+        (VORBIS_COMMENT, vorbis_comment(album_tags(tracks))),
+        (CUESHEET, cuesheet(track_offsets(sample_count, tracks), sample_count)),
+    ]
+    if picture_size:
+        metadata.append((PICTURE, picture(picture_size)))
+    metadata.append((PADDING, bytes(padding)))
+
+    with open(path, 'wb') as f:
+        f.write(b'fLaC')
+        for index, (type_, data) in enumerate(metadata):
+            f.write(block(type_, data, index == len(metadata) - 1))
+        for number in range(full):
+            n = number % NOISE_BLOCKS
+            f.write(frame(
+                number, bodies[n], BLOCK_SIZE, channels, shift, crcs[n]))
+        if rest:
+            body = subframes(last, sample_bits)
+            f.write(frame(full, body, rest, channels))
+    return sample_count
@@ -0,0 +1,375 @@
+import json
+import os
+import os.path
+import sqlite3
+
+from flackup.fileinfo import HeaderInfo, Picture, StreamInfo, Summary, Tags
+from flackup.musicbrainz import MusicBrainzDisc
+
+
+"""Catalog format version, stored as the database's user_version."""
+CATALOG_VERSION = 2
+
+"""Number of changed entries after which the catalog is committed."""
+COMMIT_INTERVAL = 200
+
+"""States returned by Catalog.refresh."""
+ADDED = 'added'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+
+"""Columns of the files table, in Entry order."""
+COLUMNS = [
+    'path',
+    'size',
+    'mtime_ns',
+    'summary',
+    'error',
+    'tags',
+    'pictures',
+    'release_mbid',
+    'discid',
+    'toc',
+    'track_count',
+    'channels',
+    'sample_bits',
+    'sample_rate',
+    'sample_count',
+    'md5',
+]
+
+"""Schema of the catalog database."""
+SCHEMA = '''
+CREATE TABLE files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    error TEXT,
+    tags TEXT NOT NULL,
+    pictures TEXT NOT NULL,
+    release_mbid TEXT,
+    discid TEXT,
+    toc TEXT,
+    track_count INTEGER,
+    channels INTEGER,
+    sample_bits INTEGER,
+    sample_rate INTEGER,
+    sample_count INTEGER,
+    md5 TEXT
+);
+CREATE INDEX files_release_mbid ON files (release_mbid);
+CREATE INDEX files_discid ON files (discid);
+'''
+
+
+class Catalog(object):
+    """A SQLite catalog of FLAC file metadata.
+
+    Entries are keyed by absolute path and valid while the file's size and
+    modification time are unchanged, so a rescan only parses new and changed
+    files. Changes are committed every COMMIT_INTERVAL entries and on close.
+
+    Variables:
+    - path: The database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != CATALOG_VERSION:
+            self._db.executescript(
+                'DROP TABLE IF EXISTS files;' + SCHEMA +
+                'PRAGMA user_version={};'.format(CATALOG_VERSION))
+        self._pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, path):
+        """Return the Entry of a FLAC file, parsing it if it changed."""
+        return self.refresh(path)[0]
+
+    def refresh(self, path):
+        """Return the Entry of a FLAC file and ADDED, UPDATED or UNCHANGED.
+
+        Files that cannot be read have an Entry that is not stored, and a
+        state of None.
+        """
+        entry, state, _ = self._refresh(path, HeaderInfo)
+        return entry, state
+
+    def load(self, path, parse=HeaderInfo):
+        """Return the Entry of an unchanged FLAC file, or parse it.
+
+        New and changed files are parsed with parse (e.g. FileInfo), stored
+        and returned as parsed, so they are read only once.
+        """
+        entry, _, info = self._refresh(path, parse)
+        return entry if info is None else info
+
+    def lookup(self, path):
+        """Return the Entry of a FLAC file if it is unchanged, or None."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        entry = self._select(path)
+        if entry is not None and entry.valid(stat):
+            return entry
+        return None
+
+    def store(self, info, stat=None):
+        """Store a parsed HeaderInfo or FileInfo and return its Entry.
+
+        Pass the os.stat result of the file from before it was parsed, if
+        it could have changed since.
+        """
+        if stat is None:
+            try:
+                stat = os.stat(info.path)
+            except OSError:
+                return Entry.from_info(info, None)
+        return self._store(info, stat)
+
+    def remove(self, path):
+        """Remove the Entry of a path."""
+        self._db.execute(
+            'DELETE FROM files WHERE path = ?', (os.path.abspath(path),))
+        self._changed()
+
+    def prune(self, top):
+        """Remove the Entries of missing files below a directory.
+
+        Returns the removed paths.
+        """
+        top = os.path.join(os.path.abspath(top), '')
+        rows = self._db.execute(
+            'SELECT path FROM files WHERE substr(path, 1, ?) = ?',
+            (len(top), top)).fetchall()
+        removed = [path for path, in rows if not os.path.exists(path)]
+        for path in removed:
+            self.remove(path)
+        return removed
+
+    def paths(self):
+        """Return the sorted paths of all Entries."""
+        rows = self._db.execute('SELECT path FROM files ORDER BY path')
+        return [path for path, in rows]
+
+    def commit(self):
+        """Commit the changes."""
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        """Commit the changes and close the database."""
+        if self._db is not None:
+            self.commit()
+            self._db.close()
+            self._db = None
+
+    def _refresh(self, path, parse):
+        """Return the Entry, state and parsed file (or None) of a path."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            info = parse(path)
+            return Entry.from_info(info, None), None, info
+        entry = self._select(path)
+        if entry is not None and entry.valid(stat):
+            return entry, UNCHANGED, None
+        state = ADDED if entry is None else UPDATED
+        info = parse(path)
+        return self._store(info, stat), state, info
+
+    def _select(self, path):
+        row = self._db.execute(
+            'SELECT {} FROM files WHERE path = ?'.format(', '.join(COLUMNS)),
+            (os.path.abspath(path),)).fetchone()
+        return Entry.from_row(row) if row is not None else None
+
+    def _store(self, info, stat):
+        entry = Entry.from_info(info, stat)
+        self._db.execute(
+            'INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(
+                ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+            entry.to_row())
+        self._changed()
+        return entry
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.commit()
+
+
+class Entry(object):
+    """A catalogued FLAC file.
+
+    Entries can be used in place of a HeaderInfo to check the flags, tags,
+    stream information and picture metadata of a file. Picture data is not
+    stored, and the cue sheet only as MusicBrainz disc ID and TOC.
+
+    Variables:
+    - path: The absolute path of the FLAC file.
+    - size, mtime_ns: The size and modification time of the parsed file.
+    - parse_ok: True if the file was parsed successfully.
+    - parse_exception: The parse exception (message only), or None.
+    - summary: The file's Summary.
+    - streaminfo: The file's StreamInfo, or None.
+    - tags: The file's Tags, with the Flackup album and track tags.
+    - release_mbid: The RELEASE_MBID tag, or None.
+    - discid, toc: The MusicBrainz disc ID and TOC, or None.
+    - track_count: The number of audio tracks in the cue sheet, or None.
+    """
+
+    def __init__(self, path, size, mtime_ns, summary, error, tags, pictures,
+                 release_mbid, discid, toc, track_count, streaminfo):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.summary = summary
+        self.parse_ok = summary.parse_ok
+        self.parse_exception = Exception(error) if error else None
+        self._tags = tags
+        self.tags = Tags(tags.items()) if self.parse_ok else None
+        self._pictures = pictures
+        self.release_mbid = release_mbid
+        self.discid = discid
+        self.toc = toc
+        self.track_count = track_count
+        self.streaminfo = streaminfo
+
+    @classmethod
+    def from_info(cls, info, stat):
+        """Create an Entry from a HeaderInfo and the file's os.stat result."""
+        size, mtime_ns = stat_key(stat) if stat is not None else (None, None)
+        tags = {}
+        pictures = []
+        mbid = discid = toc = track_count = None
+        if info.parse_ok:
+            tags = flackup_tags(info)
+            pictures = [
+                Picture(p.type, p.mime, p.width, p.height, p.depth,
+                        length=p.length)
+                for p in info.pictures()
+            ]
+            mbid = tags.get('RELEASE_MBID')
+            if info.cuesheet is not None:
+                disc = MusicBrainzDisc(info.cuesheet)
+                discid = disc.discid
+                toc = disc.toc
+                track_count = info.track_count
+        error = None
+        if info.parse_exception is not None:
+            error = error_message(info.parse_exception)
+        return cls(
+            os.path.abspath(info.path), size, mtime_ns, info.summary, error,
+            tags, pictures, mbid, discid, toc, track_count, info.streaminfo)
+
+    @classmethod
+    def from_row(cls, row):
+        """Create an Entry from a row of the files table."""
+        values = dict(zip(COLUMNS, row))
+        streaminfo = None
+        if values['channels'] is not None:
+            streaminfo = StreamInfo(
+                values['channels'],
+                values['sample_bits'],
+                values['sample_rate'],
+                values['sample_count'],
+                values['md5'],
+            )
+        pictures = [Picture(*p[:5], length=p[5])
+                    for p in json.loads(values['pictures'])]
+        return cls(
+            values['path'], values['size'], values['mtime_ns'],
+            Summary.from_string(values['summary']), values['error'],
+            json.loads(values['tags']), pictures, values['release_mbid'],
+            values['discid'], values['toc'], values['track_count'],
+            streaminfo)
+
+    def to_row(self):
+        """Return a row of the files table for this Entry."""
+        stream = self.streaminfo or StreamInfo(None, None, None, None, None)
+        pictures = [
+            [p.type, p.mime, p.width, p.height, p.depth, p.length]
+            for p in self._pictures
+        ]
+        error = None
+        if self.parse_exception is not None:
+            error = str(self.parse_exception)
+        return (
+            self.path,
+            self.size,
+            self.mtime_ns,
+            repr(self.summary),
+            error,
+            json.dumps(self._tags, sort_keys=True),
+            json.dumps(pictures),
+            self.release_mbid,
+            self.discid,
+            self.toc,
+            self.track_count,
+            stream.channels,
+            stream.sample_bits,
+            stream.sample_rate,
+            stream.sample_count,
+            stream.md5,
+        )
+
+    def valid(self, stat):
+        """Return True if the Entry matches the file's os.stat result."""
+        return (self.size, self.mtime_ns) == stat_key(stat)
+
+    def pictures(self):
+        """Return a tuple of Pictures without data, or None."""
+        if self.parse_ok:
+            return tuple(self._pictures)
+        else:
+            return None
+
+    def get_picture(self, type_):
+        """Return the Picture of the given type without data, or None."""
+        for picture in self._pictures:
+            if picture.type == type_:
+                return picture
+        return None
+
+
+def flackup_tags(info):
+    """Return the Flackup album and track tags of a file by Vorbis key."""
+    tags = dict(info.tags.album_tags())
+    if info.cuesheet is not None:
+        for track in info.cuesheet.audio_tracks:
+            prefix = 'TRACK_{:02d}_'.format(track.number)
+            for name, value in info.tags.track_tags(track.number).items():
+                tags[prefix + name] = value
+    return tags
+
+
+def error_message(exception):
+    """Return the message of an exception, or its type name."""
+    return str(exception) or type(exception).__name__
+
+
+def stat_key(stat):
+    """Return the (size, mtime_ns) validating an Entry."""
+    return stat.st_size, stat.st_mtime_ns
+
+
+def default_catalog_path():
+    """Return the catalog path below XDG_CACHE_HOME."""
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'flackup', 'catalog.sqlite')
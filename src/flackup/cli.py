@@ -1,19 +1,213 @@
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait)
+from contextlib import nullcontext
+import functools
+import json
 import os.path
 import shutil
-import subprocess
+import tempfile
+import time
 
 import click
 
 from flackup import NAME, VERSION
+import flackup.catalog as ca
 import flackup.convert as fc
-from flackup.fileinfo import FileInfo
+from flackup.fileinfo import FileInfo, HeaderInfo, MAX_PADDING
+import flackup.manifest as fm
+import flackup.paths as fp
+from flackup.metrics import Metrics, measure_overall
 from flackup.musicbrainz import MusicBrainz, MusicBrainzError
+import flackup.spool as sp
+import flackup.watch as fw
 
 
 FRONT_COVER_TYPE = 3
 
 RELEASE_URL = 'https://musicbrainz.org/release/{}'
 
+"""Output line for metadata changes that rewrote the whole FLAC file."""
+REWRITTEN = '- Rewrote the whole file, the metadata outgrew its padding'
+
+SIZE_SUFFIXES = 'KMGT'
+
+"""Files queued per thread by commands that read files concurrently."""
+QUEUE_PER_JOB = 4
+
+
+class ReviewNeeded(Exception):
+    """A FLAC file needs a release choice by the user."""
+    pass
+
+
+class ProfileType(click.ParamType):
+    """A conversion Profile in the form FORMAT:QUALITY:DIR."""
+
+    name = 'profile'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, fc.Profile):
+            return value
+        parts = value.split(':', 2)
+        if len(parts) != 3:
+            self.fail('Expected FORMAT:QUALITY:DIR, got {}'.format(value))
+        fmt, quality, base_dir = parts
+        if fmt != 'ogg':
+            self.fail('Unsupported format: {}'.format(fmt))
+        try:
+            quality = float(quality)
+        except ValueError:
+            self.fail('Invalid quality: {}'.format(quality))
+        if quality < -1 or quality > 10:
+            self.fail('Quality out of range: {:g}'.format(quality))
+        path = click.Path(exists=True, file_okay=False, writable=True)
+        base_dir = path.convert(base_dir, param, ctx)
+        return fc.Profile(fmt, quality, base_dir)
+
+
+class CoverType(click.ParamType):
+    """A cover image in the form NAME:WIDTH."""
+
+    name = 'cover'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, tuple):
+            return value
+        name, _, width = value.rpartition(':')
+        if not name or os.path.basename(name) != name:
+            self.fail('Expected NAME:WIDTH, got {}'.format(value))
+        if not name.lower().endswith('.jpg'):
+            self.fail('Cover names must end with .jpg: {}'.format(name))
+        try:
+            width = int(width)
+        except ValueError:
+            self.fail('Invalid width: {}'.format(width))
+        if width < 1:
+            self.fail('Invalid width: {}'.format(width))
+        return name, width
+
+
+class SizeType(click.ParamType):
+    """A size in bytes, with an optional K, M, G or T suffix."""
+
+    name = 'size'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, int):
+            return value
+        text = value.strip().upper().rstrip('B')
+        factor = 1
+        if text and text[-1] in SIZE_SUFFIXES:
+            factor = 1024 ** (SIZE_SUFFIXES.index(text[-1]) + 1)
+            text = text[:-1]
+        try:
+            size = int(float(text) * factor)
+        except ValueError:
+            self.fail('Invalid size: {}'.format(value))
+        if size < 0:
+            self.fail('Invalid size: {}'.format(value))
+        return size
+
+
+def flac_input(command):
+    """Add the FLAC file argument and input options to a command.
+
+    The command's "flac" parameter is an iterator over the FLAC files given
+    as arguments, found below --recursive directories and read from
+    --from-file, in that order. Only the arguments are checked up front.
+    """
+    @click.argument(
+        'flac', type=click.Path(exists=True, dir_okay=False), nargs=-1)
+    @click.option('-r', '--recursive', 'directories',
+                  help='Also process the FLAC files in this directory tree, '
+                       'can be repeated.',
+                  type=click.Path(exists=True, file_okay=False),
+                  multiple=True)
+    @click.option('--from-file', 'path_file',
+                  help='Also process the FLAC files listed in this file, '
+                       'one per line ("-" for stdin).',
+                  type=click.File('rb'))
+    @click.option('-0', '--null',
+                  help='Paths in --from-file are separated by NUL '
+                       'characters.',
+                  is_flag=True)
+    @functools.wraps(command)
+    def wrapper(flac, directories, path_file, null, **kwargs):
+        paths = input_paths(flac, directories, path_file, null)
+        return command(flac=paths, **kwargs)
+
+    return wrapper
+
+
+def input_paths(flac, directories, path_file=None, null=False):
+    """Yield the paths of the flac_input options."""
+    yield from flac
+    for directory in directories:
+        yield from fp.walk_flac(directory)
+    if path_file is not None:
+        yield from fp.read_paths(path_file, b'\0' if null else b'\n')
+
+
+def catalog_option(command):
+    """Add the --catalog option of the commands using a Catalog."""
+    return click.option(
+        '--catalog', 'catalog_path',
+        help='Skip or read unchanged files using this catalog, see '
+             'flackup index.',
+        envvar='FLACKUP_CATALOG',
+        type=click.Path(dir_okay=False))(command)
+
+
+def conversion_options(command):
+    """Add the options of the commands converting FLAC files.
+
+    These are --jobs and --timeout (see open_runner), --temp-dir and
+    --cover-cache (see open_cover_cache).
+    """
+    options = [
+        click.option(
+            '-j', '--jobs',
+            help='Number of tracks to decode/encode concurrently. '
+                 '[default: adapted to the load, up to the CPU count]',
+            type=click.IntRange(min=1)),
+        click.option(
+            '--temp-dir',
+            help='Directory for temporary WAV files, e.g. on a tmpfs.',
+            type=click.Path(exists=True, file_okay=False, writable=True)),
+        click.option(
+            '--timeout',
+            help='Stop decoders/encoders after this many seconds.',
+            type=click.FloatRange(min=0, min_open=True)),
+        click.option(
+            '--cover-cache',
+            help='Directory for resized cover images, up to 64 MiB. '
+                 '[default: $XDG_CACHE_HOME/flackup/covers]',
+            type=click.Path(file_okay=False, writable=True)),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def open_runner(jobs, timeout):
+    """Return a ProcessRunner for the --jobs and --timeout options.
+
+    Without --jobs, the number of processes adapts to the load, up to the
+    CPU count.
+    """
+    runner = fc.ProcessRunner(jobs or fc.cpu_count(), timeout)
+    if jobs is None:
+        runner.adapt(runner.jobs)
+    return runner
+
+
+def open_cover_cache(directory):
+    """Return the CoverCache for the --cover-cache option."""
+    if directory is None:
+        directory = fc.default_cache_dir()
+    return fc.CoverCache(directory)
+
 
 @click.group()
 def flackup():
@@ -22,16 +216,35 @@ def flackup():
 
 
 @flackup.command()
-@click.argument('flac', type=click.Path(exists=True, dir_okay=False), nargs=-1)
+@flac_input
 @click.option('-v', '--verbose', help='Show more information.', is_flag=True)
 @click.option('--hidden',
               help='Show only albums with a HIDE=true tag.',
               is_flag=True)
-def analyze(flac, verbose, hidden):
+@catalog_option
+@click.option('-j', '--jobs',
+              help='Number of files to read concurrently.',
+              type=click.IntRange(min=1),
+              default=1,
+              show_default=True)
+@click.option('--unordered',
+              help='Show files as they are read, not in the given order.',
+              is_flag=True)
+@click.option('--format', 'output_format',
+              help='Output format.',
+              type=click.Choice(['text', 'ndjson']),
+              default='text',
+              show_default=True)
+def analyze(flac, verbose, hidden, catalog_path, jobs, unordered,
+            output_format):
     """Analyze FLAC files.
 
     For each file, shows a list of flags followed by the filename.
 
+    With --format ndjson, a JSON object is written per file instead, with
+    the path, flags, parse error, album tags, RELEASE_MBID, front cover,
+    number of tracks and duration in seconds.
+
     \b
     Flags:
     - O: The file parsed successfully.
@@ -40,34 +253,193 @@ def analyze(flac, verbose, hidden):
     - T: Track-level tags are present (any number).
     - P: Pictures are present (any number).
     """
-    for path in flac:
-        info = FileInfo(path)
-        if info.parse_ok:
-            album_tags = info.tags.album_tags()
-        else:
-            album_tags = {}
-        if album_tags.get('HIDE') != 'true' and hidden:
-            continue
-        if not verbose:
-            click.echo('{} {}'.format(info.summary, path))
+    with open_catalog(catalog_path) as catalog:
+        def files():
+            for path in flac:
+                entry = catalog.lookup(path) if catalog is not None else None
+                yield path, entry
+
+        def analyze_task(file):
+            return analyze_file(*file, verbose, hidden, output_format)
+
+        results = map_files(analyze_task, files(), jobs, not unordered)
+        for line, info, stat in results:
+            if catalog is not None and stat is not None:
+                catalog.store(info, stat)
+            if line is not None:
+                click.echo(line)
+
+
+def analyze_file(path, entry, verbose, hidden, output_format='text'):
+    """Return the analyze output line of a FLAC file, its info and os.stat.
+
+    The file is read unless a catalog Entry is given. The output line is
+    None for files filtered out by hidden, the os.stat result is None if
+    the file was not read.
+    """
+    info = entry
+    stat = None
+    if info is None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            pass
+        info = HeaderInfo(path)
+    if info.parse_ok:
+        album_tags = info.tags.album_tags()
+    else:
+        album_tags = {}
+    if album_tags.get('HIDE') != 'true' and hidden:
+        return None, info, stat
+    if output_format == 'ndjson':
+        record = analyze_record(path, info, album_tags)
+        return json.dumps(record), info, stat
+    if not verbose:
+        return '{} {}'.format(info.summary, path), info, stat
+    img = '|                 |'
+    url = ''
+    if info.parse_ok:
+        front = info.get_picture(FRONT_COVER_TYPE)
+        if front is not None:
+            width = front.width
+            height = front.height
+            type_ = fc.picture_ext(front).upper()
+            img = '| {:4d} x {:4d} {} |'.format(width, height, type_)
+        mbid = album_tags.get('RELEASE_MBID')
+        if mbid is not None:
+            url = ' | ' + RELEASE_URL.format(mbid)
+    return '{} {} {}{}'.format(info.summary, img, path, url), info, stat
+
+
+def analyze_record(path, info, album_tags):
+    """Return the analyze --format ndjson record of a FLAC file."""
+    error = None
+    if info.parse_exception is not None:
+        error = ca.error_message(info.parse_exception)
+    cover = None
+    front = info.get_picture(FRONT_COVER_TYPE) if info.parse_ok else None
+    if front is not None:
+        cover = {
+            'type': fc.picture_ext(front),
+            'mime': front.mime,
+            'width': front.width,
+            'height': front.height,
+        }
+    duration = None
+    stream = info.streaminfo
+    if stream is not None and stream.sample_rate:
+        duration = round(stream.sample_count / stream.sample_rate, 3)
+    return {
+        'path': path,
+        'flags': repr(info.summary),
+        'summary': info.summary.to_dict(),
+        'error': error,
+        'tags': album_tags,
+        'release_mbid': album_tags.get('RELEASE_MBID'),
+        'cover': cover,
+        'tracks': info.track_count if info.parse_ok else None,
+        'duration': duration,
+    }
+
+
+def map_files(function, files, jobs=1, ordered=True):
+    """Yield the results of function for each of files, using jobs threads.
+
+    Results are yielded in the order of files, or as they are ready if
+    ordered is False. Only QUEUE_PER_JOB files per thread are queued ahead,
+    so files can be a long iterator.
+    """
+    if jobs == 1:
+        yield from map(function, files)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        if ordered:
+            queue = deque()
+            for file in files:
+                queue.append(executor.submit(function, file))
+                if len(queue) >= jobs * QUEUE_PER_JOB:
+                    yield queue.popleft().result()
+            while queue:
+                yield queue.popleft().result()
         else:
-            img = '|                 |'
-            url = ''
-            if info.parse_ok:
-                front = info.get_picture(FRONT_COVER_TYPE)
-                if front is not None:
-                    width = front.width
-                    height = front.height
-                    type_ = fc.picture_ext(front).upper()
-                    img = '| {:4d} x {:4d} {} |'.format(width, height, type_)
-                mbid = album_tags.get('RELEASE_MBID')
-                if mbid is not None:
-                    url = ' | ' + RELEASE_URL.format(mbid)
-            click.echo('{} {} {}{}'.format(info.summary, img, path, url))
+            queue = set()
+            for file in files:
+                queue.add(executor.submit(function, file))
+                if len(queue) >= jobs * QUEUE_PER_JOB:
+                    done, queue = wait(queue, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in as_completed(queue):
+                yield future.result()
 
 
 @flackup.command()
-@click.argument('flac', type=click.Path(exists=True, dir_okay=False), nargs=-1)
+@click.argument('paths', type=click.Path(exists=True), nargs=-1)
+@catalog_option
+@click.option('-v', '--verbose',
+              help='Show the added, updated and removed files.',
+              is_flag=True)
+def index(paths, catalog_path, verbose):
+    """Update the catalog of FLAC files.
+
+    PATHS are FLAC files or directories, which are searched recursively. Only
+    new and changed files are read, entries of files missing from the
+    directories are removed. The catalog defaults to
+    $XDG_CACHE_HOME/flackup/catalog.sqlite.
+
+    The analyze, tag, cover and convert commands use the catalog with
+    --catalog or the FLACKUP_CATALOG environment variable. They skip files
+    without reading them if the entry shows that there is nothing to do.
+    """
+    if catalog_path is None:
+        catalog_path = ca.default_catalog_path()
+    counts = {ca.ADDED: 0, ca.UPDATED: 0, ca.UNCHANGED: 0}
+    removed = 0
+    with ca.Catalog(catalog_path) as catalog:
+        for path in paths:
+            is_dir = os.path.isdir(path)
+            for file in fp.walk_flac(path) if is_dir else [path]:
+                entry, state = catalog.refresh(file)
+                if state is None:
+                    continue
+                counts[state] += 1
+                if verbose and state != ca.UNCHANGED:
+                    click.echo('{} {} ({})'.format(entry.summary, file, state))
+            if is_dir:
+                for file in catalog.prune(path):
+                    removed += 1
+                    if verbose:
+                        click.echo('Removed {}'.format(file))
+    click.echo('{} files, {} added, {} updated, {} removed'.format(
+        sum(counts.values()), counts[ca.ADDED], counts[ca.UPDATED], removed))
+
+
+def open_catalog(path):
+    """Return a context manager for the Catalog at path, or for None."""
+    if path is None:
+        return nullcontext()
+    return ca.Catalog(path)
+
+
+def load_info(catalog, path):
+    """Return the FileInfo of a FLAC file, or its Entry if unchanged.
+
+    Without a Catalog, the file is always parsed. See Catalog.load.
+    """
+    if catalog is None:
+        return FileInfo(path)
+    return catalog.load(path, FileInfo)
+
+
+def file_info(info, path):
+    """Return a FileInfo for the result of load_info of path."""
+    if isinstance(info, FileInfo):
+        return info
+    return FileInfo(path)
+
+
+@flackup.command()
+@flac_input
 @click.option('--mbid',
               help='Use this MBID for release metadata.')
 @click.option('--hide',
@@ -84,23 +456,29 @@ def analyze(flac, verbose, hidden):
               help='Remove a track-level HIDE tag.',
               type=int,
               multiple=True)
-def tag(flac, mbid, hide, unhide, hide_track, unhide_track):
+@catalog_option
+def tag(flac, mbid, hide, unhide, hide_track, unhide_track, catalog_path):
     """Tag FLAC files.
 
     Files with a cue sheet but no album/track-level tags will be tagged using
     metadata from MusicBrainz.
     """
+    with open_catalog(catalog_path) as catalog:
+        tag_files(
+            flac, mbid, hide, unhide, hide_track, unhide_track, catalog)
+
+
+def tag_files(flac, mbid, hide, unhide, hide_track, unhide_track, catalog):
+    """Tag FLAC files, skipping the ones the Catalog shows as tagged."""
     mb = MusicBrainz()
+    edit = hide or unhide or hide_track or unhide_track
     for path in flac:
-        info = FileInfo(path)
-        summary = info.summary
-        if not summary.parse_ok or not summary.cuesheet:
+        info = load_info(catalog, path)
+        if not taggable(info, edit):
             continue
+        info = file_info(info, path)
+        summary = info.summary
         tagged = summary.album_tags or summary.track_tags
-        album_edit = hide or unhide
-        track_edit = hide_track or unhide_track
-        if tagged and not (album_edit or track_edit):
-            continue
         click.echo('{} {}'.format(summary, path))
         album_changed = False
         track_changed = False
@@ -113,12 +491,10 @@ def tag(flac, mbid, hide, unhide, hide_track, unhide_track):
                     release = mb.release_by_id(mbid, info.cuesheet)
                 if release is None:
                     continue
-                original_date = mb.first_release_date(release['group-id'])
+                album_changed |= apply_release(mb, info, release)
             except MusicBrainzError:
                 click.echo('- Error while querying MusicBrainz')
                 continue
-            album_changed |= update_album_tags(info, release, original_date)
-            track_changed |= update_track_tags(info, release)
         # Hide or unhide album
         tags = info.tags.album_tags()
         if hide:
@@ -137,20 +513,38 @@ def tag(flac, mbid, hide, unhide, hide_track, unhide_track):
             track_changed |= info.tags.update_track(number, tags)
         # Save any changes
         if album_changed or track_changed:
-            info.update()
+            if info.update():
+                click.echo(REWRITTEN)
+            if catalog is not None:
+                catalog.store(info)
+
+
+def taggable(info, edit=False):
+    """Return True if a FLAC file needs tagging or a tag edit."""
+    summary = info.summary
+    if not summary.parse_ok or not summary.cuesheet:
+        return False
+    return edit or not (summary.album_tags or summary.track_tags)
+
 
+def find_release(musicbrainz, fileinfo, interactive=True):
+    """Retrieve a known release or search for candidates.
 
-def find_release(musicbrainz, fileinfo):
-    """Retrieve a known release or search for candidates."""
-    release = None
+    If interactive is False, ReviewNeeded is raised instead of prompting for
+    a choice or skipping the file.
+    """
     album_tags = fileinfo.tags.album_tags()
     if 'RELEASE_MBID' in album_tags:
         mbid = album_tags['RELEASE_MBID']
     else:
         releases = musicbrainz.releases_by_cuesheet(fileinfo.cuesheet)
+        if not releases and not interactive:
+            raise ReviewNeeded('No releases found')
         if not releases:
             click.echo('- No releases found')
             return None
+        if len(releases) > 1 and not interactive:
+            raise ReviewNeeded('{} releases found'.format(len(releases)))
         if len(releases) > 1:
             while True:
                 value = prompt_releases(releases)
@@ -191,6 +585,14 @@ def prompt_releases(candidates):
     return click.prompt('## = Pick, [S]kip or [Q]uit')
 
 
+def apply_release(musicbrainz, fileinfo, release):
+    """Return True if the album or track tags were changed to the release's."""
+    original_date = musicbrainz.first_release_date(release['group-id'])
+    album_changed = update_album_tags(fileinfo, release, original_date)
+    track_changed = update_track_tags(fileinfo, release)
+    return album_changed or track_changed
+
+
 def update_album_tags(fileinfo, release, original_date):
     """Return True if the album tags were changed."""
     tags = fileinfo.tags.album_tags()
@@ -235,82 +637,748 @@ def update_track_tags(fileinfo, release):
 
 
 @flackup.command()
-@click.argument('flac', type=click.Path(exists=True, dir_okay=False), nargs=-1)
-def cover(flac):
+@flac_input
+@catalog_option
+def cover(flac, catalog_path):
     """Add cover images to tagged FLAC files."""
     mb = MusicBrainz()
+    with open_catalog(catalog_path) as catalog:
+        for path in flac:
+            info = load_info(catalog, path)
+            mbid = cover_mbid(info)
+            if mbid is None:
+                continue
+            info = file_info(info, path)
+            click.echo('{} {}'.format(info.summary, path))
+            try:
+                click.echo(fetch_cover(mb, info, mbid))
+            except MusicBrainzError:
+                click.echo('- Error while querying MusicBrainz')
+                continue
+            except Exception as e:
+                click.echo('- Error while processing image ({})'.format(e))
+                continue
+            if catalog is not None:
+                catalog.store(info)
+
+
+def cover_mbid(info):
+    """Return the RELEASE_MBID of a FLAC file without front cover, or None."""
+    if not info.parse_ok:
+        return None
+    if info.get_picture(FRONT_COVER_TYPE) is not None:
+        return None
+    return info.tags.album_tags().get('RELEASE_MBID')
+
+
+def fetch_cover(musicbrainz, fileinfo, mbid):
+    """Add the front cover of a release to the FLAC file.
+
+    Returns the output lines describing the image, as one string.
+    """
+    release = musicbrainz.release_by_id(mbid)
+    data = musicbrainz.front_cover(release)
+    if data is None:
+        return '- No image found'
+    front = fc.parse_picture(data, FRONT_COVER_TYPE)
+    rewritten = fileinfo.set_picture(front) and fileinfo.update()
+    width = front.width
+    height = front.height
+    type_ = fc.picture_ext(front).upper()
+    line = '- {} x {} {}'.format(width, height, type_)
+    if rewritten:
+        line += '\n' + REWRITTEN
+    return line
+
+
+@flackup.command()
+@flac_input
+@click.option('-s', '--size',
+              help='Padding to reserve in each file, e.g. 1M.',
+              type=SizeType(),
+              default='1M',
+              show_default=True)
+def pad(flac, size):
+    """Reserve metadata padding in FLAC files.
+
+    Files with less padding than --size are rewritten once with --size bytes
+    of padding, so that later tag and cover changes up to that size are
+    written in place, without moving the audio data. Other files are not
+    changed.
+    """
+    if size > MAX_PADDING:
+        raise click.BadParameter(
+            'At most {} bytes.'.format(MAX_PADDING), param_hint='--size')
     for path in flac:
         info = FileInfo(path)
-        if not info.parse_ok:
-            continue
-        album_tags = info.tags.album_tags()
-        mbid = album_tags.get('RELEASE_MBID')
-        if mbid is None:
-            continue
-        front = info.get_picture(FRONT_COVER_TYPE)
-        if front is not None:
+        if not info.parse_ok or info.padding >= size:
             continue
         click.echo('{} {}'.format(info.summary, path))
-        try:
-            release = mb.release_by_id(mbid)
-            data = mb.front_cover(release)
-            if data is not None:
-                front = fc.parse_picture(data, FRONT_COVER_TYPE)
-                if info.set_picture(front):
-                    info.update()
-                width = front.width
-                height = front.height
-                type_ = fc.picture_ext(front).upper()
-                click.echo('- {} x {} {}'.format(width, height, type_))
+        padding = info.padding
+        info.update(padding=size, min_padding=size)
+        click.echo('- Padding: {} -> {} bytes'.format(padding, info.padding))
+
+
+@flackup.command()
+@flac_input
+@click.option('-d', '--output-dir',
+              help='Output directory',
+              type=click.Path(exists=True, file_okay=False, writable=True),
+              default='.')
+@click.option('-p', '--profile', 'profiles',
+              help='Output profile as FORMAT:QUALITY:DIR, e.g. ogg:6:Music. '
+                   'Replaces --output-dir, can be repeated.',
+              type=ProfileType(),
+              multiple=True)
+@click.option('--hidden',
+              help='Convert only albums with a HIDE=true tag.',
+              is_flag=True)
+@conversion_options
+@click.option('-a', '--albums', 'album_jobs',
+              help='Number of albums to convert concurrently.',
+              type=click.IntRange(min=1),
+              default=1,
+              show_default=True)
+@click.option('--stream',
+              help='Stream audio to the encoders without temporary WAV files.',
+              is_flag=True)
+@click.option('--temp-budget',
+              help='Temporary disk space for the albums being converted, '
+                   'e.g. 4G. [default: free space of the temp directory]',
+              type=SizeType())
+@click.option('--retag',
+              help='Only update the tags of existing output files.',
+              is_flag=True)
+@click.option('--metrics', 'metrics_file',
+              help='Write per-stage metrics of each album as JSON lines.',
+              type=click.File('w'))
+@click.option('--cover', 'covers',
+              help='Cover image as NAME:WIDTH, can be repeated. '
+                   '[default: cover.jpg:500]',
+              type=CoverType(),
+              multiple=True)
+@click.option('--enqueue', 'spool_dir',
+              help='Add the albums to this spool directory for flackup '
+                   'worker instead of converting them.',
+              type=click.Path(file_okay=False, writable=True))
+@catalog_option
+def convert(flac, output_dir, profiles, hidden, jobs, temp_dir, timeout,
+            cover_cache, album_jobs, stream, temp_budget, retag, metrics_file,
+            covers, spool_dir, catalog_path):
+    """Convert FLAC files.
+
+    Each file is decoded once for all profiles. A manifest in each output
+    directory records the converted tracks, so only changed tracks are
+    encoded, retagged, renamed or deleted. Profiles with output files missing
+    from the manifest are skipped for an album.
+
+    Tracks are encoded to hidden temporary files and renamed when finished.
+    They are journaled at the same time, so that an interrupted conversion
+    resumes with the unfinished tracks.
+
+    With --retag, the tags of existing output files are compared with the
+    FLAC file and rewritten if needed, whether in the manifest or not. No
+    audio is encoded.
+
+    Albums are converted longest first, output is shown per album once it is
+    finished. An album is only decoded when its temporary WAV files (twice
+    its PCM size for a whole file) fit in --temp-budget next to the other
+    albums being converted. Without --jobs, the number of concurrent
+    decoders/encoders is lowered while the CPUs mostly wait for I/O and
+    raised while they are not saturated.
+
+    With --metrics, the wall time, CPU time, bytes read and written, audio
+    seconds and real-time factor of each stage (decode, stream, encode,
+    replaygain, cover) are written per album, followed by a summary. The
+    total of an album is measured around its whole conversion, for the
+    audio seconds of its encoded tracks, as the stages can overlap.
+
+    With --enqueue, albums with changes are added to a spool directory as
+    jobs for flackup worker, with the profiles, --hidden, --stream and
+    --cover options.
+    """
+    if temp_budget is None and not stream:
+        temp_budget = shutil.disk_usage(temp_dir or tempfile.gettempdir()).free
+    budget = fc.TempBudget(temp_budget)
+    if not profiles:
+        profiles = [fc.Profile('ogg', fc.DEFAULT_QUALITY, output_dir)]
+    covers = dict(covers) or fc.COVER_SIZES
+    cache = open_cover_cache(cover_cache)
+    manifests = {}
+    albums = []
+    planned = set()
+    with open_catalog(catalog_path) as catalog:
+        for path in flac:
+            info = load_info(catalog, path)
+            if not convertible(info, hidden):
+                continue
+            info = file_info(info, path)
+            if retag:
+                retag_album(info, profiles, manifests)
+                continue
+            plans = plan_album(info, profiles, manifests, planned)
+            if not plans:
+                continue
+            albums.append((info.streaminfo.sample_count, path, plans))
+    albums.sort(key=lambda a: a[0], reverse=True)
+    if spool_dir is not None:
+        spool = sp.Spool(spool_dir)
+        queued = spool.queued_keys()
+        for _, path, _ in albums:
+            job = {
+                'path': os.path.abspath(path),
+                'profiles': [
+                    [p.fmt, p.quality, os.path.abspath(p.base_dir)]
+                    for p in profiles
+                ],
+                'hidden': hidden,
+                'stream': stream,
+                'covers': covers,
+            }
+            click.echo(path)
+            if spool.enqueue(job, queued) is None:
+                click.echo('- Already queued')
             else:
-                click.echo('- No image found')
-        except MusicBrainzError:
-            click.echo('- Error while querying MusicBrainz')
+                click.echo('- Enqueued')
+        return
+    failed = False
+    runner = open_runner(jobs, timeout)
+    summary = Metrics()
+    start = time.perf_counter()
+    try:
+        with runner, ThreadPoolExecutor(max_workers=album_jobs) as executor, \
+                summary.overall():
+            futures = {}
+            for _, path, plans in albums:
+                metrics = Metrics()
+                future = executor.submit(
+                    convert_album, path, plans, runner, stream, metrics,
+                    covers, cache, budget, temp_dir)
+                futures[future] = (path, metrics)
+            try:
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+                    lines, ok = future.result()
+                    for line in lines:
+                        click.echo(line)
+                    path, metrics = futures[future]
+                    summary.add(metrics)
+                    if metrics_file is not None:
+                        write_metrics(
+                            metrics_file, metrics, type='album', path=path,
+                            ok=ok)
+                    if not ok and not failed:
+                        failed = True
+                        for pending in futures:
+                            pending.cancel()
+            except BaseException:
+                for pending in futures:
+                    pending.cancel()
+                raise
+    finally:
+        for manifest in manifests.values():
+            manifest.close()
+    if metrics_file is not None:
+        write_metrics(
+            metrics_file, summary, type='summary', albums=len(albums),
+            wall=round(time.perf_counter() - start, 6))
+    if failed:
+        click.get_current_context().exit(1)
+
+
+def convertible(fileinfo, hidden=False):
+    """Return True if the FLAC file has a cue sheet and album tags.
+
+    Albums with a HIDE=true tag are only convertible if hidden is True.
+    """
+    summary = fileinfo.summary
+    if not summary.parse_ok or not summary.cuesheet:
+        return False
+    album_tags = fileinfo.tags.album_tags()
+    if album_tags.get('HIDE') == 'true' and not hidden:
+        return False
+    return 'ARTIST' in album_tags and 'ALBUM' in album_tags
+
+
+def profile_manifest(profile, manifests):
+    """Return the Manifest of the Profile's directory, opening it once.
+
+    The Manifests are kept in manifests, by real path of their directory.
+    """
+    key = os.path.realpath(profile.base_dir)
+    if key not in manifests:
+        manifests[key] = fm.Manifest(profile.base_dir)
+    return manifests[key]
+
+
+def plan_album(fileinfo, profiles, manifests, planned=None):
+    """Return the (Manifest, Plan) tuples of a FLAC file's changed outputs.
+
+    Profiles with output paths in the planned set are skipped, the paths of
+    the planned ones are added to it.
+    """
+    if planned is None:
+        planned = set()
+    source = fm.source_info(fileinfo)
+    plans = []
+    for profile in profiles:
+        manifest = profile_manifest(profile, manifests)
+        profile_tracks = fc.prepare_profiles(fileinfo, [profile])
+        if any(map(lambda t: t.path in planned, profile_tracks)):
             continue
-        except Exception as e:
-            click.echo('- Error while processing image ({})'.format(e))
+        plan = manifest.plan(source, profile_tracks)
+        if plan is None or not plan.changed:
             continue
+        planned.update(t.path for t in profile_tracks)
+        plans.append((manifest, plan))
+    return plans
+
+
+def retag_album(fileinfo, profiles, manifests):
+    """Rewrite the outdated tags of a FLAC file's existing outputs."""
+    source = fm.source_info(fileinfo)
+    retags = []
+    for profile in profiles:
+        manifest = profile_manifest(profile, manifests)
+        retags += [
+            (manifest, t) for t in fc.prepare_profiles(fileinfo, [profile])
+            if os.path.exists(t.path) and fc.retag_needed(t)
+        ]
+    if not retags:
+        return
+    click.echo('{} {}'.format(fileinfo.summary, fileinfo.path))
+    click.echo('- Retagging tracks')
+    for manifest, track in retags:
+        fc.retag_ogg(track)
+        manifest.update_tags(source, track)
+        manifest.save()
+
+
+def write_metrics(metrics_file, metrics, **fields):
+    """Write Metrics and additional fields as a JSON line.
+
+    The type field is "album" for album records and "summary" for the
+    aggregate written at the end of the run.
+    """
+    record = dict(fields)
+    record['stages'] = metrics.to_dict()
+    record['total'] = metrics.total().to_dict()
+    metrics_file.write(json.dumps(record) + '\n')
+    metrics_file.flush()
+
+
+def convert_album(path, plans, runner, stream=False, metrics=None,
+                  covers=fc.COVER_SIZES, cache=None, budget=None,
+                  temp_dir=None):
+    """Convert a FLAC file according to (Manifest, Plan) tuples.
+
+    Cover images are exported as "covers", see export_covers. WAV files are
+    decoded in temp_dir, once their space is reserved in the TempBudget.
+
+    Returns the output lines and False in case of errors.
+    """
+    try:
+        info = FileInfo(path)
+        tracks = [t for _, plan in plans for t in plan.encode]
+        audio = fc.audio_seconds(info, {t.number for t in tracks})
+        with measure_overall(metrics, audio):
+            return _convert_album(
+                info, tracks, plans, runner, stream, metrics, covers, cache,
+                budget, temp_dir)
+    except Exception as e:
+        return [path, 'ERROR {}'.format(e)], False
+
+
+def _convert_album(info, tracks, plans, runner, stream, metrics, covers,
+                   cache, budget, temp_dir):
+    path = info.path
+    source = fm.source_info(info)
+    lines = ['{} {}'.format(info.summary, path)]
+    moved = [t for _, plan in plans for _, t in plan.move]
+    resumed = [t for _, plan in plans for t in plan.resume]
+    journals = {t.path: m for m, plan in plans for t in plan.encode}
+
+    def on_encoded(track, analysis):
+        stat = os.stat(fc.partial_path(track.path))
+        journals[track.path].journal(source, track, analysis, stat)
+
+    analyses = {}
+    try:
+        if resumed:
+            lines.append('- Resuming tracks')
+        if tracks and stream and fc.pcm_aligned(info.streaminfo):
+            lines.append('- Streaming tracks')
+            analyses = fc.stream_tracks(
+                info, tracks, 'ogg', runner=runner, replaygain=False,
+                metrics=metrics, on_encoded=on_encoded)
+        elif tracks:
+            numbers = [t.number for t in tracks]
+            if budget is None:
+                budget = fc.TempBudget()
+            with budget.reserve(fc.temp_bytes(info, numbers)):
+                lines.append('- Decoding tracks')
+                tempdir = fc.decode_tracks(
+                    info, numbers, runner=runner, metrics=metrics,
+                    temp_dir=temp_dir)
+                try:
+                    lines.append('- Encoding tracks')
+                    analyses = fc.encode_tracks(
+                        tracks, tempdir, 'ogg', runner=runner,
+                        replaygain=False, metrics=metrics,
+                        on_encoded=on_encoded)
+                finally:
+                    tempdir.cleanup()
+        if any(plan.delete for _, plan in plans):
+            lines.append('- Deleting tracks')
+        if moved:
+            lines.append('- Renaming tracks')
+        if moved or any(plan.retag for _, plan in plans):
+            lines.append('- Retagging tracks')
+        for manifest, plan in plans:
+            update_outputs(
+                manifest, plan, source, analyses, runner, metrics, covers)
+    except fc.ConversionError as e:
+        lines.append('ERROR {}'.format(e))
+        return lines, False
+    finally:
+        for manifest, _ in plans:
+            manifest.save()
+    front = info.get_picture(FRONT_COVER_TYPE)
+    if front is not None:
+        dst_bases = {os.path.dirname(t.path) for t in tracks + moved + resumed}
+        for dst_base in sorted(dst_bases):
+            fc.export_covers(front, dst_base, covers, metrics, cache)
+    return lines, True
+
+
+def update_outputs(manifest, plan, source, analyses, runner, metrics=None,
+                   covers=fc.COVER_SIZES):
+    """Apply the non-encoding parts of a Plan and record it in the Manifest.
+
+    The encoded Tracks' GainAnalysis are passed as analyses. The stored ones
+    are used for the other Tracks of an album whose ReplayGain changes.
+    Resumed Tracks are retagged, in case the tags changed since.
+    """
+    gains = {}
+    for track in plan.resume + plan.retag + plan.keep:
+        gains[track.number] = manifest.gain(track.path)
+    for old_path, track in plan.move:
+        gains[track.number] = manifest.gain(old_path)
+    gains.update(analyses)
+    old_dirs = set()
+    for dst_path in plan.delete:
+        try:
+            os.remove(dst_path)
+        except FileNotFoundError:
+            pass
+        manifest.remove(dst_path)
+        old_dirs.add(os.path.dirname(dst_path))
+    for old_path, track in plan.move:
+        os.makedirs(os.path.dirname(track.path), exist_ok=True)
+        os.replace(old_path, track.path)
+        manifest.remove(old_path)
+        old_dirs.add(os.path.dirname(old_path))
+    moved = [track for _, track in plan.move]
+    for track in plan.resume + plan.retag + moved:
+        fc.retag_ogg(track)
+    if plan.encode or plan.resume or plan.move or plan.delete:
+        fc.add_replaygain(plan.tracks, gains, runner, metrics)
+    for track in plan.encode + plan.resume + plan.retag + moved:
+        manifest.record(source, track, gains.get(track.number))
+    for old_dir in sorted(old_dirs, reverse=True):
+        fm.prune(old_dir, covers)
 
 
 @flackup.command()
-@click.argument('flac', type=click.Path(exists=True, dir_okay=False), nargs=-1)
+@click.argument('spool_dir', metavar='SPOOL',
+                type=click.Path(file_okay=False, writable=True))
+@conversion_options
+@click.option('--poll',
+              help='Seconds between checks for new jobs.',
+              type=click.FloatRange(min=0),
+              default=10.0,
+              show_default=True)
+@click.option('--stale',
+              help='Seconds without heartbeat after which claimed jobs are '
+                   'queued again.',
+              type=click.FloatRange(min=0, min_open=True),
+              default=sp.STALE_AFTER,
+              show_default=True)
+@click.option('--exit-when-empty',
+              help='Exit when no jobs are pending.',
+              is_flag=True)
+@click.option('--status',
+              help='Show the jobs in the spool and exit.',
+              is_flag=True)
+def worker(spool_dir, jobs, temp_dir, timeout, cover_cache, poll, stale,
+           exit_when_empty, status):
+    """Convert albums queued with convert --enqueue.
+
+    Several workers, on one or more hosts sharing the spool directory and
+    the output directories, can run at the same time. Each job is claimed
+    by one worker and moved to the "done" or "failed" sub-directory of the
+    spool with its output lines and metrics. Jobs claimed by workers that
+    stopped (no heartbeat for --stale seconds, or a dead process on this
+    host) are queued again. A worker that lost its claim that way leaves
+    the job to the worker that claimed it next, and as each process writes
+    its own partial output files, they never write the same file.
+
+    Exits with status 1 if any job failed.
+    """
+    spool = sp.Spool(spool_dir)
+    if status:
+        show_spool(spool)
+        return
+    cache = open_cover_cache(cover_cache)
+    name = sp.worker_id()
+    heartbeat = min(sp.HEARTBEAT_INTERVAL, stale / 4)
+    manifests = {}
+    failed = False
+    with open_runner(jobs, timeout) as runner:
+        while True:
+            spool.recover(stale)
+            claim = spool.claim(name)
+            if claim is None:
+                if exit_when_empty:
+                    break
+                time.sleep(poll)
+                continue
+            started = time.time()
+            with spool.heartbeat(claim, heartbeat) as lost:
+                lines, ok, metrics = run_job(
+                    claim.job, runner, cache, temp_dir, manifests)
+            for line in lines:
+                click.echo(line)
+            result = {
+                'worker': name,
+                'started': started,
+                'ok': ok,
+                'lines': lines,
+                'stages': metrics.to_dict(),
+                'total': metrics.total().to_dict(),
+            }
+            if lost.is_set() or not spool.finish(claim, result, ok):
+                click.echo('- Claim lost to another worker, not finished')
+                continue
+            failed |= not ok
+    if failed:
+        click.get_current_context().exit(1)
+
+
+def run_job(job, runner, cache=None, temp_dir=None, manifests=None):
+    """Convert the album of a spool job.
+
+    The Manifests of the output directories are kept in manifests across
+    jobs, see profile_manifest, and only read again for new records.
+
+    Returns the output lines, False in case of errors, and the Metrics.
+    """
+    if manifests is None:
+        manifests = {}
+    metrics = Metrics()
+    path = job['path']
+    try:
+        info = FileInfo(path)
+        if not info.parse_ok:
+            return [path, 'ERROR Cannot read the file.'], False, metrics
+        if not convertible(info, job.get('hidden', False)):
+            return [], True, metrics
+        profiles = [fc.Profile(*profile) for profile in job['profiles']]
+        for profile in profiles:
+            profile_manifest(profile, manifests).load()
+        plans = plan_album(info, profiles, manifests)
+        if not plans:
+            return [], True, metrics
+        lines, ok = convert_album(
+            path, plans, runner, job.get('stream', False), metrics,
+            job.get('covers') or fc.COVER_SIZES, cache, temp_dir=temp_dir)
+    except Exception as e:
+        return [path, 'ERROR {}'.format(e)], False, metrics
+    return lines, ok, metrics
+
+
+def show_spool(spool):
+    """Show the number of jobs per state, with the claimed and failed ones."""
+    jobs = spool.status()
+    for state in sp.STATES:
+        click.echo('{}: {}'.format(state, len(jobs[state])))
+        for job in jobs[state]:
+            if state == sp.CLAIMED:
+                click.echo('- {} ({})'.format(job.get('path'), job['worker']))
+            elif state == sp.FAILED:
+                lines = job.get('result', {}).get('lines') or ['']
+                click.echo('- {} {}'.format(job.get('path'), lines[-1]))
+
+
+@flackup.command()
+@click.argument('inbox',
+                type=click.Path(exists=True, file_okay=False, writable=True))
 @click.option('-d', '--output-dir',
               help='Output directory',
               type=click.Path(exists=True, file_okay=False, writable=True),
               default='.')
-@click.option('--hidden',
-              help='Convert only albums with a HIDE=true tag.',
+@click.option('-p', '--profile', 'profiles',
+              help='Output profile as FORMAT:QUALITY:DIR, e.g. ogg:6:Music. '
+                   'Replaces --output-dir, can be repeated.',
+              type=ProfileType(),
+              multiple=True)
+@click.option('--review', 'review_dir',
+              help='Directory for files that need a release choice. '
+                   '[default: INBOX/review]',
+              type=click.Path(file_okay=False, writable=True))
+@click.option('--settle',
+              help='Seconds a closed file must stay unchanged.',
+              type=click.FloatRange(min=0),
+              default=fw.SETTLE_TIME,
+              show_default=True)
+@conversion_options
+@click.option('-a', '--albums', 'album_jobs',
+              help='Number of files to process concurrently.',
+              type=click.IntRange(min=1),
+              default=2,
+              show_default=True)
+@click.option('--scan',
+              help='Also process the FLAC files already in INBOX.',
               is_flag=True)
-def convert(flac, output_dir, hidden):
-    """Convert FLAC files."""
-    for path in flac:
+@click.option('--once',
+              help='Process the FLAC files already in INBOX and exit.',
+              is_flag=True)
+def watch(inbox, output_dir, profiles, review_dir, settle, jobs, temp_dir,
+          timeout, cover_cache, album_jobs, scan, once):
+    """Tag, add covers to and convert new FLAC files in INBOX.
+
+    New FLAC files are noticed with inotify once they are closed after
+    writing (or moved in) and stayed unchanged for --settle seconds. Each
+    one is tagged from MusicBrainz, given a cover and converted like the
+    tag, cover and convert commands do, several files at a time.
+
+    Files with no or several MusicBrainz releases are moved to the review
+    directory, keeping their path relative to INBOX. Tag them with flackup
+    tag and move them back to be converted.
+    """
+    if review_dir is None:
+        review_dir = os.path.join(inbox, 'review')
+    if not profiles:
+        profiles = [fc.Profile('ogg', fc.DEFAULT_QUALITY, output_dir)]
+    manifests = {}
+    for profile in profiles:
+        profile_manifest(profile, manifests)
+    rips = RipProcessor(
+        inbox, review_dir, profiles, manifests,
+        open_cover_cache(cover_cache), temp_dir)
+    runner = open_runner(jobs, timeout)
+    try:
+        with runner, ThreadPoolExecutor(max_workers=album_jobs) as executor:
+            if once:
+                paths = fp.find_flac(inbox, [review_dir])
+                futures = [executor.submit(rips, p, runner) for p in paths]
+                for future in futures:
+                    for line in future.result():
+                        click.echo(line)
+                return
+            watch_inbox(inbox, rips, runner, executor, settle, scan)
+    finally:
+        for manifest in manifests.values():
+            manifest.close()
+
+
+def watch_inbox(inbox, rips, runner, executor, settle, scan):
+    """Submit complete FLAC files in the inbox to the executor until stopped.
+
+    With scan True, the files already in the inbox are submitted first.
+    """
+    futures = {}
+    with fw.Watcher(inbox, settle, [rips.review_dir]) as watcher:
+        paths = fp.find_flac(inbox, [rips.review_dir]) if scan else []
+        overflows = 0
+        while True:
+            for path in paths:
+                futures[executor.submit(rips, path, runner)] = path
+            paths = watcher.poll(1.0)
+            if watcher.overflows > overflows:
+                overflows = watcher.overflows
+                click.echo('Too many changes, some files may be missed')
+            for future in [f for f in futures if f.done()]:
+                for line in future.result():
+                    click.echo(line)
+                watcher.done(futures.pop(future))
+
+
+class RipProcessor(object):
+    """Tag, add a cover to and convert new FLAC files.
+
+    Call it with the path of a FLAC file and a ProcessRunner, to get the
+    output lines. Files that need a release choice are moved to the review
+    directory. Covers are resized through the CoverCache, WAV files are
+    decoded in temp_dir.
+    """
+
+    def __init__(self, inbox, review_dir, profiles, manifests, cache=None,
+                 temp_dir=None):
+        self.inbox = inbox
+        self.review_dir = review_dir
+        self.profiles = profiles
+        self.manifests = manifests
+        self.cache = cache
+        self.temp_dir = temp_dir
+        self.musicbrainz = MusicBrainz()
+
+    def __call__(self, path, runner):
+        try:
+            return self.process(path, runner)
+        except Exception as e:
+            return [path, 'ERROR {}'.format(e)]
+
+    def process(self, path, runner):
+        """Process a FLAC file and return the output lines."""
+        mb = self.musicbrainz
         info = FileInfo(path)
         summary = info.summary
+        lines = ['{} {}'.format(summary, path)]
         if not summary.parse_ok or not summary.cuesheet:
-            continue
-        album_tags = info.tags.album_tags()
-        if album_tags.get('HIDE') == 'true' and not hidden:
-            continue
-        if 'ARTIST' not in album_tags or 'ALBUM' not in album_tags:
-            continue
-        tracks = fc.prepare_tracks(info, output_dir, 'ogg')
-        if not tracks:
-            continue
-        if any(map(lambda t: os.path.exists(t.path), tracks)):
-            continue
-        click.echo('{} {}'.format(summary, path))
+            lines.append('- No cue sheet')
+            return lines
         try:
-            click.echo('- Decoding tracks')
-            tempdir = fc.decode_tracks(info)
-            click.echo('- Encoding tracks')
-            fc.encode_tracks(tracks, tempdir, 'ogg')
-        except fc.ConversionError as e:
-            click.echo('ERROR {}'.format(e))
-            click.get_current_context().exit(1)
-        front = info.get_picture(FRONT_COVER_TYPE)
-        if front is not None:
-            dst_base = os.path.dirname(tracks[0].path)
-            fc.export_cover(front, dst_base)
+            if not (summary.album_tags or summary.track_tags):
+                release = find_release(mb, info, interactive=False)
+                rewritten = apply_release(mb, info, release) and info.update()
+                lines.append('- Tagged from MusicBrainz')
+                if rewritten:
+                    lines.append(REWRITTEN)
+        except ReviewNeeded as e:
+            lines.append('- {}, moved to {}'.format(e, self.park(path)))
+            return lines
+        except MusicBrainzError:
+            dst_path = self.park(path)
+            lines.append(
+                '- Error while querying MusicBrainz, moved to {}'.format(
+                    dst_path))
+            return lines
+        mbid = cover_mbid(info)
+        if mbid is not None:
+            try:
+                lines.append(fetch_cover(mb, info, mbid))
+            except MusicBrainzError:
+                lines.append('- Error while querying MusicBrainz for a cover')
+        if not convertible(info):
+            return lines
+        plans = plan_album(info, self.profiles, self.manifests)
+        if plans:
+            album_lines, _ = convert_album(
+                path, plans, runner, cache=self.cache, temp_dir=self.temp_dir)
+            lines += album_lines[1:]
+        return lines
+
+    def park(self, path):
+        """Move a FLAC file to the review directory and return its new path."""
+        relpath = os.path.relpath(path, self.inbox)
+        if relpath.startswith(os.pardir):
+            relpath = os.path.basename(path)
+        dst_path = os.path.join(self.review_dir, relpath)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        shutil.move(path, dst_path)
+        return dst_path
 
 
 @flackup.command()
@@ -334,17 +1402,14 @@ def version(dependencies):
 def get_version(command, parameter='--version'):
     """Return the command's version string, or None."""
     path = shutil.which(command)
-    if path:
-        res = subprocess.run(
-            [command, parameter],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            timeout=5)
-    if path and res.returncode == 0:
-        return res.stdout.strip()
-    else:
+    if not path:
         return None
+    with fc.ProcessRunner(timeout=5) as runner:
+        try:
+            output = runner.call(runner.exec([command, parameter], True))
+        except fc.ConversionError:
+            return None
+    return output.decode(errors='replace').strip()
 
 
 if __name__ == '__main__':
@@ -1,22 +1,97 @@
-from collections import namedtuple
+import asyncio
+from collections import namedtuple, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+import errno
 import io
+import mmap
 import os
 import os.path
 import re
 import shutil
+import socket
+import struct
+import subprocess
 import tempfile
+import threading
 import wave
 
+from mutagen.oggvorbis import OggVorbis
 from PIL import Image
 
-from flackup.fileinfo import Picture
+from flackup.fileinfo import Picture, StreamInfo
+from flackup.metrics import measure
+import flackup.replaygain as rg
+from flackup.spool import pid_alive
 
 
 ESC_RE = re.compile(r'[^-\w ,&()]')
 TRACK_WAV = 'track-{:02d}.wav'
+WAVE_FORMAT_PCM = 1
 
+"""Size of the WAVE_FORMAT_EXTENSIBLE header written by flac."""
+WAV_EXTENSIBLE_HEADER = 68
 
-Track = namedtuple('Track', 'number path tags')
+"""Size limit of a CoverCache directory in bytes."""
+COVER_CACHE_SIZE = 64 * 1024 * 1024
+
+"""Fraction of its size limit a full CoverCache directory is pruned to."""
+COVER_CACHE_PRUNE = 0.75
+
+"""Size limit of the images a CoverCache keeps in memory, in bytes."""
+COVER_CACHE_MEMORY = 16 * 1024 * 1024
+
+"""Size of the chunks read from a streaming decoder."""
+STREAM_CHUNK = 1024 * 1024
+
+"""Default number of PCM bytes buffered for streaming encoders."""
+STREAM_BUFFER = 64 * STREAM_CHUNK
+
+"""Seconds between load samples of an adaptive ProcessRunner."""
+ADAPT_INTERVAL = 1.0
+
+"""CPU busy fraction below which an adaptive ProcessRunner adds a process."""
+CPU_SATURATION = 0.9
+
+"""I/O wait fraction above which an adaptive ProcessRunner drops a process."""
+IO_SATURATION = 0.2
+
+"""Suffix of outputs being written, see partial_path."""
+PARTIAL_SUFFIX = '.part'
+
+
+"""Vorbis comments written from the Track tags."""
+VORBIS_COMMENTS = [
+    'TITLE',
+    'ARTIST',
+    'ALBUM',
+    'DATE',
+    'GENRE',
+    'TRACKNUMBER',
+    'DISCNUMBER',
+    'ALBUMARTIST',
+]
+
+"""Cover image file names and maximum widths."""
+COVER_SIZES = {'cover.jpg': 500}
+
+"""Minimum ratio of a reduced cover image to its final size.
+
+Images are decoded at a reduced size (JPEG) or box-reduced (other formats)
+down to this ratio before the final LANCZOS resampling, like
+Image.thumbnail does.
+"""
+REDUCING_GAP = 2.0
+
+"""Default Ogg Vorbis quality."""
+DEFAULT_QUALITY = 6
+
+
+Track = namedtuple(
+    'Track', 'number path tags quality', defaults=(DEFAULT_QUALITY,))
+
+
+"""An output format, quality and base directory."""
+Profile = namedtuple('Profile', 'fmt quality base_dir')
 
 
 class ConversionError(Exception):
@@ -24,7 +99,16 @@ class ConversionError(Exception):
     pass
 
 
-def prepare_tracks(fileinfo, base_dir, fmt):
+def prepare_profiles(fileinfo, profiles):
+    """Return a list of Tracks to be encoded for all Profiles."""
+    tracks = []
+    for profile in profiles:
+        tracks += prepare_tracks(
+            fileinfo, profile.base_dir, profile.fmt, profile.quality)
+    return tracks
+
+
+def prepare_tracks(fileinfo, base_dir, fmt, quality=DEFAULT_QUALITY):
     """Return a list of Tracks to be encoded."""
     def esc(filename):
         """Escape non-whitelisted characters in the filename."""
@@ -59,104 +143,998 @@ def prepare_tracks(fileinfo, base_dir, fmt):
         if track_artist is not None and track_artist != album_artist:
             set_album_artist = True
         tags.update(track_tags)
-        tracks.append(Track(track.number, dst_path, tags))
+        tracks.append(Track(track.number, dst_path, tags, quality))
     if set_album_artist:
         for track in tracks:
             track.tags['ALBUMARTIST'] = album_artist
     return tracks
 
 
-def decode_tracks(fileinfo):
+class ProcessRunner(object):
+    """Run external tools as asyncio subprocesses.
+
+    The runner has its own event loop in a background thread, so it can be
+    shared by several threads. At most "jobs" processes run at the same time,
+    and each one is killed after "timeout" seconds, if set. Errors are raised
+    as ConversionError, including the process' stderr output. See adapt to
+    change the number of processes with the system load.
+
+    Use it as a context manager, or call close when done.
+    """
+
+    def __init__(self, jobs=1, timeout=None):
+        self.timeout = timeout
+        self.jobs = jobs
+        self._running = 0
+        self._waiters = []
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever,
+            name='flackup-runner',
+            daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Cancel anything still running and stop the event loop."""
+        if self._loop.is_closed():
+            return
+        self.call(self._cancel_tasks())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def call(self, coroutine):
+        """Run the coroutine on the event loop and return its result."""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def set_jobs(self, jobs):
+        """Change the number of processes running at the same time.
+
+        Running processes are not stopped if the number is lowered.
+        """
+        self._loop.call_soon_threadsafe(self._set_jobs, jobs)
+
+    def adapt(self, max_jobs, interval=ADAPT_INTERVAL):
+        """Adapt the number of processes to the system load until closed.
+
+        Every "interval" seconds, the CPU and I/O wait times are sampled from
+        /proc/stat and the number is changed by one between 1 and max_jobs,
+        see adapt_jobs. Nothing changes if /proc/stat is not available.
+        """
+        asyncio.run_coroutine_threadsafe(
+            self._adapt(max_jobs, interval), self._loop)
+
+    async def _adapt(self, max_jobs, interval):
+        previous = read_cpu_times()
+        while previous is not None:
+            await asyncio.sleep(interval)
+            current = read_cpu_times()
+            if current is None:
+                break
+            busy, iowait = load_fractions(previous, current)
+            previous = current
+            self._set_jobs(adapt_jobs(
+                self.jobs, max_jobs, busy, iowait, bool(self._waiters)))
+
+    def _set_jobs(self, jobs):
+        self.jobs = jobs
+        self._wake()
+
+    async def _acquire_slot(self):
+        while self._running >= self.jobs:
+            waiter = self._loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                self._waiters.remove(waiter)
+        self._running += 1
+
+    def _release_slot(self):
+        self._running -= 1
+        self._wake()
+
+    def _wake(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def run(self, *commands):
+        """Run the commands, which are argument lists, concurrently.
+
+        See gather for the error handling.
+        """
+        self.call(self.gather(*[self.exec(args) for args in commands]))
+
+    async def gather(self, *awaitables):
+        """Return the results of the awaitables, in order.
+
+        The first exception cancels the others and is raised once they are
+        finished.
+        """
+        tasks = [asyncio.ensure_future(a) for a in awaitables]
+        if not tasks:
+            return []
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in tasks:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+        return [task.result() for task in tasks]
+
+    async def exec(self, args, capture=False):
+        """Run a command and return its stdout output, if captured."""
+        stdout = asyncio.subprocess.PIPE if capture else None
+        async with self.process(args, stdout=stdout) as process:
+            output = None
+            if capture:
+                output = await process.stdout.read()
+        return output
+
+    @asynccontextmanager
+    async def slot(self):
+        """Count the block as one of the "jobs" processes.
+
+        Use it with process and slot False to run several processes that
+        depend on each other as one job.
+        """
+        await self._acquire_slot()
+        try:
+            yield
+        finally:
+            self._release_slot()
+
+    @asynccontextmanager
+    async def process(self, args, stdin=None, stdout=None, slot=True,
+                      check=True):
+        """Start a process, and wait for it at the end of the block.
+
+        Pass asyncio.subprocess.PIPE as stdin or stdout to stream data.
+        With slot False, the process does not count against "jobs".
+        With check False, the exit status is not checked.
+
+        The process is killed if the block raises an exception.
+        """
+        if slot:
+            await self._acquire_slot()
+        try:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdin=stdin or subprocess.DEVNULL,
+                    stdout=stdout or subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE)
+            except OSError as e:
+                raise ConversionError('{}: {}'.format(args[0], e.strerror))
+            stderr = asyncio.ensure_future(process.stderr.read())
+            expired = []
+            watchdog = None
+            if self.timeout is not None:
+                watchdog = self._loop.call_later(
+                    self.timeout, self._expire, process, expired)
+            try:
+                yield process
+                await drain(process.stdout)
+                await process.wait()
+            except BaseException as e:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                await drain(process.stdout)
+                if expired:
+                    raise ConversionError(timeout_message(args)) from e
+                if isinstance(e, OSError) and process.returncode:
+                    message = failure_message(args, process, await stderr)
+                    raise ConversionError(message) from e
+                raise
+            finally:
+                if watchdog is not None:
+                    watchdog.cancel()
+                errors = await stderr
+            if expired:
+                raise ConversionError(timeout_message(args))
+            if check and process.returncode != 0:
+                raise ConversionError(failure_message(args, process, errors))
+        finally:
+            if slot:
+                self._release_slot()
+
+    @staticmethod
+    def _expire(process, expired):
+        expired.append(True)
+        if process.returncode is None:
+            process.kill()
+
+    @staticmethod
+    async def _cancel_tasks():
+        current = asyncio.current_task()
+        tasks = [t for t in asyncio.all_tasks() if t is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def drain(reader):
+    """Read and discard everything up to EOF from the StreamReader, if any.
+
+    This lets the pipe transport close after the process has exited.
+    """
+    if reader is None:
+        return
+    while await reader.read(STREAM_CHUNK):
+        pass
+
+
+def failure_message(args, process, stderr):
+    """Return an error message for a failed process."""
+    message = '{} exited with status {}.'.format(
+        os.path.basename(args[0]), process.returncode)
+    details = stderr.decode(errors='replace').strip()
+    if details:
+        message = '{} {}'.format(message, details)
+    return message
+
+
+def timeout_message(args):
+    """Return an error message for a process that timed out."""
+    return '{} timed out.'.format(os.path.basename(args[0]))
+
+
+"""CPU time counters of /proc/stat, in clock ticks."""
+CpuTimes = namedtuple('CpuTimes', 'total idle iowait')
+
+
+def read_cpu_times():
+    """Return the CpuTimes of all CPUs, or None if not available."""
+    try:
+        with open('/proc/stat') as f:
+            fields = f.readline().split()
+    except OSError:
+        return None
+    if len(fields) < 6 or fields[0] != 'cpu':
+        return None
+    # user nice system idle iowait irq softirq steal (guest is in user)
+    times = [int(field) for field in fields[1:9]]
+    return CpuTimes(sum(times), times[3], times[4])
+
+
+def load_fractions(before, after):
+    """Return the busy and I/O wait fractions of CPU time between CpuTimes."""
+    total = after.total - before.total
+    if total <= 0:
+        return 0.0, 0.0
+    idle = after.idle - before.idle
+    iowait = after.iowait - before.iowait
+    return (total - idle - iowait) / total, iowait / total
+
+
+def adapt_jobs(jobs, max_jobs, busy, iowait, waiting):
+    """Return the number of processes to run for the measured load.
+
+    A process is dropped while the CPUs mostly wait for I/O, and added while
+    they have time to spare and processes are waiting for a slot.
+    """
+    if iowait > IO_SATURATION:
+        return max(jobs - 1, 1)
+    if busy < CPU_SATURATION and waiting:
+        return min(jobs + 1, max_jobs)
+    return min(jobs, max_jobs)
+
+
+class TempBudget(object):
+    """Admission control for temporary disk space.
+
+    Albums reserve their predicted temporary space before decoding, and wait
+    while it does not fit in "limit" bytes. A reservation larger than the
+    limit is admitted once nothing else is reserved. With a limit of None,
+    nothing waits.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        """Wait until size bytes fit in the budget, and hold them."""
+        with self._condition:
+            while not self._fits(size):
+                self._condition.wait()
+            self.used += size
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.used -= size
+                self._condition.notify_all()
+
+    def _fits(self, size):
+        if self.limit is None or self.used == 0:
+            return True
+        return self.used + size <= self.limit
+
+
+@contextmanager
+def default_runner(runner, jobs):
+    """Yield the ProcessRunner, or a new one for "jobs" processes."""
+    if runner is not None:
+        yield runner
+    else:
+        with ProcessRunner(jobs) as runner:
+            yield runner
+
+
+def decode_tracks(fileinfo, numbers=None, jobs=1, runner=None, metrics=None,
+                  temp_dir=None):
     """Decode the FLAC file into individual WAV files.
 
     WAV file names follow the pattern "track-NN.wav".
-    Tracks with a "HIDE" tag set to "true" are skipped.
+    If numbers is None, tracks with a "HIDE" tag set to "true" are skipped.
 
-    Returns a TemporaryDirectory with the WAV files, or None.
+    If only some of the audio tracks are requested, or the samples do not
+    fill whole bytes (see pcm_aligned), each one is decoded on its own from
+    its cue sheet offset, up to "jobs" concurrently. Otherwise, the whole
+    file is decoded once and split into tracks. See temp_bytes for the disk
+    space needed.
+
+    Returns a TemporaryDirectory with the WAV files, created in temp_dir or
+    the default temporary directory.
     """
     executable = shutil.which('flac')
     if executable is None:
         raise ConversionError('flac executable not found.')
 
-    tempdir = tempfile.TemporaryDirectory(prefix='flackup-')
-    flac = fileinfo.path
-    wav = os.path.join(tempdir.name, 'flackup.wav')
-    res = os.system('flac -s -d {} -o {}'.format(quote(flac), quote(wav)))
-    exit = res >> 8
-    if exit != 0:
-        raise ConversionError('Non-zero exit status.')
-
+    ranges = track_ranges(fileinfo)
+    if numbers is None:
+        numbers = [
+            n for n in ranges
+            if fileinfo.tags.track_tags(n).get('HIDE') != 'true'
+        ]
+    wanted = set(numbers)
+    numbers = [n for n in ranges if n in wanted]
     stream = fileinfo.streaminfo
-    tracks = fileinfo.cuesheet.audio_tracks
-    numbers = [t.number for t in tracks]
-    starts = [t.offset for t in tracks]
-    ends = starts[1:] + [stream.sample_count]
-    sample_bytes = stream.channels * (stream.sample_bits // 8)
+    tempdir = tempfile.TemporaryDirectory(prefix='flackup-', dir=temp_dir)
+    audio = audio_seconds(fileinfo, numbers)
+    with measure(metrics, 'decode', audio) as stage:
+        if len(numbers) < len(ranges) or not pcm_aligned(stream):
+            commands = []
+            for number in numbers:
+                start, end = ranges[number]
+                if end >= stream.sample_count:
+                    end = None
+                out_name = TRACK_WAV.format(number)
+                out_path = os.path.join(tempdir.name, out_name)
+                commands.append(flac_args(fileinfo.path, out_path, start, end))
+            with default_runner(runner, jobs) as runner:
+                runner.run(*commands)
+            stage.read += flac_bytes(fileinfo, audio)
+            stage.written += dir_size(tempdir.name)
+            return tempdir
 
-    with wave.open(wav, 'rb') as wave_in:
-        for number, start, end in zip(numbers, starts, ends):
-            tags = fileinfo.tags.track_tags(number)
-            if tags.get('HIDE') == 'true':
-                continue
-            out_name = TRACK_WAV.format(number)
-            out_path = os.path.join(tempdir.name, out_name)
-            wave_in.setpos(start)
-            with wave.open(out_path, 'wb') as wave_out:
-                wave_out.setnchannels(stream.channels)
-                wave_out.setsampwidth(stream.sample_bits // 8)
-                wave_out.setframerate(stream.sample_rate)
-                copy(wave_in, wave_out, end - start, sample_bytes)
-
-    os.remove(wav)
+        flac = fileinfo.path
+        raw = os.path.join(tempdir.name, 'flackup.raw')
+        with default_runner(runner, jobs) as runner:
+            runner.run(flac_args(flac, raw, raw=stream))
+        raw_size = os.path.getsize(raw)
+        stage.read += os.path.getsize(flac)
+        stage.written += raw_size
+
+        sample_bytes = pcm_sample_bytes(stream)
+        if raw_size < stream.sample_count * sample_bytes:
+            raise ConversionError('Unexpected end of file.')
+
+        with open(raw, 'rb') as raw_in:
+            for number in numbers:
+                start, end = ranges[number]
+                out_name = TRACK_WAV.format(number)
+                out_path = os.path.join(tempdir.name, out_name)
+                with open(out_path, 'wb') as wav_out:
+                    wav_out.write(wav_header(stream, end - start))
+                    wav_out.flush()
+                    offset = start * sample_bytes
+                    count = (end - start) * sample_bytes
+                    copy(raw_in, wav_out, offset, count)
+                stage.read += count
+                stage.written += os.path.getsize(out_path)
+
+        os.remove(raw)
     return tempdir
 
 
-def encode_tracks(tracks, tempdir, fmt):
-    """Encode the Tracks from WAV files in tempdir."""
-    for track in tracks:
-        dst_base = os.path.dirname(track.path)
-        os.makedirs(dst_base, exist_ok=True)
-        src_name = TRACK_WAV.format(track.number)
-        src_path = os.path.join(tempdir.name, src_name)
-        encode_ogg(track, src_path)
-    replaygain_ogg(tracks)
+def temp_bytes(fileinfo, numbers):
+    """Return the peak temporary disk space of decode_tracks in bytes.
+
+    Decoding the whole file needs its raw PCM image and the WAV files of the
+    tracks, decoding some tracks only needs their WAV files.
+    """
+    stream = fileinfo.streaminfo
+    sample_bytes = pcm_sample_bytes(stream)
+    ranges = track_ranges(fileinfo)
+    wanted = [n for n in ranges if n in set(numbers)]
+    if pcm_aligned(stream):
+        header = len(wav_header(stream, 0))
+    else:
+        header = WAV_EXTENSIBLE_HEADER
+    size = sum(
+        (ranges[n][1] - ranges[n][0]) * sample_bytes + header for n in wanted)
+    if len(wanted) < len(ranges) or not pcm_aligned(stream):
+        return size
+    return size + stream.sample_count * sample_bytes
+
+
+def flac_args(flac, dst, start=None, end=None, raw=None):
+    """Return the flac command line to decode the file, or a range of it.
+
+    The output is a WAV file, or raw PCM if raw is the StreamInfo of the
+    FLAC file. Use "-" as dst for stdout.
+    """
+    cmd = ['flac', '-s', '-d']
+    if start:
+        cmd.append('--skip={}'.format(start))
+    if end is not None:
+        cmd.append('--until={}'.format(end))
+    if raw is not None:
+        cmd += raw_args(raw)
+    if dst == '-':
+        cmd.append('-c')
+    else:
+        cmd += ['-o', dst]
+    cmd.append(flac)
+    return cmd
+
+
+def raw_args(streaminfo):
+    """Return the flac arguments for little-endian raw PCM output.
+
+    The sample format matches WAV: unsigned for 8 bits, signed otherwise.
+    """
+    sign = 'unsigned' if streaminfo.sample_bits <= 8 else 'signed'
+    return [
+        '--force-raw-format',
+        '--endian=little',
+        '--sign={}'.format(sign),
+    ]
 
 
-def encode_ogg(track, src_path):
-    """Encode the Track as Ogg Vorbis."""
+def pcm_sample_bytes(streaminfo):
+    """Return the number of bytes per PCM sample, for all channels."""
+    return streaminfo.channels * ((streaminfo.sample_bits + 7) // 8)
+
+
+def pcm_aligned(streaminfo):
+    """Return True if the samples fill whole bytes, e.g. 16 or 24 bits.
+
+    flac writes other sample sizes (e.g. 20 bits) as raw PCM right-justified
+    in whole bytes, which a plain PCM WAV header does not describe, so they
+    are only decoded to WAV files by flac.
+    """
+    return streaminfo.sample_bits % 8 == 0
+
+
+def wav_header(streaminfo, sample_count):
+    """Return a PCM WAV header for the given number of samples.
+
+    The samples must be pcm_aligned.
+    """
+    sample_bytes = pcm_sample_bytes(streaminfo)
+    data_size = sample_count * sample_bytes
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF',
+        36 + data_size,
+        b'WAVE',
+        b'fmt ',
+        16,
+        WAVE_FORMAT_PCM,
+        streaminfo.channels,
+        streaminfo.sample_rate,
+        streaminfo.sample_rate * sample_bytes,
+        sample_bytes,
+        sample_bytes // streaminfo.channels * 8,
+        b'data',
+        data_size
+    )
+
+
+def encode_tracks(tracks, tempdir, fmt, jobs=1, runner=None,
+                  replaygain=True, metrics=None, on_encoded=None):
+    """Encode the Tracks from WAV files in tempdir.
+
+    The Tracks may belong to several Profiles, sharing the WAV files.
+    Up to "jobs" tracks are encoded concurrently. The first error stops the
+    remaining tracks, ReplayGain is added once all tracks are finished unless
+    replaygain is False.
+
+    Each Track is written to its partial_path and renamed once encoded and
+    analyzed, see finish_output for on_encoded. The ReplayGain analysis runs
+    alongside the encoders and is measured as part of the "encode" stage.
+
+    Returns a dictionary of track numbers to GainAnalysis (or None).
+    """
     executable = shutil.which('oggenc')
     if executable is None:
         raise ConversionError('oggenc executable not found.')
 
+    def src_path(number):
+        return os.path.join(tempdir.name, TRACK_WAV.format(number))
+
+    async def encode_number(number):
+        number_tracks = [t for t in tracks if t.number == number]
+        await runner.gather(
+            *[encode_ogg(runner, t, src_path(number)) for t in number_tracks])
+        analysis = await asyncio.to_thread(analyze_wav, src_path(number))
+        for track in number_tracks:
+            finish_output(track, analysis, on_encoded)
+        return analysis
+
+    prepare_outputs(tracks)
+    numbers = sorted({t.number for t in tracks})
+    with default_runner(runner, jobs) as runner:
+        with measure(metrics, 'encode') as stage:
+            try:
+                results = runner.call(runner.gather(
+                    *[encode_number(n) for n in numbers]))
+            except BaseException:
+                remove_partials(tracks)
+                raise
+            for track in tracks:
+                stage.audio += wav_seconds(src_path(track.number))
+                stage.read += os.path.getsize(src_path(track.number))
+                stage.written += os.path.getsize(track.path)
+        analyses = dict(zip(numbers, results))
+        if replaygain:
+            add_replaygain(tracks, analyses, runner, metrics)
+    return analyses
+
+
+async def encode_ogg(runner, track, src_path):
+    """Encode the Track as Ogg Vorbis to its partial_path."""
+    partial = track._replace(path=partial_path(track.path))
+    await runner.exec(oggenc_args(partial, src_path))
+
+
+def partial_path(path):
+    """Return the temporary path an output is written to.
+
+    It is a hidden file in the same directory, so that the finished file
+    can be renamed into place atomically. The name includes the
+    partial_owner, so that two processes converting the same output (like
+    a worker that lost its claim and the next one) never write one file.
+    """
+    dst_base, name = os.path.split(path)
+    return os.path.join(dst_base, '.{}.{}{}'.format(
+        name, partial_owner(), PARTIAL_SUFFIX))
+
+
+def partial_owner():
+    """Return the owner of this process' partial_path files, "HOST-PID"."""
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def prepare_outputs(tracks):
+    """Create the directories of the Tracks and remove stale partials.
+
+    A partial_path is stale if its process ran on this host and is gone.
+    Those of other hosts cannot be told from running ones and are kept.
+    """
+    names = {}
+    for track in tracks:
+        dst_base, name = os.path.split(track.path)
+        names.setdefault(dst_base, set()).add(name)
+    hostname = socket.gethostname()
+    for dst_base, dir_names in names.items():
+        os.makedirs(dst_base, exist_ok=True)
+        prefixes = ['.{}.{}-'.format(n, hostname) for n in dir_names]
+        for entry in os.listdir(dst_base):
+            if not entry.endswith(PARTIAL_SUFFIX):
+                continue
+            pids = [
+                entry[len(p):-len(PARTIAL_SUFFIX)]
+                for p in prefixes if entry.startswith(p)
+            ]
+            if any(p.isdigit() and not pid_alive(int(p)) for p in pids):
+                try:
+                    os.remove(os.path.join(dst_base, entry))
+                except FileNotFoundError:
+                    pass
+
+
+def finish_output(track, analysis, on_encoded=None):
+    """Rename the Track's partial_path to its path.
+
+    If set, on_encoded is called with the Track and its GainAnalysis (or
+    None) just before, so that it can journal the output with the os.stat
+    result of its partial_path. Renaming keeps the size and modification
+    time, which tells a renamed output from an older one at the same path.
+    """
+    if on_encoded is not None:
+        on_encoded(track, analysis)
+    os.replace(partial_path(track.path), track.path)
+
+
+def remove_partials(tracks):
+    """Remove the partial_path files left by failed Tracks."""
+    for track in tracks:
+        try:
+            os.remove(partial_path(track.path))
+        except FileNotFoundError:
+            pass
+
+
+def analyze_wav(path):
+    """Return a GainAnalysis of the WAV file, or None if unsupported."""
+    try:
+        with wave.open(path, 'rb') as wav:
+            stream = StreamInfo(
+                wav.getnchannels(),
+                wav.getsampwidth() * 8,
+                wav.getframerate(),
+                wav.getnframes()
+            )
+            if not rg.supported(stream):
+                return None
+            analysis = rg.GainAnalysis(stream)
+            while True:
+                frames = wav.readframes(rg.BLOCK_LENGTH)
+                if not frames:
+                    break
+                analysis.feed(frames)
+    except wave.Error:
+        return None
+    return analysis.finish()
+
+
+def stream_tracks(fileinfo, tracks, fmt, jobs=1, buffer_size=STREAM_BUFFER,
+                  runner=None, replaygain=True, metrics=None,
+                  on_encoded=None):
+    """Decode the FLAC file and stream the Tracks directly to the encoders.
+
+    The decoder output is read once and each Track's samples are piped to its
+    encoder, without any WAV files. Tracks of several Profiles with the same
+    number share the samples and count as one job. Up to "jobs" tracks are
+    encoded concurrently, with at most "buffer_size" bytes of PCM waiting for
+    them. The first error stops the remaining tracks, ReplayGain is added once
+    all tracks are finished unless replaygain is False, using the streamed
+    samples. Outputs are renamed into place as in encode_tracks. The samples
+    must be pcm_aligned, otherwise use decode_tracks and encode_tracks.
+
+    Returns a dictionary of track numbers to GainAnalysis (or None).
+    """
+    if not pcm_aligned(fileinfo.streaminfo):
+        raise ConversionError('Cannot stream {}-bit samples.'.format(
+            fileinfo.streaminfo.sample_bits))
+    for executable in ['flac', 'oggenc']:
+        if shutil.which(executable) is None:
+            raise ConversionError('{} executable not found.'.format(executable))
+    prepare_outputs(tracks)
+
+    numbers = {t.number for t in tracks}
+    audio = sum(audio_seconds(fileinfo, [t.number]) for t in tracks)
+    with default_runner(runner, jobs) as runner:
+        with measure(metrics, 'stream', audio) as stage:
+            try:
+                analyses = runner.call(_stream_tracks(
+                    runner, fileinfo, tracks, buffer_size, on_encoded))
+            except BaseException:
+                remove_partials(tracks)
+                raise
+            stage.read += flac_bytes(
+                fileinfo, audio_seconds(fileinfo, numbers))
+            stage.written += sum(os.path.getsize(t.path) for t in tracks)
+        if replaygain:
+            add_replaygain(tracks, analyses, runner, metrics)
+    return analyses
+
+
+async def _stream_tracks(runner, fileinfo, tracks, buffer_size, on_encoded):
+    stream = fileinfo.streaminfo
+    sample_bytes = pcm_sample_bytes(stream)
+    ranges = track_ranges(fileinfo)
+    numbers = [n for n in ranges if any(t.number == n for t in tracks)]
+    fan_out = max(sum(1 for t in tracks if t.number == n) for n in numbers)
+    buffered = asyncio.Semaphore(max(fan_out, buffer_size // STREAM_CHUNK))
+    analyses = {}
+    encoders = []
+    errors = []
+    args = flac_args(fileinfo.path, '-', raw=stream)
+    pipe = asyncio.subprocess.PIPE
+    async with runner.process(args, stdout=pipe, slot=False, check=False) \
+            as decoder:
+        position = 0
+        try:
+            for number in numbers:
+                start, end = ranges[number]
+                await skip(decoder.stdout, (start - position) * sample_bytes)
+                number_tracks = [t for t in tracks if t.number == number]
+                chunk_queues = [asyncio.Queue() for _ in number_tracks]
+                encoders.append(asyncio.ensure_future(stream_number(
+                    runner, number_tracks, stream, chunk_queues, buffered,
+                    errors)))
+                analysis = None
+                if rg.supported(stream):
+                    analysis = rg.GainAnalysis(stream)
+                remaining = (end - start) * sample_bytes
+                while remaining:
+                    for _ in chunk_queues:
+                        await buffered.acquire()
+                    if errors:
+                        raise errors[0]
+                    chunk = await decoder.stdout.read(
+                        min(STREAM_CHUNK, remaining))
+                    if not chunk:
+                        for _ in chunk_queues:
+                            buffered.release()
+                        raise ConversionError('Unexpected end of stream.')
+                    for chunk_queue in chunk_queues:
+                        chunk_queue.put_nowait(chunk)
+                    if analysis is not None:
+                        await asyncio.to_thread(analysis.feed, chunk)
+                    remaining -= len(chunk)
+                for chunk_queue in chunk_queues:
+                    chunk_queue.put_nowait(None)
+                if analysis is not None:
+                    analysis.finish()
+                analyses[number] = analysis
+                encoders.append(asyncio.ensure_future(finish_outputs(
+                    encoders[-1:], number_tracks, analysis, on_encoded)))
+                position = end
+            if position < stream.sample_count:
+                decoder.kill()
+            await runner.gather(*encoders)
+        except BaseException:
+            for encoder in encoders:
+                encoder.cancel()
+            await asyncio.gather(*encoders, return_exceptions=True)
+            raise
+    if position == stream.sample_count and decoder.returncode != 0:
+        raise ConversionError('flac exited with status {}.'.format(
+            decoder.returncode))
+    return analyses
+
+
+async def finish_outputs(encoders, tracks, analysis, on_encoded):
+    """Wait for the encoders, then call finish_output for the Tracks."""
+    await asyncio.gather(*encoders)
+    for track in tracks:
+        finish_output(track, analysis, on_encoded)
+
+
+async def stream_number(runner, tracks, stream, chunk_queues, buffered,
+                        errors):
+    """Run stream_ogg for Tracks sharing the same samples, as one job.
+
+    The encoders must run together: each chunk is only released once all
+    of them have written it. Taking a slot for each could leave one waiting
+    for a slot held by another, which waits for its chunks.
+    """
+    async with runner.slot():
+        results = await asyncio.gather(*[
+            stream_ogg(runner, track, stream, chunk_queue, buffered, errors,
+                       slot=False)
+            for track, chunk_queue in zip(tracks, chunk_queues)
+        ], return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def stream_ogg(runner, track, stream, chunk_queue, buffered, errors,
+                     slot=True):
+    """Encode the Track as Ogg Vorbis from queued raw PCM chunks.
+
+    The output is written to the Track's partial_path. With slot False, the
+    encoder does not count against the runner's "jobs".
+
+    Each chunk releases the buffered semaphore once written. After an error,
+    the remaining chunks are discarded and the error is added to errors.
+    """
+    finished = False
+    try:
+        partial = track._replace(path=partial_path(track.path))
+        args = oggenc_args(partial, '-', raw=stream)
+        pipe = asyncio.subprocess.PIPE
+        async with runner.process(args, stdin=pipe, slot=slot) as encoder:
+            while True:
+                chunk = await chunk_queue.get()
+                if chunk is None:
+                    finished = True
+                    break
+                try:
+                    encoder.stdin.write(chunk)
+                    await encoder.stdin.drain()
+                finally:
+                    buffered.release()
+            encoder.stdin.close()
+    except (ConversionError, OSError) as e:
+        if not isinstance(e, ConversionError):
+            e = ConversionError(str(e))
+        errors.append(e)
+        while not finished:
+            chunk = await chunk_queue.get()
+            if chunk is None:
+                finished = True
+            else:
+                buffered.release()
+        raise e
+
+
+def audio_seconds(fileinfo, numbers):
+    """Return the duration of the tracks in seconds."""
+    ranges = track_ranges(fileinfo)
+    samples = sum(ranges[n][1] - ranges[n][0] for n in numbers)
+    return samples / fileinfo.streaminfo.sample_rate
+
+
+def flac_bytes(fileinfo, seconds):
+    """Return the approximate FLAC file size of a duration in seconds."""
+    stream = fileinfo.streaminfo
+    if not stream.sample_count:
+        return 0
+    fraction = seconds * stream.sample_rate / stream.sample_count
+    return int(os.path.getsize(fileinfo.path) * fraction)
+
+
+def wav_seconds(path):
+    """Return the duration of a WAV file in seconds."""
+    with wave.open(path, 'rb') as wav:
+        return wav.getnframes() / wav.getframerate()
+
+
+def dir_size(path):
+    """Return the total size of the files in a directory."""
+    return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+
+
+def track_ranges(fileinfo):
+    """Return a dictionary of track numbers to (start, end) sample ranges."""
+    stream = fileinfo.streaminfo
+    tracks = fileinfo.cuesheet.audio_tracks
+    numbers = [t.number for t in tracks]
+    starts = [t.offset for t in tracks]
+    ends = starts[1:] + [stream.sample_count]
+    return dict(zip(numbers, zip(starts, ends)))
+
+
+async def skip(reader, count):
+    """Read and discard count bytes from the StreamReader."""
+    while count > 0:
+        chunk = await reader.read(min(STREAM_CHUNK, count))
+        if not chunk:
+            raise ConversionError('Unexpected end of stream.')
+        count -= len(chunk)
+
+
+def oggenc_args(track, src_path, raw=None):
+    """Return the oggenc command line for the Track.
+
+    For raw PCM input, pass the StreamInfo of the samples as raw.
+    """
     tags = track.tags
     cmd = [
         'oggenc',
         '-Q',
-        '-q 6',
-        '-o {}'.format(quote(track.path)),
+        '-q', '{:g}'.format(track.quality),
+        '-o', track.path,
         '--utf8',
-        '-t {}'.format(quote(tags.get('TITLE', ''))),
-        '-a {}'.format(quote(tags.get('ARTIST', ''))),
-        '-l {}'.format(quote(tags.get('ALBUM', ''))),
-        '-d {}'.format(quote(tags.get('DATE', ''))),
-        '-G {}'.format(quote(tags.get('GENRE', ''))),
-        '-N {}'.format(track.number),
+        '-t', tags.get('TITLE', ''),
+        '-a', tags.get('ARTIST', ''),
+        '-l', tags.get('ALBUM', ''),
+        '-d', tags.get('DATE', ''),
+        '-G', tags.get('GENRE', ''),
+        '-N', str(track.number),
     ]
     disc = tags.get('DISC')
     if disc is not None:
-        cmd.append('-c DISCNUMBER={}'.format(disc))
+        cmd += ['-c', 'DISCNUMBER={}'.format(disc)]
     album_artist = tags.get('ALBUMARTIST')
     if album_artist is not None:
-        cmd.append('-c ALBUMARTIST={}'.format(quote(album_artist)))
+        cmd += ['-c', 'ALBUMARTIST={}'.format(album_artist)]
+    if raw is not None:
+        cmd += [
+            '-r',
+            '-B', str(raw.sample_bits),
+            '-C', str(raw.channels),
+            '-R', str(raw.sample_rate),
+            '--raw-endianness', '0',
+        ]
     cmd.append(src_path)
-    res = os.system(' '.join(cmd))
-    exit = res >> 8
-    if exit != 0:
-        raise ConversionError('Non-zero exit status.')
+    return cmd
+
+
+def vorbis_comments(track):
+    """Return the Vorbis comments of the Track, as written by oggenc_args."""
+    tags = track.tags
+    comments = {}
+    for key in ['TITLE', 'ARTIST', 'ALBUM', 'DATE', 'GENRE']:
+        if tags.get(key):
+            comments[key] = tags[key]
+    comments['TRACKNUMBER'] = str(track.number)
+    if 'DISC' in tags:
+        comments['DISCNUMBER'] = tags['DISC']
+    if 'ALBUMARTIST' in tags:
+        comments['ALBUMARTIST'] = tags['ALBUMARTIST']
+    return comments
+
+
+def retag_ogg(track):
+    """Replace the Vorbis comments of an encoded Track.
+
+    Only VORBIS_COMMENTS are replaced, ReplayGain tags are kept.
+    """
+    ogg = OggVorbis(track.path)
+    for key in list(ogg.keys()):
+        if key.upper() in VORBIS_COMMENTS:
+            del ogg[key]
+    for key, value in vorbis_comments(track).items():
+        ogg[key] = value
+    ogg.save()
+
 
+def retag_needed(track):
+    """Return True if the Vorbis comments of an encoded Track are outdated."""
+    ogg = OggVorbis(track.path)
+    current = {}
+    for key, values in ogg.items():
+        values = [v for v in values if v]
+        if key.upper() in VORBIS_COMMENTS and values:
+            current[key.upper()] = values
+    wanted = {k: [v] for k, v in vorbis_comments(track).items()}
+    return current != wanted
 
-def replaygain_ogg(tracks):
-    """Add ReplayGain information to the Tracks."""
+
+def add_replaygain(tracks, analyses, runner=None, metrics=None):
+    """Add ReplayGain information to the Tracks.
+
+    Uses a dictionary of track numbers to GainAnalysis (or GainResult), or
+    vorbisgain if any of them is None. Tracks in the same directory form an
+    album.
+    """
+    albums = {}
+    for track in tracks:
+        albums.setdefault(os.path.dirname(track.path), []).append(track)
+    for album in albums.values():
+        album_analyses = [analyses.get(t.number) for t in album]
+        if any(a is None for a in album_analyses):
+            replaygain_ogg(album, runner, metrics)
+            continue
+        album_gain, album_peak = rg.album_gain(album_analyses)
+        with measure(metrics, 'replaygain'):
+            for track, analysis in zip(album, album_analyses):
+                ogg = OggVorbis(track.path)
+                tags = replaygain_tags(analysis.gain, analysis.peak, 'TRACK')
+                tags.update(replaygain_tags(album_gain, album_peak, 'ALBUM'))
+                for key, value in tags.items():
+                    ogg[key] = value
+                ogg.save()
+
+
+def replaygain_tags(gain, peak, level):
+    """Return a dictionary of ReplayGain tags for the level."""
+    tags = {}
+    if gain is not None:
+        tags['REPLAYGAIN_{}_GAIN'.format(level)] = '{:+.2f} dB'.format(gain)
+        tags['REPLAYGAIN_{}_PEAK'.format(level)] = '{:.8f}'.format(peak)
+    return tags
+
+
+def replaygain_ogg(tracks, runner=None, metrics=None):
+    """Add ReplayGain information to the Tracks using vorbisgain."""
     executable = shutil.which('vorbisgain')
     if executable is None:
         raise ConversionError('vorbisgain executable not found.')
@@ -167,11 +1145,12 @@ def replaygain_ogg(tracks):
         '-a',
     ]
     for track in tracks:
-        cmd.append(quote(track.path))
-    res = os.system(' '.join(cmd))
-    exit = res >> 8
-    if exit != 0:
-        raise ConversionError('Non-zero exit status.')
+        cmd.append(track.path)
+    audio = sum(OggVorbis(t.path).info.length for t in tracks)
+    with measure(metrics, 'replaygain', audio) as stage:
+        with default_runner(runner, 1) as runner:
+            runner.run(cmd)
+        stage.read += sum(os.path.getsize(t.path) for t in tracks)
 
 
 def parse_picture(bytes_, type_):
@@ -207,32 +1186,238 @@ def picture_ext(picture):
         return 'bin'
 
 
-def export_cover(picture, dst_base, max_width=500):
-    """Export the Picture as a size-constrained cover.ext file."""
-    cover_path = os.path.join(dst_base, 'cover.jpg')
+def export_cover(picture, dst_base, max_width=500, metrics=None, cache=None):
+    """Export the Picture as a size-constrained cover.jpg file."""
+    export_covers(picture, dst_base, {'cover.jpg': max_width}, metrics, cache)
+
+
+def export_covers(picture, dst_base, sizes=COVER_SIZES, metrics=None,
+                  cache=None):
+    """Export the Picture as size-constrained cover images.
+
+    sizes maps file names to maximum widths. Pictures within the width are
+    copied, larger ones are decoded once at a reduced size and resized for
+    all names. Resized images are looked up in and added to the CoverCache.
+    """
+    with measure(metrics, 'cover') as stage:
+        stage.read += picture.length
+        image = None
+        widths = [w for w in sizes.values() if picture.width > w]
+        for name, max_width in sizes.items():
+            if picture.width <= max_width:
+                data = picture.data
+            else:
+                data = None
+                if cache is not None:
+                    data = cache.get(picture, max_width)
+                if data is None:
+                    if image is None:
+                        image = open_reduced(picture, max(widths))
+                    data = resize_cover(image, picture, max_width)
+                    if cache is not None:
+                        cache.put(picture, max_width, data)
+            with open(os.path.join(dst_base, name), 'wb') as f:
+                f.write(data)
+            stage.written += len(data)
+
+
+def cover_height(picture, width):
+    """Return the height of the Picture resized to width."""
+    return int(picture.height * width / picture.width)
+
+
+def open_reduced(picture, width):
+    """Return the Picture's Image, reduced on decoding for a width.
+
+    JPEG images are decoded with DCT scaling, others are box-reduced by an
+    integer factor. Both keep REDUCING_GAP times the final size.
+    """
     image = Image.open(io.BytesIO(picture.data))
-    if picture.width > max_width:
-        factor = max_width / picture.width
-        height = int(picture.height * factor)
-        image = image.resize((max_width, height), Image.LANCZOS)
-        if image.mode != 'RGB':
-            image = image.convert(mode='RGB')
-        image.save(cover_path, quality=90, optimize=True)
-    else:
-        with open(cover_path, 'wb') as f:
-            f.write(picture.data)
+    target = (
+        int(width * REDUCING_GAP),
+        int(cover_height(picture, width) * REDUCING_GAP),
+    )
+    if image.format == 'JPEG':
+        image.draft('RGB', target)
+        return image
+    factor = min(image.width // target[0], image.height // max(target[1], 1))
+    if factor > 1:
+        image = image.reduce(factor)
+    return image
+
+
+def resize_cover(image, picture, width):
+    """Return the Image resized to width as JPEG data."""
+    height = cover_height(picture, width)
+    image = image.resize((width, height), Image.LANCZOS)
+    if image.mode != 'RGB':
+        image = image.convert(mode='RGB')
+    data = io.BytesIO()
+    image.save(data, format='JPEG', quality=90, optimize=True)
+    return data.getvalue()
+
+
+class CoverCache(object):
+    """Resized cover images, keyed by the original's content hash.
+
+    Images are kept in memory and, if a directory is given, on disk. Use
+    default_cache_dir for the user's cache directory. The least recently
+    used images are dropped from memory beyond COVER_CACHE_MEMORY bytes,
+    and removed from the directory once it holds more than max_size bytes.
+
+    Variables:
+    - directory: The cache directory, or None.
+    - max_size: The size limit of the directory in bytes.
+    """
+
+    def __init__(self, directory=None, max_size=COVER_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._images = OrderedDict()
+        self._memory = 0
+        self._disk = None
+        self._lock = threading.Lock()
+
+    def get(self, picture, width):
+        """Return resized JPEG data of the Picture, or None."""
+        key = self.key(picture, width)
+        with self._lock:
+            data = self._images.get(key)
+            if data is not None:
+                self._images.move_to_end(key)
+        if data is not None or self.directory is None:
+            return data
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, picture, width, data):
+        """Add resized JPEG data of the Picture."""
+        key = self.key(picture, width)
+        self._remember(key, data)
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, key)
+        with tempfile.NamedTemporaryFile(
+                dir=self.directory, prefix='.tmp-', delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+        with self._lock:
+            if self._disk is None:
+                self._disk = self.prune(self.max_size)
+            else:
+                self._disk += len(data)
+            if self._disk > self.max_size:
+                self._disk = self.prune(
+                    int(self.max_size * COVER_CACHE_PRUNE))
+
+    def prune(self, max_size):
+        """Remove the least recently used images beyond max_size bytes.
+
+        Returns the size of the remaining images.
+        """
+        images = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.') or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    images.append((stat.st_mtime_ns, stat.st_size, entry))
+        except FileNotFoundError:
+            return 0
+        size = sum(image[1] for image in images)
+        for _, image_size, entry in sorted(images, key=lambda i: i[:2]):
+            if size <= max_size:
+                break
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            size -= image_size
+        return size
+
+    def _remember(self, key, data):
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self._memory -= len(old)
+            self._images[key] = data
+            self._memory += len(data)
+            while self._memory > COVER_CACHE_MEMORY and len(self._images) > 1:
+                _, dropped = self._images.popitem(last=False)
+                self._memory -= len(dropped)
+
+    @staticmethod
+    def key(picture, width):
+        """Return the cache key of the Picture resized to width."""
+        return '{}-{}.jpg'.format(picture.digest, width)
+
+
+def default_cache_dir():
+    """Return the cover cache directory below XDG_CACHE_HOME."""
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'flackup', 'covers')
+
+
+def cpu_count():
+    """Return the number of CPUs usable by this process."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def copy(src, dst, offset, count):
+    """Copy count bytes at offset in src to the current position in dst.
+
+    The bytes are copied by the kernel if possible, using copy_file_range or
+    sendfile, with a mmap slice as fallback.
+    """
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    for method in (_copy_file_range, _sendfile):
+        try:
+            while count:
+                copied = method(src_fd, dst_fd, offset, count)
+                if copied == 0:
+                    raise ConversionError('Unexpected end of file.')
+                offset += copied
+                count -= copied
+            return
+        except (AttributeError, OSError) as e:
+            if getattr(e, 'errno', None) not in _COPY_FALLBACK_ERRORS:
+                raise
+    if count:
+        with mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ) as view:
+            if offset + count > len(view):
+                raise ConversionError('Unexpected end of file.')
+            os.lseek(dst_fd, 0, os.SEEK_END)
+            dst.write(view[offset:offset + count])
+
+
+"""Errors that make copy try the next method."""
+_COPY_FALLBACK_ERRORS = {
+    None,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EXDEV,
+}
 
 
-def copy(wave_in, wave_out, sample_count, sample_bytes):
-    """Copy samples between WAV objects."""
-    b_size = 65536 // sample_bytes
-    while sample_count:
-        b = wave_in.readframes(min(b_size, sample_count))
-        b_samples = len(b) // sample_bytes
-        sample_count -= b_samples
-        wave_out.writeframes(b)
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset)
 
 
-def quote(string):
-    """Return the string in double quotes, escaped."""
-    return '"{}"'.format(string.replace('"', '\\"'))
+def _sendfile(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
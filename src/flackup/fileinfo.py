@@ -1,6 +1,12 @@
 from collections import namedtuple
+import hashlib
+import os
+import re
+import struct
 
-from mutagen.flac import FLAC, Picture as MutagenPicture
+from mutagen.flac import (
+    FLAC, CueSheet as MutagenCueSheet, Picture as MutagenPicture,
+    StreamInfo as MutagenStreamInfo, VCFLACDict)
 
 
 """Tag names for both albums and tracks."""
@@ -24,13 +30,42 @@ _VERSION_NUMBER = 1
 """Tag name of the Flackup tags version number."""
 _VERSION_TAG = 'FLACKUP_VERSION'
 
+"""Tag name pattern of track-level tags, with the number and name."""
+_TRACK_KEY = re.compile(r'TRACK_(\d\d)_(.+)')
+
+"""FLAC metadata block types read by HeaderInfo."""
+BLOCK_STREAMINFO = 0
+BLOCK_PADDING = 1
+BLOCK_VORBIS_COMMENT = 4
+BLOCK_CUESHEET = 5
+BLOCK_PICTURE = 6
+
+"""Flag of the last metadata block, before the first audio frame."""
+_LAST_BLOCK = 0x80
+
+"""PICTURE block fields after the description: width to data length."""
+_PICTURE_FIELDS = struct.Struct('>IIIII')
+
+"""Padding added when the metadata outgrows a file, for later changes."""
+PADDING_RESERVE = 1024 * 1024
+
+"""Largest size of a PADDING block."""
+MAX_PADDING = (1 << 24) - 1
+
+"""Size of the chunks read to compute a Picture digest."""
+_DIGEST_CHUNK = 1 << 20
+
 
 """A subset of FLAC stream information data.
 
+The md5 is the hex MD5 signature of the unencoded audio, or None if unknown.
+An encoder that doesn't compute the signature stores all zeros instead.
+
 See: https://xiph.org/flac/format.html#metadata_block_streaminfo
 """
 StreamInfo = namedtuple(
-    'StreamInfo', 'channels sample_bits sample_rate sample_count')
+    'StreamInfo', 'channels sample_bits sample_rate sample_count md5',
+    defaults=(None,))
 
 
 """A subset of FLAC cue sheet track data.
@@ -75,35 +110,50 @@ class CueSheet(object):
 class Tags(object):
     """Flackup album and track tags.
 
-    This class supports only one string value per tag.
+    This class supports only one string value per tag. The Vorbis comments
+    are indexed once, by album and track number. Changes are kept until
+    they are saved to Mutagen Vorbis comments in one pass.
 
     See: https://www.xiph.org/vorbis/doc/v-comment.html
     """
 
     def __init__(self, mutagen_tags):
-        if mutagen_tags is not None:
-            self._tags = mutagen_tags
-        else:
-            self._tags = {}
+        self._album = {}
+        self._tracks = {}
+        self._changes = {}
+        for key, value in mutagen_tags or ():
+            key = key.upper()
+            match = _TRACK_KEY.match(key)
+            if match:
+                number, name = match.groups()
+                values = self._tracks.setdefault(int(number), {})
+            else:
+                name = key
+                values = self._album
+            values.setdefault(name, value)
+
+    @property
+    def changed(self):
+        """Return True if there are unsaved changes."""
+        return bool(self._changes)
 
     def album_tags(self):
         """Return a dictionary of album-level tags."""
-        return self._collect_tags('', *ALBUM_TAGS)
+        return self._collect_tags(self._album, ALBUM_TAGS)
 
     def track_tags(self, number):
         """Return a dictionary of track-level tags."""
         num = int(number)
         if num < 1 or num > 99:
             raise Exception(f'Invalid track number: {number}')
-        prefix = 'TRACK_{:02d}_'.format(num)
-        return self._collect_tags(prefix, *TRACK_TAGS)
+        return self._collect_tags(self._tracks.get(num, {}), TRACK_TAGS)
 
     def update_album(self, tags):
         """Update album-level tags.
 
         Returns True if anything changed.
         """
-        return self._update_tags(tags, '', *ALBUM_TAGS)
+        return self._update_tags(tags, self._album, '', ALBUM_TAGS)
 
     def update_track(self, number, tags):
         """Update track-level tags.
@@ -114,46 +164,127 @@ class Tags(object):
         if num < 1 or num > 99:
             raise Exception(f'Invalid track number: {number}')
         prefix = 'TRACK_{:02d}_'.format(num)
-        return self._update_tags(tags, prefix, *TRACK_TAGS)
+        values = self._tracks.setdefault(num, {})
+        return self._update_tags(tags, values, prefix, TRACK_TAGS)
+
+    def save(self, mutagen_tags):
+        """Apply the changes to Mutagen Vorbis comments."""
+        if not self._changes:
+            return
+        changes = self._changes
+        mutagen_tags[:] = [
+            (k, v) for k, v in mutagen_tags if k.upper() not in changes
+        ] + [(k, v) for k, v in changes.items() if v is not None]
+        self._changes = {}
 
-    def _collect_tags(self, prefix, *args):
-        result = {}
-        for name in args:
-            key = prefix + name
-            if key in self._tags:
-                result[name] = self._tags[key][0]
-        return result
+    @staticmethod
+    def _collect_tags(values, names):
+        return {name: values[name] for name in names if name in values}
 
-    def _update_tags(self, tags, prefix, *args):
+    def _update_tags(self, tags, values, prefix, names):
         changed = False
-        for name in args:
-            key = prefix + name
-            if name not in tags and key not in self._tags:
+        for name in names:
+            value = tags.get(name)
+            if value == values.get(name):
                 continue
-            elif name in tags and key not in self._tags:
-                self._tags[key] = tags[name]
-                changed = True
-            elif name not in tags and key in self._tags:
-                del self._tags[key]
-                changed = True
-            elif tags[name] != self._tags[key][0]:
-                del self._tags[key]
-                self._tags[key] = tags[name]
-                changed = True
-        if changed and _VERSION_TAG not in self._tags:
-            self._tags[_VERSION_TAG] = str(_VERSION_NUMBER)
+            if value is None:
+                del values[name]
+            else:
+                values[name] = value
+            self._changes[prefix + name] = value
+            changed = True
+        if changed and _VERSION_TAG not in self._album:
+            self._album[_VERSION_TAG] = str(_VERSION_NUMBER)
+            self._changes[_VERSION_TAG] = str(_VERSION_NUMBER)
         return changed
 
 
-"""A subset of FLAC picture data.
+class Picture(object):
+    """A subset of FLAC picture data.
 
-See: https://xiph.org/flac/format.html#metadata_block_picture
-"""
-Picture = namedtuple('Picture', 'type mime width height depth data')
+    A Picture read from a file only stores where its image data is. The data
+    is read when first used, and equality compares a stored SHA-256 digest
+    instead of the data.
+
+    Variables:
+    - type, mime, width, height, depth: The picture metadata.
+    - path, offset: The file and offset of the data, or None.
+    - length: The data length in bytes.
+
+    See: https://xiph.org/flac/format.html#metadata_block_picture
+    """
+
+    def __init__(self, type_, mime, width, height, depth, data=None,
+                 path=None, offset=None, length=None):
+        self.type = type_
+        self.mime = mime
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.path = path
+        self.offset = offset
+        self.length = len(data) if data is not None else length
+        self._data = data
+        self._digest = None
+
+    @property
+    def data(self):
+        """Return the image data, reading it from the file if needed."""
+        self.load()
+        return self._data
+
+    @property
+    def digest(self):
+        """Return the hex SHA-256 digest of the image data."""
+        if self._digest is None:
+            digest = hashlib.sha256()
+            if self._data is not None:
+                digest.update(self._data)
+            else:
+                with open(self.path, 'rb') as f:
+                    f.seek(self.offset)
+                    remaining = self.length
+                    while remaining:
+                        chunk = read_exactly(
+                            f, min(remaining, _DIGEST_CHUNK))
+                        digest.update(chunk)
+                        remaining -= len(chunk)
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def load(self):
+        """Read the image data, so it no longer depends on the file."""
+        if self._data is None:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                self._data = read_exactly(f, self.length)
+
+    def __eq__(self, other):
+        if not isinstance(other, Picture):
+            return NotImplemented
+        return (
+            self._key() == other._key() and
+            self.digest == other.digest
+        )
+
+    def __hash__(self):
+        return hash(self._key() + (self.digest,))
+
+    def __repr__(self):
+        return 'Picture(type={}, mime={!r}, width={}, height={}, ' \
+            'depth={}, length={})'.format(
+                self.type, self.mime, self.width, self.height, self.depth,
+                self.length)
+
+    def _key(self):
+        return (
+            self.type, self.mime, self.width, self.height, self.depth,
+            self.length
+        )
 
 
 class Summary():
-    """A summary for a FileInfo object.
+    """A summary for a FileInfo or HeaderInfo object.
 
    Flags:
    - parse_ok: The file parsed successfully.
@@ -190,6 +321,25 @@ class Summary():
             if fileinfo.pictures():
                 self.pictures = True
 
+    def to_dict(self):
+        """Return the flags as a dictionary."""
+        return {
+            'parse_ok': self.parse_ok,
+            'cuesheet': self.cuesheet,
+            'album_tags': self.album_tags,
+            'track_tags': self.track_tags,
+            'pictures': self.pictures,
+        }
+
+    @classmethod
+    def from_string(cls, text):
+        """Return a Summary from its string representation."""
+        summary = cls.__new__(cls)
+        flags = [c != '-' for c in text]
+        (summary.parse_ok, summary.cuesheet, summary.album_tags,
+         summary.track_tags, summary.pictures) = flags
+        return summary
+
     def __repr__(self):
         def flag_or_dash(status, flag):
             if status:
@@ -206,8 +356,13 @@ class Summary():
         return ''.join(map(flag_or_dash, status, 'OCATP'))
 
 
-class FileInfo(object):
-    """Read and write FLAC metadata.
+class HeaderInfo(object):
+    """Read FLAC metadata from the metadata blocks.
+
+    Only the metadata blocks are read, up to the first audio frame.
+    STREAMINFO, VORBIS_COMMENT and CUESHEET blocks are parsed, PICTURE blocks
+    are recorded as Pictures whose image data is read only when used. This
+    makes reading files with large covers cheap.
 
     Variables:
     - path: The FLAC file.
@@ -217,8 +372,7 @@ class FileInfo(object):
     - streaminfo: The file's StreamInfo.
     - cuesheet: The file's CueSheet.
     - tags: The file's Tags.
-
-    This class supports only one picture per type.
+    - padding: The total size of the file's PADDING blocks.
     """
 
     def __init__(self, path):
@@ -227,25 +381,21 @@ class FileInfo(object):
 
     @property
     def summary(self):
-        """Return a Summary for this FileInfo."""
+        """Return a Summary for this file."""
         return Summary(self)
 
+    @property
+    def track_count(self):
+        """Return the number of audio tracks in the cue sheet, or None."""
+        if self.cuesheet is None:
+            return None
+        return len(self.cuesheet.audio_tracks)
+
     def parse(self):
-        """Read the FLAC file and update the variables."""
+        """Read the FLAC metadata blocks and update the variables."""
         try:
-            self._flac = FLAC(self.path)
-            info = self._flac.info
-            self.streaminfo = StreamInfo(
-                info.channels,
-                info.bits_per_sample,
-                info.sample_rate,
-                info.total_samples
-            )
-            if self._flac.cuesheet is not None:
-                self.cuesheet = CueSheet(self._flac.cuesheet)
-            else:
-                self.cuesheet = None
-            self.tags = Tags(self._flac.tags)
+            with open(self.path, 'rb') as f:
+                self._parse(f)
             self.parse_ok = True
             self.parse_exception = None
         except Exception as e:
@@ -254,27 +404,124 @@ class FileInfo(object):
             self.streaminfo = None
             self.cuesheet = None
             self.tags = None
-
-    def update(self):
-        """Save the current metadata and re-parse the FLAC file."""
-        self._flac.save()
-        self.parse()
+            self.padding = None
+            self._pictures = None
 
     def pictures(self):
         """Return a tuple of Pictures, or None."""
         if self.parse_ok:
-            return tuple(self._picture_m2f(p) for p in self._flac.pictures)
+            return tuple(self._pictures)
         else:
             return None
 
     def get_picture(self, type_):
         """Return the Picture of the given type, or None."""
-        result = None
         if self.parse_ok:
-            matches = [p for p in self._flac.pictures if p.type == type_]
-            if matches:
-                result = self._picture_m2f(matches[0])
-        return result
+            for picture in self._pictures:
+                if picture.type == type_:
+                    return picture
+        return None
+
+    def _parse(self, f):
+        size = os.fstat(f.fileno()).st_size
+        skip_id3(f)
+        if f.read(4) != b'fLaC':
+            raise ValueError('Not a FLAC file.')
+        streaminfo = None
+        cuesheet = None
+        tags = None
+        padding = 0
+        self._pictures = []
+        last = False
+        while not last:
+            header = read_exactly(f, 4)
+            last = header[0] & _LAST_BLOCK
+            type_ = header[0] & ~_LAST_BLOCK
+            length = int.from_bytes(header[1:], 'big')
+            offset = f.tell()
+            if offset + length > size:
+                raise ValueError('Truncated metadata block.')
+            if type_ == BLOCK_STREAMINFO and streaminfo is None:
+                streaminfo = MutagenStreamInfo(read_exactly(f, length))
+            elif type_ == BLOCK_VORBIS_COMMENT and tags is None:
+                tags = VCFLACDict(read_exactly(f, length))
+            elif type_ == BLOCK_CUESHEET and cuesheet is None:
+                cuesheet = MutagenCueSheet(read_exactly(f, length))
+            elif type_ == BLOCK_PICTURE:
+                self._pictures.append(read_picture(f, self.path, length))
+            elif type_ == BLOCK_PADDING:
+                padding += length
+            f.seek(offset + length)
+        if streaminfo is None:
+            raise ValueError('No STREAMINFO block.')
+        self.streaminfo = StreamInfo(
+            streaminfo.channels,
+            streaminfo.bits_per_sample,
+            streaminfo.sample_rate,
+            streaminfo.total_samples,
+            '{:032x}'.format(streaminfo.md5_signature)
+        )
+        self.cuesheet = CueSheet(cuesheet) if cuesheet is not None else None
+        self.tags = Tags(tags)
+        self.padding = padding
+
+
+class FileInfo(HeaderInfo):
+    """Read and write FLAC metadata.
+
+    Reads like HeaderInfo. The file is loaded with Mutagen only to save
+    changes to the tags and pictures.
+
+    This class supports only one picture per type.
+    """
+
+    def parse(self):
+        """Read the FLAC file and update the variables."""
+        super().parse()
+        self._pictures_changed = False
+        self._file_pictures = self._pictures
+
+    def update(self, padding=PADDING_RESERVE, min_padding=0):
+        """Save the current metadata and re-parse the FLAC file.
+
+        If the metadata fits in place of the old metadata and padding,
+        leaving at least min_padding bytes, the audio data is not moved.
+        Otherwise the whole file is rewritten with "padding" bytes (at least
+        min_padding) of padding for later changes.  Padding beyond the
+        largest PADDING block is dropped, which also rewrites the file.
+
+        Returns True if the whole file was rewritten.
+        """
+        rewritten = False
+
+        def padding_size(info):
+            nonlocal rewritten
+            if info.padding >= min_padding:
+                size = min(info.padding, MAX_PADDING)
+                if size != info.padding:
+                    rewritten = True
+                return size
+            rewritten = True
+            return min(max(padding, min_padding), MAX_PADDING)
+
+        flac = FLAC(self.path)
+        if self.tags.changed:
+            if flac.tags is None:
+                flac.add_tags()
+            self.tags.save(flac.tags)
+        if self._pictures_changed:
+            blocks = self._picture_blocks(flac.pictures)
+            flac.clear_pictures()
+            for picture in self._pictures:
+                block = blocks.get(id(picture))
+                if block is None:
+                    block = self._picture_f2m(picture)
+                flac.add_picture(block)
+        flac.save(padding=padding_size)
+        saved = self._pictures
+        self.parse()
+        self._move_pictures(saved)
+        return rewritten
 
     def set_picture(self, picture):
         """Set or replace the Picture of its type.
@@ -285,7 +532,8 @@ class FileInfo(object):
         old = self.get_picture(picture.type)
         if old != picture:
             self.remove_picture(picture.type)
-            self._flac.add_picture(self._picture_f2m(picture))
+            self._pictures.append(picture)
+            self._pictures_changed = True
             changed = True
         return changed
 
@@ -295,26 +543,41 @@ class FileInfo(object):
         Returns True if anything changed.
         """
         changed = False
-        pics = self._flac.pictures
-        keep = [p for p in pics if p.type != type_]
-        if len(pics) != len(keep):
-            self._flac.clear_pictures()
-            for picture in keep:
-                self._flac.add_picture(picture)
+        keep = [p for p in self._pictures if p.type != type_]
+        if len(self._pictures) != len(keep):
+            for picture in self._pictures:
+                if picture.type == type_:
+                    picture.load()
+            self._pictures = keep
+            self._pictures_changed = True
             changed = True
         return changed
 
-    @staticmethod
-    def _picture_m2f(mutagen_picture):
-        """Create a Flackup Picture from a Mutagen Picture."""
-        return Picture(
-            mutagen_picture.type,
-            mutagen_picture.mime,
-            mutagen_picture.width,
-            mutagen_picture.height,
-            mutagen_picture.depth,
-            mutagen_picture.data
-        )
+    def _move_pictures(self, saved):
+        """Point the saved Pictures read from this file to their new data.
+
+        The Pictures handed out before an update stay readable without
+        loading their data beforehand. Removed ones were loaded when removed.
+        """
+        if not self.parse_ok:
+            return
+        for old, new in zip(saved, self._pictures):
+            if old.path == self.path and old._data is None and \
+                    old.type == new.type and old.length == new.length:
+                old.offset = new.offset
+
+    def _picture_blocks(self, mutagen_pictures):
+        """Map the ids of the parsed Pictures to their Mutagen Pictures.
+
+        Pictures that are kept are saved from these, with their description
+        and palette size.
+        """
+        blocks = {}
+        for picture, block in zip(self._file_pictures, mutagen_pictures):
+            if block.type == picture.type and \
+                    len(block.data) == picture.length:
+                blocks[id(picture)] = block
+        return blocks
 
     @staticmethod
     def _picture_f2m(flackup_picture):
@@ -327,3 +590,44 @@ class FileInfo(object):
         picture.depth = flackup_picture.depth
         picture.data = flackup_picture.data
         return picture
+
+
+def skip_id3(f):
+    """Skip an ID3v2 tag at the start of a file, if present."""
+    header = f.read(10)
+    if len(header) == 10 and header.startswith(b'ID3'):
+        size = 0
+        for byte in header[6:10]:
+            size = (size << 7) | (byte & 0x7f)
+        f.seek(10 + size)
+    else:
+        f.seek(0)
+
+
+def read_exactly(f, size):
+    """Read size bytes from a file, raising ValueError if it ends before."""
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError('Unexpected end of file.')
+    return data
+
+
+def read_picture(f, path, length):
+    """Read a PICTURE block of the given length as a Picture.
+
+    The file must be positioned at the start of the block data. The image
+    data is not read.
+    """
+    end = f.tell() + length
+    type_, mime_length = struct.unpack('>II', read_exactly(f, 8))
+    mime = read_exactly(f, mime_length).decode('ascii', 'replace')
+    desc_length, = struct.unpack('>I', read_exactly(f, 4))
+    f.seek(desc_length, os.SEEK_CUR)
+    width, height, depth, _, data_length = _PICTURE_FIELDS.unpack(
+        read_exactly(f, _PICTURE_FIELDS.size))
+    offset = f.tell()
+    if offset + data_length > end:
+        raise ValueError('Invalid PICTURE block.')
+    return Picture(
+        type_, mime, width, height, depth, path=path, offset=offset,
+        length=data_length)
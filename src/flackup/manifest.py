@@ -0,0 +1,403 @@
+from collections import namedtuple
+import fcntl
+import json
+import os
+import os.path
+import threading
+
+import flackup.replaygain as rg
+
+
+"""File name of the manifest in an output directory."""
+MANIFEST_NAME = '.flackup-manifest.jsonl'
+
+"""File name of the journal of unfinished tracks in an output directory."""
+JOURNAL_NAME = '.flackup-journal.jsonl'
+
+"""Manifest format version, stored in every record."""
+MANIFEST_VERSION = 1
+
+"""STREAMINFO MD5 signature of files without one."""
+NO_MD5 = '0' * 32
+
+
+"""Path, size, modification time and STREAMINFO MD5 of a FLAC file."""
+Source = namedtuple('Source', 'path size mtime md5')
+
+
+class Plan(namedtuple('Plan', 'encode resume retag move delete keep')):
+    """Changes that bring the outputs of a FLAC file up to date.
+
+    Variables:
+    - encode: Tracks to be encoded.
+    - resume: Tracks encoded by an interrupted conversion, to be retagged.
+    - retag: Tracks whose Vorbis comments must be rewritten.
+    - move: (old path, Track) tuples of outputs to be renamed and retagged.
+    - delete: Paths of outputs to be deleted.
+    - keep: Tracks that are up to date.
+    """
+
+    @property
+    def changed(self):
+        """Return True if any outputs must be changed."""
+        return bool(
+            self.encode or self.resume or self.retag or self.move or
+            self.delete)
+
+    @property
+    def tracks(self):
+        """Return all Tracks of the album after the changes."""
+        moved = [track for _, track in self.move]
+        return self.encode + self.resume + self.retag + moved + self.keep
+
+
+def source_info(fileinfo):
+    """Return the Source of a parsed FileInfo."""
+    stat = os.stat(fileinfo.path)
+    return Source(
+        os.path.abspath(fileinfo.path),
+        stat.st_size,
+        stat.st_mtime_ns,
+        fileinfo.streaminfo.md5
+    )
+
+
+def encoder_settings(track):
+    """Return the encoder settings of the Track."""
+    fmt = os.path.splitext(track.path)[1].lstrip('.')
+    return {'format': fmt, 'quality': track.quality}
+
+
+class Manifest(object):
+    """Conversion state of an output directory.
+
+    The manifest records the Source, tags, encoder settings and ReplayGain
+    histogram of each generated track, keyed by its path relative to the
+    output directory. Records are appended to a JSON Lines file, the last
+    record of a path wins.
+
+    Encoded tracks are written to a journal right away, before they are
+    renamed into place. Their records move to the manifest once the whole
+    album is finished, so the tracks of an interrupted conversion can be
+    reused by the next one. Journaled tracks are only reused if the output's
+    size and modification time match the journal, in case it was not renamed
+    into place.
+
+    Records are appended under a POSIX lock, so several processes (or hosts
+    sharing the directory) can convert different albums into it. Only one
+    of them may call close, which rewrites the files.
+
+    Variables:
+    - base_dir: The output directory.
+    - entries: Dictionary of relative paths to records.
+    - journaled: Dictionary of relative paths to records of encoded tracks
+      not yet in the manifest.
+
+    Methods are thread-safe, call close when done.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.path = os.path.join(base_dir, MANIFEST_NAME)
+        self.journal_path = os.path.join(base_dir, JOURNAL_NAME)
+        self.entries = {}
+        self.journaled = {}
+        self._pending = []
+        self._records = 0
+        self._journal_records = 0
+        self._position = None
+        self._journal_position = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Read the manifest and journal files, if they exist.
+
+        Only the records appended since the last load are read, unless a
+        file was rewritten, so a long-running process can call it to see
+        the records of other processes.
+        """
+        with self._lock:
+            records, self._position, reset = read_records(
+                self.path, self._position)
+            if reset:
+                self.entries = {}
+                self._records = 0
+            for record in records:
+                self._records += 1
+                if record.get('deleted'):
+                    self.entries.pop(record['path'], None)
+                else:
+                    self.entries[record['path']] = record
+            records, self._journal_position, reset = read_records(
+                self.journal_path, self._journal_position)
+            if reset:
+                self.journaled = {}
+                self._journal_records = 0
+            for record in records:
+                self._journal_records += 1
+                entry = self.entries.get(record['path'])
+                if entry is None or not same_audio(entry, record):
+                    self.journaled[record['path']] = record
+
+    def plan(self, source, tracks):
+        """Return the Plan for the Tracks of a Source, or None.
+
+        Returns None if an output exists that is not recorded for this
+        Source, such outputs are never overwritten.
+        """
+        with self._lock:
+            previous = {
+                path: entry for path, entry in self.entries.items()
+                if entry['source'] == source.path
+            }
+            wanted = {self.relpath(t.path) for t in tracks}
+            stale = [path for path in previous if path not in wanted]
+            encode, resume, retag, move, keep = [], [], [], [], []
+            for track in tracks:
+                path = self.relpath(track.path)
+                entry = previous.get(path)
+                if self._resumable(source, track):
+                    resume.append(track)
+                elif entry is None:
+                    if path in self.entries or os.path.exists(track.path):
+                        return None
+                    old = self._movable(previous, stale, source, track)
+                    if old is not None:
+                        stale.remove(old)
+                        move.append((self.abspath(old), track))
+                    else:
+                        encode.append(track)
+                elif not os.path.exists(track.path):
+                    encode.append(track)
+                elif not reusable(entry, source, track):
+                    encode.append(track)
+                elif entry['tags'] != track.tags:
+                    retag.append(track)
+                else:
+                    keep.append(track)
+            delete = [self.abspath(path) for path in stale]
+        return Plan(encode, resume, retag, move, delete, keep)
+
+    def _movable(self, previous, stale, source, track):
+        """Return a stale path with reusable audio for the Track, or None."""
+        for path in stale:
+            entry = previous[path]
+            if not reusable(entry, source, track):
+                continue
+            if os.path.exists(self.abspath(path)):
+                return path
+        return None
+
+    def _resumable(self, source, track):
+        """Return True if a journaled output can be reused for the Track."""
+        record = self.journaled.get(self.relpath(track.path))
+        if record is None or record['source'] != source.path:
+            return False
+        if not reusable(record, source, track):
+            return False
+        try:
+            stat = os.stat(track.path)
+        except FileNotFoundError:
+            return False
+        output = record.get('output')
+        return output is None or output == [stat.st_size, stat.st_mtime_ns]
+
+    def record(self, source, track, gain=None):
+        """Record a generated Track with its GainAnalysis or GainResult."""
+        entry = self._entry(source, track, gain)
+        with self._lock:
+            self.entries[entry['path']] = entry
+            self.journaled.pop(entry['path'], None)
+            self._pending.append(entry)
+
+    def journal(self, source, track, gain=None, stat=None):
+        """Write an encoded Track to the journal file right away.
+
+        Pass the os.stat result of the encoded output file, so that it is
+        only resumed if it is unchanged.
+        """
+        entry = self._entry(source, track, gain)
+        if stat is not None:
+            entry['output'] = [stat.st_size, stat.st_mtime_ns]
+        with self._lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.journaled[entry['path']] = entry
+            self._journal_records += 1
+
+    def _entry(self, source, track, gain):
+        entry = {
+            'version': MANIFEST_VERSION,
+            'path': self.relpath(track.path),
+            'source': source.path,
+            'size': source.size,
+            'mtime': source.mtime,
+            'md5': source.md5,
+            'number': track.number,
+            'tags': track.tags,
+            'encoder': encoder_settings(track),
+        }
+        if gain is not None:
+            entry['replaygain'] = {
+                'peak': gain.peak,
+                'histogram': rg.sparse_histogram(gain.histogram),
+            }
+        return entry
+
+    def update_tags(self, source, track):
+        """Record the new tags of a retagged Track.
+
+        Nothing is recorded if the Track's audio is outdated or unknown.
+        """
+        with self._lock:
+            entry = self.entries.get(self.relpath(track.path))
+        if entry is None or entry['source'] != source.path:
+            return
+        if not reusable(entry, source, track):
+            return
+        self.record(source, track, self.gain(track.path))
+
+    def remove(self, path):
+        """Remove the record of an output path."""
+        path = self.relpath(path)
+        with self._lock:
+            if self.entries.pop(path, None) is not None:
+                self._pending.append({
+                    'version': MANIFEST_VERSION,
+                    'path': path,
+                    'deleted': True,
+                })
+
+    def gain(self, path):
+        """Return the stored GainResult of an output path, or None.
+
+        Journaled records take precedence over the manifest.
+        """
+        path = self.relpath(path)
+        with self._lock:
+            entry = self.journaled.get(path) or self.entries.get(path)
+        if entry is None or 'replaygain' not in entry:
+            return None
+        replaygain = entry['replaygain']
+        return rg.GainResult(
+            rg.dense_histogram(replaygain['histogram']), replaygain['peak'])
+
+    def save(self):
+        """Append the pending records to the manifest file."""
+        with self._lock:
+            if not self._pending:
+                return
+            with open(self.path, 'a', encoding='utf-8') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                for record in self._pending:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+            self._records += len(self._pending)
+            self._pending = []
+
+    def close(self):
+        """Save the pending records and rewrite the files if needed.
+
+        The journal file is removed once all its tracks are recorded.
+        """
+        self.save()
+        with self._lock:
+            if self._records != len(self.entries):
+                write_records(self.path, self.entries)
+                self._records = len(self.entries)
+            if not self.journaled:
+                if os.path.exists(self.journal_path):
+                    os.remove(self.journal_path)
+            elif self._journal_records != len(self.journaled):
+                write_records(self.journal_path, self.journaled)
+            self._journal_records = len(self.journaled)
+
+    def relpath(self, path):
+        """Return the path relative to the output directory."""
+        return os.path.relpath(path, self.base_dir)
+
+    def abspath(self, path):
+        """Return the full path of a path relative to the output directory."""
+        return os.path.join(self.base_dir, path)
+
+
+def read_records(path, position=None):
+    """Read the records of a JSON Lines file of the current version.
+
+    Reading starts at a position returned by a previous call, unless the
+    file was replaced since. Lines that are still being written are left
+    for the next call.
+
+    Returns the records, the position after them, and True if the file was
+    read from the start.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return [], None, True
+    with f:
+        stat = os.fstat(f.fileno())
+        file_id = (stat.st_dev, stat.st_ino)
+        offset = 0
+        if position is not None and position[0] == file_id and \
+                position[1] <= stat.st_size:
+            offset = position[1]
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    records = []
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get('version') == MANIFEST_VERSION:
+            records.append(record)
+    return records, (file_id, offset + end), offset == 0
+
+
+def write_records(path, records):
+    """Replace a JSON Lines file with a dictionary of records, by path."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        for key in sorted(records):
+            f.write(json.dumps(records[key], sort_keys=True) + '\n')
+    os.replace(temp_path, path)
+
+
+def same_audio(entry, other):
+    """Return True if two records describe the same encoded audio."""
+    keys = ['source', 'size', 'mtime', 'md5', 'number', 'encoder']
+    return all(entry[key] == other[key] for key in keys)
+
+
+def reusable(entry, source, track):
+    """Return True if the recorded audio can be reused for the Track."""
+    if entry['number'] != track.number:
+        return False
+    if entry['encoder'] != encoder_settings(track):
+        return False
+    if source.md5 not in (None, NO_MD5) and entry['md5'] not in (None, NO_MD5):
+        return entry['md5'] == source.md5
+    return entry['size'] == source.size and entry['mtime'] == source.mtime
+
+
+def prune(path, covers=('cover.jpg',)):
+    """Remove an album directory left with at most the cover images.
+
+    The parent (artist) directory is removed too, if it is empty.
+    """
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return
+    if any(name not in covers for name in names):
+        return
+    for name in names:
+        os.remove(os.path.join(path, name))
+    os.rmdir(path)
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
@@ -0,0 +1,158 @@
+from contextlib import contextmanager, nullcontext
+import resource
+import threading
+import time
+
+
+"""Names of the conversion stages, in order."""
+STAGES = ['decode', 'stream', 'encode', 'replaygain', 'cover']
+
+
+class Stage(object):
+    """Counters of a conversion stage.
+
+    Variables:
+    - wall: Elapsed time in seconds.
+    - cpu: CPU time in seconds of this process and its finished children.
+    - read: Number of bytes read.
+    - written: Number of bytes written.
+    - audio: Number of audio seconds processed.
+    """
+
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.read = 0
+        self.written = 0
+        self.audio = 0.0
+
+    @property
+    def rtf(self):
+        """Return the real-time factor (wall time per audio second), or None."""
+        if not self.audio:
+            return None
+        return self.wall / self.audio
+
+    def add(self, other):
+        """Add the counters of another Stage."""
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.read += other.read
+        self.written += other.written
+        self.audio += other.audio
+
+    def to_dict(self):
+        """Return the counters as a dictionary."""
+        rtf = self.rtf
+        return {
+            'wall': round(self.wall, 6),
+            'cpu': round(self.cpu, 6),
+            'read': self.read,
+            'written': self.written,
+            'audio': round(self.audio, 6),
+            'rtf': None if rtf is None else round(rtf, 6),
+        }
+
+
+class Metrics(object):
+    """Per-stage counters of one or more album conversions.
+
+    CPU time is measured for the whole process, so it includes concurrent
+    stages of other albums. Stages can overlap, so the total wall time, CPU
+    time and audio seconds are measured separately, around the whole
+    conversion (see overall).
+
+    Variables:
+    - stages: Dictionary of stage names to Stage.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._overall = Stage()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, audio=0.0):
+        """Measure a stage of the conversion.
+
+        Yields a Stage to add read/written bytes and audio seconds to.
+        """
+        current = Stage()
+        current.audio = audio
+        wall = time.perf_counter()
+        cpu = cpu_time()
+        try:
+            yield current
+        finally:
+            current.wall = time.perf_counter() - wall
+            current.cpu = cpu_time() - cpu
+            self.add_stage(name, current)
+
+    @contextmanager
+    def overall(self, audio=0.0):
+        """Measure the whole conversion of "audio" seconds, for total."""
+        wall = time.perf_counter()
+        cpu = cpu_time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._overall.wall += time.perf_counter() - wall
+                self._overall.cpu += cpu_time() - cpu
+                self._overall.audio += audio
+
+    def add_stage(self, name, stage):
+        """Add the counters of a Stage."""
+        with self._lock:
+            self.stages.setdefault(name, Stage()).add(stage)
+
+    def add(self, other):
+        """Add the counters of other Metrics.
+
+        Only the audio seconds of their overall measure are added, as they
+        may have run concurrently: measure the wall and CPU time of several
+        conversions with overall.
+        """
+        for name, stage in other.stages.items():
+            self.add_stage(name, stage)
+        with self._lock:
+            self._overall.audio += other._overall.audio
+
+    def total(self):
+        """Return a Stage with the overall wall time, CPU time and audio.
+
+        The bytes read and written are the sum of all stages.
+        """
+        total = Stage()
+        total.wall = self._overall.wall
+        total.cpu = self._overall.cpu
+        total.audio = self._overall.audio
+        for stage in self.stages.values():
+            total.read += stage.read
+            total.written += stage.written
+        return total
+
+    def to_dict(self):
+        """Return the stages as a dictionary, in STAGES order."""
+        names = sorted(self.stages, key=STAGES.index)
+        return {name: self.stages[name].to_dict() for name in names}
+
+
+def measure(metrics, name, audio=0.0):
+    """Return a context manager to measure a stage, if metrics is not None."""
+    if metrics is None:
+        return nullcontext(Stage())
+    return metrics.stage(name, audio)
+
+
+def measure_overall(metrics, audio=0.0):
+    """Return a context manager to measure a whole conversion, if needed."""
+    if metrics is None:
+        return nullcontext()
+    return metrics.overall(audio)
+
+
+def cpu_time():
+    """Return the CPU time of this process and its finished children."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
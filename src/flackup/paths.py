@@ -0,0 +1,59 @@
+import os
+import os.path
+
+
+"""Size of the chunks read by read_paths."""
+PATHS_CHUNK = 64 * 1024
+
+
+def find_flac(top, exclude=()):
+    """Return the sorted FLAC files in a directory tree, see walk_flac."""
+    return sorted(walk_flac(top, exclude))
+
+
+def walk_flac(top, exclude=()):
+    """Yield the FLAC files in a directory tree as they are found.
+
+    Each directory's files are yielded in name order, followed by those of
+    its sub-directories. Hidden and excluded directories are skipped, as are
+    symbolic links to directories.
+    """
+    exclude = {os.path.realpath(p) for p in exclude}
+    stack = [top]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                entries = sorted(entries, key=lambda e: e.name)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith('.') and \
+                        os.path.realpath(entry.path) not in exclude:
+                    subdirs.append(entry.path)
+            elif is_flac(entry.name):
+                yield entry.path
+        stack += reversed(subdirs)
+
+
+def is_flac(path):
+    """Return True if the path has a FLAC file name."""
+    name = os.path.basename(path)
+    return name.lower().endswith('.flac') and not name.startswith('.')
+
+
+def read_paths(f, separator=b'\n'):
+    """Yield the non-empty paths in a binary file, as they are read."""
+    rest = b''
+    while True:
+        chunk = f.read(PATHS_CHUNK)
+        if not chunk:
+            break
+        *paths, rest = (rest + chunk).split(separator)
+        for path in paths:
+            if path:
+                yield os.fsdecode(path)
+    if rest:
+        yield os.fsdecode(rest)
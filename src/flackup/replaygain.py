@@ -0,0 +1,241 @@
+from collections import namedtuple
+from functools import lru_cache
+import math
+
+import numpy as np
+
+
+"""Loudness of the pink noise reference, in dB."""
+PINK_REF = 64.82
+
+"""Resolution and range of the loudness histogram."""
+STEPS_PER_DB = 100
+MAX_DB = 120
+
+"""Percentile of the RMS windows used as the loudness value."""
+RMS_PERCENTILE = 0.95
+
+"""Length of the RMS windows, in seconds."""
+RMS_WINDOW = 0.05
+
+"""Number of samples in the filter impulse responses."""
+IMPULSE_LENGTH = 8192
+
+"""Number of samples filtered at once."""
+BLOCK_LENGTH = 1 << 17
+
+"""Equal loudness filter coefficients per sample rate.
+
+Each entry contains the Yule-Walk (b, a) and Butterworth (b, a) coefficients
+of the reference implementation (gain_analysis.c).
+"""
+FILTERS = {
+    44100: (
+        (
+            0.05418656406430, -0.02911007808948, -0.00848709379851,
+            -0.00851165645469, -0.00834990904936, 0.02245293253339,
+            -0.02596338512915, 0.01624864962975, -0.00240879051584,
+            0.00674613682247, -0.00187763777362,
+        ),
+        (
+            1.0, -3.47845948550071, 6.36317777566148,
+            -8.54751527471874, 9.47693607801280, -8.81498681370155,
+            6.85401540936998, -4.39470996079559, 2.19611684890774,
+            -0.75104302451432, 0.13149317958808,
+        ),
+        (0.98500175787242, -1.97000351574484, 0.98500175787242),
+        (1.0, -1.96977855582618, 0.97022847566350),
+    ),
+    48000: (
+        (
+            0.03857599435200, -0.02160367184185, -0.00123395316851,
+            -0.00009291677959, -0.01655260341619, 0.02161526843274,
+            -0.02074045215285, 0.00594298065125, 0.00306428023191,
+            0.00012025322027, 0.00288463683916,
+        ),
+        (
+            1.0, -3.84664617118067, 7.81501653005538,
+            -11.34170355132042, 13.05504219327545, -12.28759895145294,
+            9.48293806319790, -5.87257861775999, 2.75465861874613,
+            -0.86984376593551, 0.13919314567432,
+        ),
+        (0.98621192462708, -1.97242384925416, 0.98621192462708),
+        (1.0, -1.97223372919527, 0.97261396931306),
+    ),
+}
+
+
+def supported(streaminfo):
+    """Return True if samples of this StreamInfo can be analyzed."""
+    return (
+        streaminfo.sample_rate in FILTERS and
+        streaminfo.sample_bits in (8, 16, 24, 32) and
+        streaminfo.channels > 0
+    )
+
+
+class GainAnalysis(object):
+    """ReplayGain 1.0 analysis of a single track.
+
+    Feed the track's little-endian PCM samples in any number of chunks, the
+    same as in a WAV file, then call finish.
+
+    Variables:
+    - histogram: Loudness histogram of the RMS windows.
+    - peak: Highest absolute sample value, 1.0 being full scale.
+
+    See: https://wiki.hydrogenaud.io/index.php?title=ReplayGain_1.0_specification
+    """
+
+    def __init__(self, streaminfo):
+        if not supported(streaminfo):
+            raise ValueError('Unsupported stream: {}'.format(streaminfo))
+        self._channels = streaminfo.channels
+        self._sample_bytes = streaminfo.sample_bits // 8
+        self._scale = 2.0 ** (16 - streaminfo.sample_bits)
+        self._impulse = impulse_response(streaminfo.sample_rate)
+        self._window = math.ceil(streaminfo.sample_rate * RMS_WINDOW)
+        self._pending = b''
+        self._tail = np.zeros((IMPULSE_LENGTH - 1, self._channels))
+        self._energy = np.zeros(0)
+        self._spectra = {}
+        self.histogram = np.zeros(STEPS_PER_DB * MAX_DB, dtype=np.int64)
+        self.peak = 0.0
+
+    def feed(self, data):
+        """Analyze a chunk of PCM samples."""
+        frame_bytes = self._sample_bytes * self._channels
+        block_bytes = BLOCK_LENGTH * frame_bytes
+        data = self._pending + bytes(data)
+        usable = len(data) - len(data) % block_bytes
+        for offset in range(0, usable, block_bytes):
+            self._analyze(data[offset:offset + block_bytes])
+        self._pending = data[usable:]
+
+    def finish(self):
+        """Analyze any remaining samples and return self.
+
+        A partial RMS window at the end of the track is ignored.
+        """
+        frame_bytes = self._sample_bytes * self._channels
+        usable = len(self._pending) - len(self._pending) % frame_bytes
+        if usable:
+            self._analyze(self._pending[:usable])
+        self._pending = b''
+        return self
+
+    @property
+    def gain(self):
+        """Return the track gain in dB, or None without enough samples."""
+        return histogram_gain(self.histogram)
+
+    def _analyze(self, data):
+        samples = decode_samples(data, self._sample_bytes)
+        samples = samples.reshape(-1, self._channels)
+        if len(samples) == 0:
+            return
+        peak = np.abs(samples).max() / float(1 << (8 * self._sample_bytes - 1))
+        self.peak = max(self.peak, float(peak))
+        filtered = self._filter(samples * self._scale)
+        energy = np.mean(filtered * filtered, axis=1)
+        energy = np.concatenate((self._energy, energy))
+        count = len(energy) // self._window
+        windows = energy[:count * self._window].reshape(count, self._window)
+        self._energy = energy[count * self._window:]
+        values = STEPS_PER_DB * 10 * np.log10(windows.mean(axis=1) + 1e-37)
+        values = np.clip(values.astype(np.int64), 0, len(self.histogram) - 1)
+        self.histogram += np.bincount(values, minlength=len(self.histogram))
+
+    def _filter(self, samples):
+        """Apply the equal loudness filter using overlap-add convolution."""
+        length = len(samples)
+        size = 1 << (length + IMPULSE_LENGTH - 2).bit_length()
+        spectrum = self._spectra.get(size)
+        if spectrum is None:
+            spectrum = np.fft.rfft(self._impulse, size)
+            self._spectra[size] = spectrum
+        full = np.fft.irfft(
+            np.fft.rfft(samples, size, axis=0) * spectrum[:, np.newaxis],
+            size,
+            axis=0)
+        full = full[:length + IMPULSE_LENGTH - 1]
+        full[:IMPULSE_LENGTH - 1] += self._tail
+        self._tail = full[length:].copy()
+        return full[:length]
+
+
+class GainResult(namedtuple('GainResult', 'histogram peak')):
+    """The histogram and peak of a finished analysis, e.g. a stored one."""
+
+    @property
+    def gain(self):
+        """Return the track gain in dB, or None without enough samples."""
+        return histogram_gain(self.histogram)
+
+
+def decode_samples(data, sample_bytes):
+    """Return little-endian PCM samples as a signed integer array."""
+    if sample_bytes == 1:
+        return np.frombuffer(data, dtype=np.uint8).astype(np.int64) - 128
+    if sample_bytes == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        samples = (
+            raw[:, 0].astype(np.int32) |
+            (raw[:, 1].astype(np.int32) << 8) |
+            (raw[:, 2].astype(np.int32) << 16)
+        )
+        return np.where(samples & 0x800000, samples - 0x1000000, samples)
+    dtype = {2: '<i2', 4: '<i4'}[sample_bytes]
+    return np.frombuffer(data, dtype=dtype).astype(np.int64)
+
+
+def histogram_gain(histogram):
+    """Return the gain in dB for a loudness histogram, or None if empty."""
+    elems = int(histogram.sum())
+    if elems == 0:
+        return None
+    upper = math.ceil(elems * (1. - RMS_PERCENTILE))
+    counts = np.cumsum(histogram[::-1])
+    index = len(histogram) - 1 - int(np.argmax(counts >= upper))
+    return PINK_REF - index / STEPS_PER_DB
+
+
+def album_gain(analyses):
+    """Return the album gain and peak for a list of GainAnalysis/GainResult."""
+    histogram = sum(a.histogram for a in analyses)
+    peak = max(a.peak for a in analyses)
+    return histogram_gain(histogram), peak
+
+
+def sparse_histogram(histogram):
+    """Return the non-empty bins of a histogram as [index, count] lists."""
+    return [[int(i), int(histogram[i])] for i in np.flatnonzero(histogram)]
+
+
+def dense_histogram(bins):
+    """Return a histogram from a list of [index, count] bins."""
+    histogram = np.zeros(STEPS_PER_DB * MAX_DB, dtype=np.int64)
+    for index, count in bins:
+        histogram[index] = count
+    return histogram
+
+
+@lru_cache()
+def impulse_response(sample_rate):
+    """Return the impulse response of the equal loudness filter."""
+    yule_b, yule_a, butter_b, butter_a = FILTERS[sample_rate]
+    impulse = [0.0] * IMPULSE_LENGTH
+    impulse[0] = 1.0
+    response = lfilter(yule_b, yule_a, impulse)
+    response = lfilter(butter_b, butter_a, response)
+    return np.array(response)
+
+
+def lfilter(b, a, x):
+    """Apply an IIR filter to a sequence, sample by sample."""
+    y = []
+    for n in range(len(x)):
+        value = sum(b[k] * x[n - k] for k in range(min(len(b), n + 1)))
+        value -= sum(a[k] * y[n - k] for k in range(1, min(len(a), n + 1)))
+        y.append(value)
+    return y
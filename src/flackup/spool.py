@@ -0,0 +1,291 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import os.path
+import socket
+import threading
+import time
+
+
+"""Spool format version, stored in every job."""
+SPOOL_VERSION = 1
+
+"""Sub-directories of a spool, one per job state."""
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+STATES = [PENDING, CLAIMED, DONE, FAILED]
+
+"""Seconds between updates of the lock file of a claimed job."""
+HEARTBEAT_INTERVAL = 30.0
+
+"""Seconds without heartbeat after which a claim is considered stale."""
+STALE_AFTER = 300.0
+
+
+"""A claimed job: file name, job dictionary, lock file path and contents."""
+Claim = namedtuple('Claim', 'name job lock owner')
+
+
+class Spool(object):
+    """A directory of album conversion jobs shared by several workers.
+
+    Jobs are JSON files that move between the "pending", "claimed", "done"
+    and "failed" sub-directories by atomic renames, so the spool can be on
+    shared storage (e.g. NFS) without any other service. A worker claims a
+    job by creating its lock file exclusively, then renaming it from
+    "pending" to "claimed". While the job runs, the lock file's modification
+    time is updated as a heartbeat. Claims of workers that stopped updating
+    it, or whose process is gone on this host, are moved back to "pending"
+    by recover. A worker whose claim was recovered lost the job: its
+    heartbeat reports it, and finish leaves the job to the new claim.
+
+    Variables:
+    - path: The spool directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for state in STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def enqueue(self, job, queued=None):
+        """Add a job dictionary with a "path" key, unless already queued.
+
+        When adding many jobs, pass the set returned by queued_keys as
+        queued, so that the spool is listed only once. The new job's key is
+        added to it.
+
+        Returns the job's file name, or None if it is pending or claimed.
+        """
+        if queued is None:
+            queued = self.queued_keys()
+        key = job_key(job['path'])
+        if key in queued:
+            return None
+        job = dict(job, version=SPOOL_VERSION, enqueued=time.time())
+        name = '{:020d}-{}.json'.format(time.time_ns(), key)
+        write_json(self.state_path(PENDING, name), job)
+        queued.add(key)
+        return name
+
+    def queued_keys(self):
+        """Return the set of job keys that are pending or claimed."""
+        return {
+            job_key_of(name)
+            for state in [PENDING, CLAIMED] for name in self.names(state)
+        }
+
+    def claim(self, worker):
+        """Claim the oldest pending job for the worker, or return None."""
+        for name in self.names(PENDING):
+            lock = self.lock_path(name)
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            owner = {'worker': worker, 'claimed': time.time()}
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(owner, f)
+            try:
+                os.rename(
+                    self.state_path(PENDING, name),
+                    self.state_path(CLAIMED, name))
+            except FileNotFoundError:
+                remove(lock)
+                continue
+            job = read_json(self.state_path(CLAIMED, name))
+            if job is None:
+                self.finish(
+                    Claim(name, {}, lock, owner), {'error': 'Invalid job.'})
+                continue
+            return Claim(name, job, lock, owner)
+        return None
+
+    def owns(self, claim):
+        """Return True unless the Claim was recovered by another worker.
+
+        The lock file is missing for a moment while recover checks it, so
+        the claim is only lost if it has another owner or the job left
+        "claimed".
+        """
+        owner = read_json(claim.lock)
+        if owner is not None:
+            return owner == claim.owner
+        return os.path.exists(self.state_path(CLAIMED, claim.name))
+
+    @contextmanager
+    def heartbeat(self, claim, interval=HEARTBEAT_INTERVAL):
+        """Update the Claim's lock file every "interval" seconds.
+
+        Yields a threading.Event that is set, and the updates stop, once the
+        claim was recovered by another worker.
+        """
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                if not self.owns(claim):
+                    lost.set()
+                    return
+                try:
+                    os.utime(claim.lock)
+                except FileNotFoundError:
+                    pass
+
+        thread = threading.Thread(
+            target=beat, name='flackup-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            thread.join()
+
+    def finish(self, claim, result, ok=False):
+        """Store the job with its result dictionary in "done" or "failed".
+
+        Returns False, without changing the spool, if the claim was lost.
+        """
+        if not self.owns(claim):
+            return False
+        job = dict(claim.job, result=result, finished=time.time())
+        state = DONE if ok else FAILED
+        write_json(self.state_path(state, claim.name), job)
+        remove(self.state_path(CLAIMED, claim.name))
+        remove(claim.lock)
+        return True
+
+    def recover(self, stale=STALE_AFTER):
+        """Move stale claims back to "pending" and return their names.
+
+        The lock file is renamed before the job is moved, so only one worker
+        recovers each claim.
+        """
+        recovered = []
+        now = time.time()
+        hostname = socket.gethostname()
+        for lock_name in self.names(CLAIMED, '.lock'):
+            lock = os.path.join(self.path, CLAIMED, lock_name)
+            if not self._stale(lock, now, stale, hostname):
+                continue
+            tombstone = '{}.{}.stale'.format(lock, os.getpid())
+            try:
+                os.rename(lock, tombstone)
+            except FileNotFoundError:
+                continue
+            if not self._stale(tombstone, now, stale, hostname):
+                os.rename(tombstone, lock)
+                continue
+            name = lock_name[:-len('.lock')] + '.json'
+            try:
+                os.rename(
+                    self.state_path(CLAIMED, name),
+                    self.state_path(PENDING, name))
+                recovered.append(name)
+            except FileNotFoundError:
+                pass
+            remove(tombstone)
+        return recovered
+
+    @staticmethod
+    def _stale(lock, now, stale, hostname):
+        """Return True if the lock file's worker is gone or silent."""
+        try:
+            mtime = os.stat(lock).st_mtime
+        except FileNotFoundError:
+            return False
+        if now - mtime > stale:
+            return True
+        owner = read_json(lock) or {}
+        host, _, pid = owner.get('worker', '').rpartition(':')
+        if host != hostname or not pid.isdigit():
+            return False
+        return not pid_alive(int(pid))
+
+    def status(self):
+        """Return a dictionary of job states to lists of job dictionaries."""
+        jobs = {}
+        for state in STATES:
+            jobs[state] = []
+            for name in self.names(state):
+                job = read_json(self.state_path(state, name))
+                if job is None:
+                    continue
+                if state == CLAIMED:
+                    lock = read_json(self.lock_path(name)) or {}
+                    job['worker'] = lock.get('worker')
+                jobs[state].append(job)
+        return jobs
+
+    def names(self, state, suffix='.json'):
+        """Return the sorted file names in a state directory."""
+        try:
+            names = os.listdir(os.path.join(self.path, state))
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if n.endswith(suffix))
+
+    def state_path(self, state, name):
+        """Return the path of a job file in a state directory."""
+        return os.path.join(self.path, state, name)
+
+    def lock_path(self, name):
+        """Return the path of a job's lock file."""
+        return self.state_path(CLAIMED, name[:-len('.json')] + '.lock')
+
+
+def worker_id():
+    """Return the identifier of this worker process, "HOST:PID"."""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def job_key(path):
+    """Return the key of a FLAC file path in job file names."""
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def job_key_of(name):
+    """Return the key of a job file name."""
+    return name[:-len('.json')].rpartition('-')[2]
+
+
+def pid_alive(pid):
+    """Return True if a process with the PID exists on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_json(path):
+    """Return the JSON contents of a file, or None."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    """Write a JSON file atomically."""
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def remove(path):
+    """Remove a file, if it exists."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,268 @@
+from collections import namedtuple
+import ctypes
+import ctypes.util
+import os
+import os.path
+import select
+import struct
+import time
+
+from flackup.paths import is_flac
+
+
+"""Seconds a closed FLAC file must stay unchanged before it is reported."""
+SETTLE_TIME = 5.0
+
+"""Size of the buffer for reading inotify events."""
+EVENT_BUFFER = 64 * 1024
+
+"""inotify event header: watch descriptor, mask, cookie and name length."""
+EVENT_STRUCT = struct.Struct('iIII')
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+"""Events watched in each directory."""
+WATCH_MASK = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE
+)
+
+
+"""An inotify event for a path, with the event mask."""
+Event = namedtuple('Event', 'path mask')
+
+
+class Inotify(object):
+    """A Linux inotify instance, using libc through ctypes.
+
+    Raises OSError if inotify is not available.
+    """
+
+    def __init__(self):
+        self._libc = load_libc()
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise errno_error()
+        self._paths = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Watch a directory for the events in mask."""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise errno_error(path)
+        self._paths[wd] = path
+
+    def read(self, timeout=None):
+        """Return the Events available within timeout seconds.
+
+        Events of the IN_Q_OVERFLOW type have a path of None. All queued
+        events are read, so none of the returned ones are older than the
+        call.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, EVENT_BUFFER)
+            except BlockingIOError:
+                return events
+            events += self._parse(data)
+
+    def _parse(self, data):
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_STRUCT.unpack_from(data, offset)
+            offset += EVENT_STRUCT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            if mask & IN_Q_OVERFLOW:
+                events.append(Event(None, mask))
+                continue
+            base = self._paths.get(wd)
+            if base is None:
+                continue
+            path = os.path.join(base, os.fsdecode(name)) if name else base
+            events.append(Event(path, mask))
+        return events
+
+    def close(self):
+        """Close the inotify instance."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class Watcher(object):
+    """Report FLAC files in a directory tree once they are complete.
+
+    A file is complete when it was closed after writing or moved in, and its
+    size and modification time stayed the same for "settle" seconds. The
+    tree is walked once at the start to watch its directories, new ones are
+    watched (and their FLAC files tracked) as they appear. Directories in
+    exclude are not watched.
+
+    Variables:
+    - overflows: Number of times the kernel dropped events.
+    """
+
+    def __init__(self, path, settle=SETTLE_TIME, exclude=()):
+        self.settle = settle
+        self.overflows = 0
+        self._exclude = {os.path.realpath(p) for p in exclude}
+        self._inotify = Inotify()
+        self._pending = {}
+        self._busy = set()
+        self._done = {}
+        self._watch_tree(path, track=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds and return the newly complete files.
+
+        Returned files are ignored until they are passed to done.
+        """
+        if self._pending:
+            deadline = min(d for _, d in self._pending.values())
+            wait = max(deadline - time.monotonic(), 0)
+            timeout = wait if timeout is None else min(timeout, wait)
+        for event in self._inotify.read(timeout):
+            self._handle(event)
+        ready = self._settled()
+        self._done = {
+            path: current for path, current in self._done.items()
+            if path in self._pending
+        }
+        return ready
+
+    def done(self, path):
+        """Mark a file as processed.
+
+        It is reported again only after it changed, so that the changes made
+        while processing it are ignored. The file is forgotten once the
+        events of these changes are handled.
+        """
+        self._busy.discard(path)
+        current = signature(path)
+        if current is None:
+            self._done.pop(path, None)
+        else:
+            self._done[path] = current
+
+    def close(self):
+        """Stop watching."""
+        self._inotify.close()
+
+    def _handle(self, event):
+        mask = event.mask
+        if mask & IN_Q_OVERFLOW:
+            self.overflows += 1
+            return
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and self._watched(event.path):
+                self._watch_tree(event.path, track=True)
+            return
+        path = event.path
+        if not is_flac(path) or path in self._busy:
+            return
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._track(path)
+        elif mask & IN_MODIFY and path in self._pending:
+            self._track(path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self._pending.pop(path, None)
+
+    def _track(self, path):
+        current = signature(path)
+        if current is None:
+            self._pending.pop(path, None)
+        else:
+            self._pending[path] = (current, time.monotonic() + self.settle)
+
+    def _settled(self):
+        now = time.monotonic()
+        ready = []
+        for path, (previous, deadline) in list(self._pending.items()):
+            if deadline > now:
+                continue
+            current = signature(path)
+            if current != previous:
+                self._track(path)
+                continue
+            del self._pending[path]
+            if self._done.pop(path, None) == current:
+                continue
+            self._busy.add(path)
+            ready.append(path)
+        return sorted(ready)
+
+    def _watch_tree(self, top, track):
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = sorted(
+                d for d in dirnames
+                if self._watched(os.path.join(dirpath, d)))
+            try:
+                self._inotify.add_watch(dirpath)
+            except FileNotFoundError:
+                continue
+            if track:
+                for name in filenames:
+                    if is_flac(name):
+                        self._track(os.path.join(dirpath, name))
+
+    def _watched(self, path):
+        name = os.path.basename(path)
+        if name.startswith('.'):
+            return False
+        return os.path.realpath(path) not in self._exclude
+
+
+def signature(path):
+    """Return the (size, mtime) of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def load_libc():
+    """Return the C library, if it has inotify functions."""
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError('inotify is not available.')
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def errno_error(path=None):
+    """Return an OSError for the current C errno."""
+    number = ctypes.get_errno()
+    return OSError(number, os.strerror(number), path)
@@ -0,0 +1,101 @@
+import os
+import shutil
+import sqlite3
+
+import flackup.catalog as ca
+from flackup.fileinfo import FileInfo
+
+
+class TestCatalog(object):
+    """Test the Catalog class."""
+
+    def test_refresh(self, datadir, tmp_path):
+        """Test that files are parsed only when new or changed."""
+        path = copy_flac(datadir, tmp_path)
+        with ca.Catalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+            entry, state = catalog.refresh(path)
+            assert state == ca.ADDED
+            assert repr(entry.summary) == 'OCATP'
+            _, state = catalog.refresh(path)
+            assert state == ca.UNCHANGED
+            os.utime(path, ns=(0, 0))
+            _, state = catalog.refresh(path)
+            assert state == ca.UPDATED
+
+    def test_load(self, datadir, tmp_path):
+        """Test that changed files are returned as parsed."""
+        path = copy_flac(datadir, tmp_path)
+        with ca.Catalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+            info = catalog.load(path, FileInfo)
+            assert isinstance(info, FileInfo)
+            entry = catalog.load(path, FileInfo)
+            assert isinstance(entry, ca.Entry)
+            assert entry.tags.album_tags() == info.tags.album_tags()
+
+    def test_entry(self, datadir, tmp_path):
+        """Test that stored Entries read like the file."""
+        path = copy_flac(datadir, tmp_path)
+        db_path = str(tmp_path / 'catalog.sqlite')
+        with ca.Catalog(db_path) as catalog:
+            catalog.refresh(path)
+        with ca.Catalog(db_path) as catalog:
+            entry, state = catalog.refresh(path)
+        info = FileInfo(path)
+        assert state == ca.UNCHANGED
+        assert entry.path == path
+        assert entry.parse_ok is True
+        assert entry.streaminfo == info.streaminfo
+        assert entry.tags.album_tags() == info.tags.album_tags()
+        for number in [1, 2, 3]:
+            assert entry.tags.track_tags(number) == \
+                info.tags.track_tags(number)
+        front = entry.get_picture(3)
+        assert (front.mime, front.width, front.height) == ('image/png', 128, 128)
+        assert entry.get_picture(4) is None
+        assert entry.discid is not None
+        assert entry.toc.startswith('1 3 ')
+
+    def test_invalid(self, datadir, tmp_path):
+        """Test the Entry of an invalid file."""
+        path = str(tmp_path / 'invalid.flac')
+        shutil.copy(str(datadir / 'invalid.flac'), path)
+        db_path = str(tmp_path / 'catalog.sqlite')
+        with ca.Catalog(db_path) as catalog:
+            catalog.refresh(path)
+        with ca.Catalog(db_path) as catalog:
+            entry, state = catalog.refresh(path)
+        assert state == ca.UNCHANGED
+        assert entry.parse_ok is False
+        assert str(entry.parse_exception) == 'Not a FLAC file.'
+        assert entry.tags is None
+        assert entry.pictures() is None
+
+    def test_prune(self, datadir, tmp_path):
+        """Test that entries of missing files are removed."""
+        path = copy_flac(datadir, tmp_path)
+        with ca.Catalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+            catalog.refresh(path)
+            assert catalog.prune(str(tmp_path)) == []
+            os.remove(path)
+            assert catalog.prune(str(tmp_path / 'other')) == []
+            assert catalog.prune(str(tmp_path)) == [path]
+            assert catalog.paths() == []
+
+    def test_version(self, datadir, tmp_path):
+        """Test that catalogs of other versions are recreated."""
+        path = copy_flac(datadir, tmp_path)
+        db_path = str(tmp_path / 'catalog.sqlite')
+        with ca.Catalog(db_path) as catalog:
+            catalog.refresh(path)
+        db = sqlite3.connect(db_path)
+        db.execute('PRAGMA user_version=0')
+        db.close()
+        with ca.Catalog(db_path) as catalog:
+            assert catalog.paths() == []
+
+
+def copy_flac(datadir, tmp_path):
+    """Copy the tagged test file and return its path."""
+    path = str(tmp_path / 'tagged.flac')
+    shutil.copy(str(datadir / 'tagged.flac'), path)
+    return path
@@ -1,8 +1,112 @@
+import json
+import time
+
 from click.testing import CliRunner
+from mutagen.flac import FLAC
+from mutagen.oggvorbis import OggVorbis
+import pytest
 
 from flackup import NAME, VERSION
+from flackup.catalog import Catalog
 from flackup.cli import flackup
-from flackup.fileinfo import FileInfo
+import flackup.convert as fc
+from flackup.fileinfo import FileInfo, HeaderInfo
+from flackup.musicbrainz import MusicBrainz
+
+
+class TestAnalyze(object):
+    """Test the analyze command."""
+
+    def test_jobs(self, datadir, tmp_path):
+        """Test that --jobs keeps the order of the files."""
+        paths = copy_files(datadir / 'tagged.flac', tmp_path, 20)
+        runner = CliRunner()
+        result = runner.invoke(flackup, ['analyze', '-j', '4'] + paths)
+        assert result.exit_code == 0
+        assert result.output.splitlines() == [
+            'OCATP {}'.format(p) for p in paths]
+
+    def test_unordered(self, datadir, tmp_path):
+        """Test that --unordered shows every file once."""
+        paths = copy_files(datadir / 'tagged.flac', tmp_path, 20)
+        runner = CliRunner()
+        args = ['analyze', '-j', '4', '--unordered'] + paths
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert sorted(result.output.splitlines()) == sorted(
+            'OCATP {}'.format(p) for p in paths)
+
+    def test_recursive(self, datadir, tmp_path):
+        """Test the --recursive option."""
+        library = tmp_path / 'library'
+        (library / 'b').mkdir(parents=True)
+        paths = copy_files(datadir / 'tagged.flac', library / 'b', 2)
+        runner = CliRunner()
+        result = runner.invoke(flackup, ['analyze', '-r', str(library)])
+        assert result.exit_code == 0
+        assert result.output.splitlines() == [
+            'OCATP {}'.format(p) for p in paths]
+
+    def test_from_file(self, datadir, tmp_path, monkeypatch):
+        """Test the --from-file and --null options."""
+        monkeypatch.setattr('flackup.paths.PATHS_CHUNK', 7)
+        paths = copy_files(datadir / 'tagged.flac', tmp_path, 3)
+        runner = CliRunner()
+        args = ['analyze', '--from-file', '-']
+        result = runner.invoke(flackup, args, input='\n'.join(paths) + '\n')
+        assert result.exit_code == 0
+        assert result.output.splitlines() == [
+            'OCATP {}'.format(p) for p in paths]
+        result = runner.invoke(flackup, args + ['-0'], input='\0'.join(paths))
+        assert result.output.splitlines() == [
+            'OCATP {}'.format(p) for p in paths]
+
+    def test_ndjson(self, datadir, tmp_path):
+        """Test --format ndjson, with and without a catalog."""
+        path = str(datadir / 'tagged.flac')
+        catalog = str(tmp_path / 'catalog.sqlite')
+        runner = CliRunner()
+        args = ['analyze', '--format', 'ndjson', '--catalog', catalog, path]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        record = json.loads(result.output)
+        assert record['path'] == path
+        assert record['flags'] == 'OCATP'
+        assert record['summary']['pictures'] is True
+        assert record['error'] is None
+        assert record['tags']['ALBUM'] == 'Test Album'
+        assert record['release_mbid'] is None
+        assert record['cover'] == {
+            'type': 'png', 'mime': 'image/png', 'width': 128, 'height': 128}
+        assert record['tracks'] == 3
+        assert record['duration'] == 3.0
+        result = runner.invoke(flackup, args)
+        assert json.loads(result.output) == record
+
+    def test_ndjson_invalid(self, datadir, tmp_path):
+        """Test --format ndjson with a file that is not FLAC."""
+        path = tmp_path / 'invalid.flac'
+        path.write_text('Not FLAC')
+        runner = CliRunner()
+        args = ['analyze', '--format', 'ndjson', str(path)]
+        record = json.loads(runner.invoke(flackup, args).output)
+        assert record['flags'] == '-----'
+        assert record['error'] == 'Not a FLAC file.'
+        assert record['tracks'] is None
+
+    def test_hidden(self, datadir, tmp_path):
+        """Test --hidden with --jobs and a catalog."""
+        paths = copy_files(datadir / 'tagged.flac', tmp_path, 4)
+        catalog = str(tmp_path / 'catalog.sqlite')
+        runner = CliRunner()
+        runner.invoke(flackup, ['tag', '--hide', paths[1]])
+        args = ['analyze', '-j', '2', '--hidden', '--catalog', catalog]
+        result = runner.invoke(flackup, args + paths)
+        assert result.output == 'OCATP {}\n'.format(paths[1])
+        with Catalog(catalog) as entries:
+            assert entries.paths() == paths
+        result = runner.invoke(flackup, args + paths)
+        assert result.output == 'OCATP {}\n'.format(paths[1])
 
 
 class TestTag(object):
@@ -48,6 +152,417 @@ class TestTag(object):
         assert info.tags.track_tags(3).get('HIDE') is None
 
 
+class TestIndex(object):
+    """Test the index command and the --catalog option."""
+
+    def test_index(self, datadir, tmp_path):
+        """Test indexing a directory twice."""
+        catalog = str(tmp_path / 'catalog.sqlite')
+        runner = CliRunner()
+        args = ['index', '--catalog', catalog, str(datadir)]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert result.output == '1 files, 1 added, 0 updated, 0 removed\n'
+        (datadir / 'tagged.flac').unlink()
+        result = runner.invoke(flackup, args)
+        assert result.output == '0 files, 0 added, 0 updated, 1 removed\n'
+
+    def test_analyze(self, datadir, tmp_path, monkeypatch):
+        """Test that analyze reads unchanged files from the catalog."""
+        path = str(datadir / 'tagged.flac')
+        catalog = str(tmp_path / 'catalog.sqlite')
+        runner = CliRunner()
+        runner.invoke(flackup, ['index', '--catalog', catalog, path])
+
+        def fail(path):
+            raise AssertionError('File was read.')
+
+        monkeypatch.setattr('flackup.catalog.HeaderInfo', fail)
+        monkeypatch.setenv('FLACKUP_CATALOG', catalog)
+        result = runner.invoke(flackup, ['analyze', '-v', path])
+        assert result.exit_code == 0
+        assert result.output == \
+            'OCATP |  128 x  128 PNG | {}\n'.format(path)
+
+    def test_tag(self, datadir, tmp_path):
+        """Test that tag updates the catalog."""
+        path = str(datadir / 'tagged.flac')
+        catalog = str(tmp_path / 'catalog.sqlite')
+        runner = CliRunner()
+        args = ['--catalog', catalog, path]
+        result = runner.invoke(flackup, ['tag', '--hide'] + args)
+        assert result.exit_code == 0
+        result = runner.invoke(flackup, ['analyze', '--hidden'] + args)
+        assert result.output == 'OCATP {}\n'.format(path)
+        result = runner.invoke(flackup, ['tag'] + args)
+        assert result.output == ''
+
+    def test_tag_parsed_once(self, datadir, tmp_path, monkeypatch):
+        """Test that tag reads changed files only once with a catalog."""
+        path = str(datadir / 'tagged.flac')
+        catalog = str(tmp_path / 'catalog.sqlite')
+        parse = HeaderInfo.parse
+        parsed = []
+
+        def count_parse(self):
+            parsed.append(self.path)
+            parse(self)
+
+        monkeypatch.setattr(HeaderInfo, 'parse', count_parse)
+        runner = CliRunner()
+        args = ['tag', '--hide', '--catalog', catalog, path]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert len(parsed) == 2
+
+
+class TestConvert(object):
+    """Test the convert command."""
+
+    def test_albums(self, datadir, tmp_path):
+        """Test the --albums option."""
+        path = datadir / 'tagged.flac'
+        runner = CliRunner()
+        args = ['convert', '-d', str(tmp_path), '-a', 2, str(path), str(path)]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert result.output.count(str(path)) == 1
+        files = list((tmp_path / 'Test Artist' / 'Test Album').iterdir())
+        assert len(files) == 3
+
+    def test_album_error(self, datadir, tmp_path, monkeypatch):
+        """Test that unexpected errors are shown per album."""
+        def export_covers(*args):
+            raise OSError('No space left')
+
+        path = datadir / 'tagged.flac'
+        monkeypatch.setattr('flackup.convert.export_covers', export_covers)
+        runner = CliRunner()
+        args = ['convert', '-d', str(tmp_path), str(path)]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 1
+        assert 'ERROR No space left' in result.output
+
+    def test_interrupted(self, datadir, tmp_path, monkeypatch):
+        """Test that an interruption cancels the queued albums."""
+        def convert_album(path, *args):
+            calls.append(path)
+            if len(calls) == 1:
+                raise KeyboardInterrupt()
+            time.sleep(0.5)
+            return [], True
+
+        calls = []
+        paths = []
+        for album in ['One', 'Two', 'Three']:
+            path = tmp_path / '{}.flac'.format(album)
+            path.write_bytes((datadir / 'tagged.flac').read_bytes())
+            flac = FLAC(str(path))
+            flac['ALBUM'] = album
+            flac.save()
+            paths.append(str(path))
+        monkeypatch.setattr('flackup.cli.convert_album', convert_album)
+        out = tmp_path / 'out'
+        out.mkdir()
+        runner = CliRunner()
+        args = ['convert', '-d', str(out), '-a', 1] + paths
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 1
+        assert len(calls) < len(paths)
+
+    def test_incremental(self, datadir, tmp_path):
+        """Test that only changed tracks are converted again."""
+        path = datadir / 'tagged.flac'
+        album = tmp_path / 'Test Artist' / 'Test Album'
+        runner = CliRunner()
+        args = ['convert', '-d', str(tmp_path), str(path)]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert result.output == ''
+        runner.invoke(flackup, ['tag', '-T', 3, str(path)])
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert '- Encoding tracks' in result.output
+        assert len(list(album.glob('*.ogg'))) == 3
+        runner.invoke(flackup, ['tag', '-t', 1, str(path)])
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert '- Deleting tracks' in result.output
+        assert '- Encoding tracks' not in result.output
+        names = sorted(p.name for p in album.glob('*.ogg'))
+        assert names == ['02 Track 2.ogg', '03 Track 3.ogg']
+
+    def test_resume(self, datadir, tmp_path):
+        """Test that an interrupted conversion resumes unfinished tracks."""
+        path = datadir / 'tagged.flac'
+        album = tmp_path / 'Test Artist' / 'Test Album'
+        runner = CliRunner()
+        args = ['convert', '-d', str(tmp_path), str(path)]
+        runner.invoke(flackup, args)
+        manifest = tmp_path / '.flackup-manifest.jsonl'
+        journal = tmp_path / '.flackup-journal.jsonl'
+        manifest.rename(journal)
+        host = fc.partial_owner().rpartition('-')[0]
+        (album / '02 Track 2.ogg').rename(
+            album / '.02 Track 2.ogg.{}-{}.part'.format(host, 2 ** 22 + 1))
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert '- Resuming tracks' in result.output
+        assert '- Encoding tracks' in result.output
+        assert sorted(p.name for p in album.iterdir()) == [
+            '01 Track 1.ogg', '02 Track 2.ogg', 'cover.jpg']
+        assert not journal.exists()
+        assert len(manifest.read_text().splitlines()) == 2
+        ogg = OggVorbis(album / '01 Track 1.ogg')
+        assert 'REPLAYGAIN_ALBUM_GAIN' in ogg
+        result = runner.invoke(flackup, args)
+        assert result.output == ''
+
+    def test_temp_budget(self, datadir, tmp_path):
+        """Test the --temp-dir and --temp-budget options."""
+        path = datadir / 'tagged.flac'
+        temp = tmp_path / 'temp'
+        out = tmp_path / 'out'
+        temp.mkdir()
+        out.mkdir()
+        runner = CliRunner()
+        args = [
+            'convert', '-d', str(out), '--temp-dir', str(temp),
+            '--temp-budget', '1K', '-j', '2', str(path),
+        ]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert len(list((out / 'Test Artist' / 'Test Album').iterdir())) == 3
+        assert list(temp.iterdir()) == []
+
+    def test_temp_budget_invalid(self, datadir, tmp_path):
+        """Test the --temp-budget option with an invalid size."""
+        path = datadir / 'tagged.flac'
+        runner = CliRunner()
+        args = [
+            'convert', '-d', str(tmp_path), '--temp-budget', '1X', str(path),
+        ]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 2
+        assert 'Invalid size' in result.output
+
+    def test_retag(self, datadir, tmp_path):
+        """Test the --retag option."""
+        path = datadir / 'tagged.flac'
+        album = tmp_path / 'Test Artist' / 'Test Album'
+        runner = CliRunner()
+        args = ['convert', '-d', str(tmp_path), str(path)]
+        runner.invoke(flackup, args)
+        info = FileInfo(path)
+        tags = info.tags.album_tags()
+        tags['GENRE'] = 'Changed'
+        info.tags.update_album(tags)
+        info.update()
+        result = runner.invoke(flackup, args + ['--retag'])
+        assert result.exit_code == 0
+        assert '- Retagging tracks' in result.output
+        for track in album.glob('*.ogg'):
+            assert OggVorbis(track)['GENRE'] == ['Changed']
+        result = runner.invoke(flackup, args + ['--retag'])
+        assert result.output == ''
+        result = runner.invoke(flackup, args)
+        assert result.output == ''
+
+    def test_metrics(self, datadir, tmp_path):
+        """Test the --metrics option."""
+        path = datadir / 'tagged.flac'
+        metrics_path = tmp_path / 'metrics.jsonl'
+        out = tmp_path / 'out'
+        out.mkdir()
+        runner = CliRunner()
+        args = [
+            'convert', '-d', str(out), '--metrics', str(metrics_path),
+            str(path),
+        ]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        lines = metrics_path.read_text().splitlines()
+        album, summary = [json.loads(line) for line in lines]
+        assert album['type'] == 'album'
+        assert album['path'] == str(path)
+        assert album['ok'] is True
+        assert list(album['stages']) == [
+            'decode', 'encode', 'replaygain', 'cover']
+        assert album['stages']['encode']['rtf'] is not None
+        assert summary['type'] == 'summary'
+        assert summary['albums'] == 1
+        assert album['total']['audio'] == pytest.approx(2.0)
+        assert album['total']['wall'] >= album['stages']['encode']['wall']
+        assert summary['total']['audio'] == pytest.approx(2.0)
+        assert summary['total']['wall'] >= album['total']['wall']
+
+    def test_covers(self, datadir, tmp_path):
+        """Test the --cover option."""
+        path = datadir / 'tagged.flac'
+        runner = CliRunner()
+        args = [
+            'convert', '-d', str(tmp_path), '--cover', 'front.jpg:500',
+            '--cover', 'thumb.jpg:64', '--cover-cache', str(tmp_path / 'c'),
+            str(path),
+        ]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        album = tmp_path / 'Test Artist' / 'Test Album'
+        assert (album / 'front.jpg').is_file()
+        assert (album / 'thumb.jpg').is_file()
+        assert not (album / 'cover.jpg').exists()
+
+    def test_profiles(self, datadir, tmp_path):
+        """Test the --profile option."""
+        path = datadir / 'tagged.flac'
+        high = tmp_path / 'high'
+        low = tmp_path / 'low'
+        high.mkdir()
+        low.mkdir()
+        runner = CliRunner()
+        args = [
+            'convert',
+            '-p', 'ogg:6:{}'.format(high),
+            '-p', 'ogg:2:{}'.format(low),
+            str(path),
+        ]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        for base in [high, low]:
+            files = list((base / 'Test Artist' / 'Test Album').iterdir())
+            assert len(files) == 3
+
+    def test_profiles_invalid(self, datadir, tmp_path):
+        """Test the --profile option with an unsupported format."""
+        path = datadir / 'tagged.flac'
+        runner = CliRunner()
+        args = ['convert', '-p', 'mp3:6:{}'.format(tmp_path), str(path)]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 2
+        assert 'Unsupported format' in result.output
+
+
+class TestWorker(object):
+    """Test the convert --enqueue option and the worker command."""
+
+    def test_worker(self, datadir, tmp_path):
+        """Test converting a queued album."""
+        path = datadir / 'tagged.flac'
+        spool = tmp_path / 'spool'
+        out = tmp_path / 'out'
+        out.mkdir()
+        runner = CliRunner()
+        args = ['convert', '-d', str(out), '--enqueue', str(spool), str(path)]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert '- Enqueued' in result.output
+        result = runner.invoke(flackup, args)
+        assert '- Already queued' in result.output
+        assert not (out / 'Test Artist').exists()
+        worker = ['worker', '--exit-when-empty', str(spool)]
+        result = runner.invoke(flackup, worker)
+        assert result.exit_code == 0
+        assert '- Encoding tracks' in result.output
+        files = list((out / 'Test Artist' / 'Test Album').iterdir())
+        assert len(files) == 3
+        done = list((spool / 'done').iterdir())
+        assert len(done) == 1
+        job = json.loads(done[0].read_text())
+        assert job['result']['ok'] is True
+        assert 'encode' in job['result']['stages']
+        result = runner.invoke(flackup, ['worker', '--status', str(spool)])
+        assert 'done: 1' in result.output
+        result = runner.invoke(flackup, args)
+        assert result.output == ''
+
+    def test_worker_failed(self, datadir, tmp_path):
+        """Test that failed jobs are reported."""
+        path = tmp_path / 'tagged.flac'
+        path.write_bytes((datadir / 'tagged.flac').read_bytes())
+        spool = tmp_path / 'spool'
+        runner = CliRunner()
+        args = [
+            'convert', '-d', str(tmp_path), '--enqueue', str(spool), str(path),
+        ]
+        runner.invoke(flackup, args)
+        path.unlink()
+        worker = ['worker', '--exit-when-empty', str(spool)]
+        result = runner.invoke(flackup, worker)
+        assert result.exit_code == 1
+        assert 'ERROR' in result.output
+        result = runner.invoke(flackup, ['worker', '--status', str(spool)])
+        assert 'failed: 1' in result.output
+
+
+class TestWatch(object):
+    """Test the watch command."""
+
+    def test_once(self, datadir, tmp_path):
+        """Test processing the files in an inbox."""
+        inbox = tmp_path / 'inbox'
+        out = tmp_path / 'out'
+        (inbox / 'rip').mkdir(parents=True)
+        out.mkdir()
+        path = inbox / 'rip' / 'tagged.flac'
+        path.write_bytes((datadir / 'tagged.flac').read_bytes())
+        runner = CliRunner()
+        args = ['watch', '--once', '-d', str(out), str(inbox)]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert '- Encoding tracks' in result.output
+        files = list((out / 'Test Artist' / 'Test Album').iterdir())
+        assert len(files) == 3
+        result = runner.invoke(flackup, args)
+        assert '- Encoding tracks' not in result.output
+
+    def test_review(self, datadir, tmp_path, monkeypatch):
+        """Test that files with several releases are moved for review."""
+        def releases_by_cuesheet(self, cuesheet):
+            return [{'id': '1'}, {'id': '2'}]
+
+        monkeypatch.setattr(
+            MusicBrainz, 'releases_by_cuesheet', releases_by_cuesheet)
+        inbox = tmp_path / 'inbox'
+        (inbox / 'rip').mkdir(parents=True)
+        path = inbox / 'rip' / 'untagged.flac'
+        path.write_bytes((datadir / 'tagged.flac').read_bytes())
+        flac = FLAC(path)
+        flac.clear()
+        flac.save()
+        runner = CliRunner()
+        args = ['watch', '--once', '-d', str(tmp_path), str(inbox)]
+        result = runner.invoke(flackup, args)
+        assert result.exit_code == 0
+        assert '2 releases found' in result.output
+        assert not path.exists()
+        assert (inbox / 'review' / 'rip' / 'untagged.flac').is_file()
+
+
+class TestPad(object):
+    """Test the pad command."""
+
+    def test_pad(self, datadir):
+        """Test that files with too little padding are rewritten once."""
+        path = str(datadir / 'tagged.flac')
+        runner = CliRunner()
+        result = runner.invoke(flackup, ['pad', '-s', '64K', path])
+        assert result.exit_code == 0
+        assert result.output == \
+            'OCATP {}\n- Padding: 7662 -> 65536 bytes\n'.format(path)
+        assert FileInfo(path).padding == 65536
+        result = runner.invoke(flackup, ['pad', '-s', '64K', path])
+        assert result.output == ''
+
+    def test_too_large(self, datadir):
+        """Test that padding over the FLAC block size limit is refused."""
+        path = str(datadir / 'tagged.flac')
+        runner = CliRunner()
+        result = runner.invoke(flackup, ['pad', '-s', '16M', path])
+        assert result.exit_code == 2
+
+
 class TestVersion(object):
     """Test the version command."""
 
@@ -57,3 +572,13 @@ class TestVersion(object):
         result = runner.invoke(flackup, ['version'])
         assert result.exit_code == 0
         assert result.output.strip() == f'{NAME} {VERSION}'
+
+
+def copy_files(path, directory, count):
+    """Copy a file count times to a directory and return the paths."""
+    paths = []
+    for number in range(count):
+        copy = directory / '{:02d}.flac'.format(number)
+        copy.write_bytes(path.read_bytes())
+        paths.append(str(copy))
+    return paths
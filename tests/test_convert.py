@@ -1,8 +1,21 @@
+import errno
+import io
+import os
 from pathlib import Path
 import re
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+from mutagen.oggvorbis import OggVorbis
+from PIL import Image
+import pytest
 
 import flackup.convert as fc
-from flackup.fileinfo import FileInfo
+from flackup.fileinfo import FileInfo, StreamInfo
+from flackup.metrics import Metrics
 
 
 TRACK_WAV_RE = re.compile(r'track-\d\d\.wav')
@@ -27,6 +40,19 @@ class TestConvert(object):
         for track in tracks:
             assert track.tags['DATE'] == '1970'
 
+    def test_prepare_profiles(self, datadir, tmp_path):
+        """Test the prepare_profiles function."""
+        info = FileInfo(datadir / 'tagged.flac')
+        profiles = [
+            fc.Profile('ogg', 6, str(tmp_path / 'high')),
+            fc.Profile('ogg', 2, str(tmp_path / 'low')),
+        ]
+        tracks = fc.prepare_profiles(info, profiles)
+        assert [t.number for t in tracks] == [1, 2, 1, 2]
+        assert [t.quality for t in tracks] == [6, 6, 2, 2]
+        assert tracks[0].path.startswith(str(tmp_path / 'high'))
+        assert tracks[2].path.startswith(str(tmp_path / 'low'))
+
     def test_decode_tracks(self, datadir):
         """Test the prepare_tracks function."""
         info = FileInfo(datadir / 'tagged.flac')
@@ -38,6 +64,49 @@ class TestConvert(object):
         for file in files:
             assert TRACK_WAV_RE.match(file.name) is not None
 
+    def test_decode_tracks_all(self, datadir):
+        """Test the decode_tracks function with all tracks."""
+        info = FileInfo(datadir / 'tagged.flac')
+        tempdir = fc.decode_tracks(info, [1, 2, 3])
+        path = Path(tempdir.name)
+        names = sorted(file.name for file in path.iterdir())
+        assert names == ['track-01.wav', 'track-02.wav', 'track-03.wav']
+        for name in names:
+            with wave.open(str(path / name), 'rb') as wav:
+                assert wav.getnframes() == 44100
+
+    def test_decode_tracks_numbers(self, datadir):
+        """Test the decode_tracks function with selected tracks."""
+        info = FileInfo(datadir / 'tagged.flac')
+        tempdir = fc.decode_tracks(info, [2, 3], jobs=2)
+        path = Path(tempdir.name)
+        names = sorted(file.name for file in path.iterdir())
+        assert names == ['track-02.wav', 'track-03.wav']
+        with wave.open(str(path / 'track-03.wav'), 'rb') as wav:
+            assert wav.getnframes() == 44100
+
+    def test_decode_tracks_unaligned(self, datadir, monkeypatch):
+        """Test that 20-bit samples are decoded to WAV files by flac."""
+        info = FileInfo(datadir / 'tagged.flac')
+        info.streaminfo = info.streaminfo._replace(sample_bits=20)
+        calls = []
+
+        def flac_args(flac, dst, start=None, end=None, raw=None):
+            calls.append(raw)
+            return fc_flac_args(flac, dst, start, end, raw)
+
+        fc_flac_args = fc.flac_args
+        monkeypatch.setattr(fc, 'flac_args', flac_args)
+        tempdir = fc.decode_tracks(info)
+        names = sorted(file.name for file in Path(tempdir.name).iterdir())
+        tempdir.cleanup()
+        assert names == ['track-01.wav', 'track-02.wav']
+        assert calls == [None, None]
+        assert fc.temp_bytes(info, [1, 2, 3]) == \
+            (info.streaminfo.sample_count * 6 + 3 * fc.WAV_EXTENSIBLE_HEADER)
+        with pytest.raises(fc.ConversionError):
+            fc.stream_tracks(info, [], 'ogg')
+
     def test_encode_tracks(self, datadir):
         """Test the encode_tracks function."""
         info = FileInfo(datadir / 'tagged.flac')
@@ -49,6 +118,248 @@ class TestConvert(object):
         assert len(files) == 2
         for file in files:
             assert file.name.endswith('.ogg')
+            ogg = OggVorbis(file)
+            assert 'REPLAYGAIN_TRACK_GAIN' in ogg
+            assert 'REPLAYGAIN_ALBUM_GAIN' in ogg
+
+    def test_encode_tracks_profiles(self, datadir, tmp_path):
+        """Test the encode_tracks function with two profiles."""
+        info = FileInfo(datadir / 'tagged.flac')
+        profiles = [
+            fc.Profile('ogg', 6, str(tmp_path / 'high')),
+            fc.Profile('ogg', 2, str(tmp_path / 'low')),
+        ]
+        tracks = fc.prepare_profiles(info, profiles)
+        tempdir = fc.decode_tracks(info)
+        fc.encode_tracks(tracks, tempdir, 'ogg', jobs=2)
+        for track in tracks:
+            ogg = OggVorbis(track.path)
+            assert 'REPLAYGAIN_ALBUM_GAIN' in ogg
+
+    def test_oggenc_args_quality(self):
+        """Test that oggenc_args uses the Track quality."""
+        track = fc.Track(1, 'track.ogg', {}, 2.5)
+        args = fc.oggenc_args(track, 'track.wav')
+        assert args[args.index('-q') + 1] == '2.5'
+
+    def test_retag_ogg(self, datadir):
+        """Test that retag_ogg keeps the ReplayGain tags."""
+        info = FileInfo(datadir / 'tagged.flac')
+        tracks = fc.prepare_tracks(info, str(datadir), 'ogg')
+        tempdir = fc.decode_tracks(info)
+        fc.encode_tracks(tracks, tempdir, 'ogg')
+        track = tracks[0]
+        track.tags['TITLE'] = 'New Title'
+        fc.retag_ogg(track)
+        ogg = OggVorbis(track.path)
+        assert ogg['TITLE'] == ['New Title']
+        assert ogg['TRACKNUMBER'] == ['1']
+        assert 'REPLAYGAIN_TRACK_GAIN' in ogg
+        assert fc.retag_needed(track) is False
+        track.tags['GENRE'] = 'Changed'
+        assert fc.retag_needed(track) is True
+
+    def test_analyze_wav(self, datadir):
+        """Test the analyze_wav function with the near-silent fixture."""
+        info = FileInfo(datadir / 'tagged.flac')
+        tempdir = fc.decode_tracks(info)
+        path = Path(tempdir.name)
+        analysis = fc.analyze_wav(str(path / 'track-01.wav'))
+        assert analysis.gain == pytest.approx(64.82, abs=0.01)
+        assert analysis.peak < 0.001
+
+    def test_encode_tracks_metrics(self, datadir):
+        """Test the decode_tracks and encode_tracks metrics."""
+        info = FileInfo(datadir / 'tagged.flac')
+        tracks = fc.prepare_tracks(info, str(datadir), 'ogg')
+        metrics = Metrics()
+        tempdir = fc.decode_tracks(info, metrics=metrics)
+        fc.encode_tracks(tracks, tempdir, 'ogg', metrics=metrics)
+        stages = metrics.stages
+        assert list(metrics.to_dict()) == ['decode', 'encode', 'replaygain']
+        assert stages['decode'].audio == pytest.approx(2.0)
+        assert stages['decode'].read > 0
+        assert stages['encode'].audio == pytest.approx(2.0)
+        assert stages['encode'].written > 0
+
+    def test_encode_tracks_jobs(self, datadir):
+        """Test the encode_tracks function with concurrent jobs."""
+        info = FileInfo(datadir / 'tagged.flac')
+        tracks = fc.prepare_tracks(info, str(datadir), 'ogg')
+        tempdir = fc.decode_tracks(info)
+        fc.encode_tracks(tracks, tempdir, 'ogg', jobs=2)
+        for track in tracks:
+            assert Path(track.path).is_file()
+
+    def test_encode_tracks_error(self, datadir, monkeypatch):
+        """Test that an encoding error stops the encode_tracks function."""
+        def oggenc_args(track, src_path):
+            return python('import sys; sys.exit(1)')
+
+        def add_replaygain(tracks, analyses, runner):
+            raise AssertionError('ReplayGain after error')
+
+        info = FileInfo(datadir / 'tagged.flac')
+        tracks = fc.prepare_tracks(info, str(datadir), 'ogg')
+        monkeypatch.setattr(fc, 'oggenc_args', oggenc_args)
+        monkeypatch.setattr(fc, 'add_replaygain', add_replaygain)
+        tempdir = tempfile.TemporaryDirectory()
+        with pytest.raises(fc.ConversionError):
+            fc.encode_tracks(tracks, tempdir, 'ogg', jobs=2)
+
+    def test_encode_tracks_partial(self, datadir, monkeypatch):
+        """Test that failed tracks leave no output files."""
+        def oggenc_args(track, src_path):
+            code = 'import sys; open(sys.argv[1], "w"); sys.exit(1)'
+            return python(code) + [track.path]
+
+        info = FileInfo(datadir / 'tagged.flac')
+        tracks = fc.prepare_tracks(info, str(datadir), 'ogg')
+        tempdir = fc.decode_tracks(info)
+        monkeypatch.setattr(fc, 'oggenc_args', oggenc_args)
+        with pytest.raises(fc.ConversionError):
+            fc.encode_tracks(tracks, tempdir, 'ogg')
+        assert list(Path(tracks[0].path).parent.iterdir()) == []
+
+    def test_encode_tracks_journal(self, datadir):
+        """Test that on_encoded is called before renaming each track."""
+        def on_encoded(track, analysis):
+            assert Path(fc.partial_path(track.path)).is_file()
+            assert not Path(track.path).exists()
+            encoded.append((track.number, analysis))
+
+        encoded = []
+        info = FileInfo(datadir / 'tagged.flac')
+        tracks = fc.prepare_tracks(info, str(datadir), 'ogg')
+        tempdir = fc.decode_tracks(info)
+        analyses = fc.encode_tracks(
+            tracks, tempdir, 'ogg', replaygain=False, on_encoded=on_encoded)
+        assert sorted(encoded) == sorted(analyses.items())
+        for track in tracks:
+            assert Path(track.path).is_file()
+
+    def test_partial_path(self):
+        """Test the partial_path function."""
+        path = fc.partial_path('/music/Album/01 Track.ogg')
+        owner = fc.partial_owner()
+        assert path == '/music/Album/.01 Track.ogg.{}.part'.format(owner)
+
+    def test_prepare_outputs(self, tmp_path):
+        """Test that only partials of dead processes on this host go."""
+        track = fc.Track(1, str(tmp_path / 'Album' / '01 Track.ogg'), {})
+        fc.prepare_outputs([track])
+        host = fc.partial_owner().rpartition('-')[0]
+        names = [
+            '.01 Track.ogg.{}-{}.part'.format(host, 2 ** 22 + 1),
+            '.01 Track.ogg.other-host-{}.part'.format(2 ** 22 + 1),
+            '.02 Track.ogg.{}-{}.part'.format(host, 2 ** 22 + 1),
+            os.path.basename(fc.partial_path(track.path)),
+        ]
+        for name in names:
+            (tmp_path / 'Album' / name).write_bytes(b'')
+        fc.prepare_outputs([track])
+        assert sorted(p.name for p in (tmp_path / 'Album').iterdir()) == \
+            sorted(names[1:])
+
+    def test_temp_bytes(self, datadir):
+        """Test the temp_bytes function."""
+        info = FileInfo(datadir / 'tagged.flac')
+        tempdir = fc.decode_tracks(info, [2, 3])
+        path = Path(tempdir.name)
+        size = sum(file.stat().st_size for file in path.iterdir())
+        assert fc.temp_bytes(info, [2, 3]) == size
+        pcm = info.streaminfo.sample_count * 2 * 2
+        assert fc.temp_bytes(info, [1, 2, 3]) == pcm + size + 44 + 44100 * 4
+
+    def test_decode_tracks_temp_dir(self, datadir, tmp_path):
+        """Test the temp_dir parameter of decode_tracks."""
+        info = FileInfo(datadir / 'tagged.flac')
+        tempdir = fc.decode_tracks(info, temp_dir=str(tmp_path))
+        assert Path(tempdir.name).parent == tmp_path
+        tempdir.cleanup()
+
+    def test_stream_tracks(self, datadir):
+        """Test the stream_tracks function."""
+        info = FileInfo(datadir / 'tagged.flac')
+        tracks = fc.prepare_tracks(info, str(datadir), 'ogg')
+        fc.stream_tracks(info, tracks, 'ogg', jobs=2, buffer_size=1)
+        path = Path(tracks[0].path).parent
+        files = list(path.iterdir())
+        assert len(files) == 2
+        for file in files:
+            assert file.name.endswith('.ogg')
+
+    def test_stream_tracks_profiles(self, datadir, tmp_path, monkeypatch):
+        """Test that the encoders of two profiles share one job."""
+        monkeypatch.setattr(fc, 'STREAM_CHUNK', 4096)
+        info = FileInfo(datadir / 'tagged.flac')
+        profiles = [
+            fc.Profile('ogg', 6, str(tmp_path / 'high')),
+            fc.Profile('ogg', 2, str(tmp_path / 'low')),
+        ]
+        tracks = fc.prepare_profiles(info, profiles)
+        thread = threading.Thread(
+            target=fc.stream_tracks,
+            args=(info, tracks, 'ogg'),
+            kwargs={'jobs': 1, 'buffer_size': 1, 'replaygain': False},
+            daemon=True)
+        thread.start()
+        thread.join(30)
+        assert not thread.is_alive()
+        for track in tracks:
+            assert os.path.exists(track.path)
+
+    def test_stream_tracks_error(self, datadir, monkeypatch):
+        """Test that an encoding error stops the stream_tracks function."""
+        def oggenc_args(track, src_path, raw):
+            return python('import sys; sys.exit(1)')
+
+        info = FileInfo(datadir / 'tagged.flac')
+        tracks = fc.prepare_tracks(info, str(datadir), 'ogg')
+        monkeypatch.setattr(fc, 'oggenc_args', oggenc_args)
+        with pytest.raises(fc.ConversionError):
+            fc.stream_tracks(info, tracks, 'ogg', jobs=2, buffer_size=1)
+        assert list(Path(tracks[0].path).parent.iterdir()) == []
+
+    def test_copy(self, tmp_path):
+        """Test the copy function."""
+        data = bytes(range(256)) * 1024
+        (tmp_path / 'src').write_bytes(data)
+        with open(tmp_path / 'src', 'rb') as src:
+            with open(tmp_path / 'dst', 'wb') as dst:
+                dst.write(b'HEAD')
+                dst.flush()
+                fc.copy(src, dst, 1000, 100000)
+        assert (tmp_path / 'dst').read_bytes() == b'HEAD' + data[1000:101000]
+
+    def test_copy_fallback(self, tmp_path, monkeypatch):
+        """Test the copy function without kernel-side copies."""
+        def unsupported(*args):
+            raise OSError(errno.EXDEV, 'Unsupported')
+
+        monkeypatch.setattr(fc, '_copy_file_range', unsupported)
+        monkeypatch.setattr(fc, '_sendfile', unsupported)
+        data = bytes(range(256)) * 1024
+        (tmp_path / 'src').write_bytes(data)
+        with open(tmp_path / 'src', 'rb') as src:
+            with open(tmp_path / 'dst', 'wb') as dst:
+                dst.write(b'HEAD')
+                dst.flush()
+                fc.copy(src, dst, 1000, 100000)
+        assert (tmp_path / 'dst').read_bytes() == b'HEAD' + data[1000:101000]
+
+    def test_wav_header(self, tmp_path):
+        """Test the wav_header function."""
+        stream = StreamInfo(2, 16, 44100, 132300)
+        path = tmp_path / 'test.wav'
+        path.write_bytes(fc.wav_header(stream, 10) + bytes(40))
+        with wave.open(str(path), 'rb') as wav:
+            assert wav.getnchannels() == 2
+            assert wav.getsampwidth() == 2
+            assert wav.getframerate() == 44100
+            assert wav.getnframes() == 10
+        assert fc.pcm_aligned(stream) is True
+        assert fc.pcm_aligned(stream._replace(sample_bits=20)) is False
 
     def test_export_cover(self, datadir):
         """Test the export_cover function."""
@@ -57,3 +368,180 @@ class TestConvert(object):
         fc.export_cover(front, str(datadir))
         path = Path(datadir / 'cover.jpg')
         assert path.is_file()
+
+    @pytest.mark.parametrize('fmt', ['JPEG', 'PNG'])
+    def test_export_covers(self, tmp_path, fmt):
+        """Test the export_covers function with several sizes."""
+        front = fc.parse_picture(image_data(1200, 900, fmt), 3)
+        sizes = {'cover.jpg': 500, 'thumb.jpg': 100, 'full.jpg': 2000}
+        fc.export_covers(front, str(tmp_path), sizes)
+        with Image.open(tmp_path / 'cover.jpg') as image:
+            assert image.format == 'JPEG'
+            assert image.size == (500, 375)
+        with Image.open(tmp_path / 'thumb.jpg') as image:
+            assert image.size == (100, 75)
+        assert (tmp_path / 'full.jpg').read_bytes() == front.data
+
+    def test_export_covers_cache(self, tmp_path, monkeypatch):
+        """Test that cached covers are not resized again."""
+        front = fc.parse_picture(image_data(1200, 900, 'JPEG'), 3)
+        cache_dir = tmp_path / 'cache'
+        fc.export_covers(front, str(tmp_path), cache=fc.CoverCache(cache_dir))
+        assert len(list(cache_dir.iterdir())) == 1
+
+        def open_reduced(picture, width):
+            raise AssertionError('Cover resized again')
+
+        monkeypatch.setattr(fc, 'open_reduced', open_reduced)
+        out = tmp_path / 'out'
+        out.mkdir()
+        fc.export_covers(front, str(out), cache=fc.CoverCache(cache_dir))
+        assert (out / 'cover.jpg').read_bytes() == \
+            (tmp_path / 'cover.jpg').read_bytes()
+
+    def test_cover_cache_prune(self, tmp_path):
+        """Test that the least recently used covers are removed."""
+        cache_dir = tmp_path / 'cache'
+        pictures = [
+            fc.parse_picture(image_data(100 + n, 100, 'JPEG'), 3)
+            for n in range(3)
+        ]
+        cache = fc.CoverCache(str(cache_dir), max_size=3500)
+
+        def put(picture, mtime):
+            cache.put(picture, 500, bytes(1000))
+            os.utime(cache_dir / cache.key(picture, 500), ns=(mtime, mtime))
+
+        put(pictures[0], 0)
+        put(pictures[1], 1)
+        assert fc.CoverCache(str(cache_dir)).get(pictures[0], 500) is not None
+        put(pictures[2], 2)
+        assert len(list(cache_dir.iterdir())) == 3
+        cache.put(pictures[2], 250, bytes(1000))
+        names = sorted(path.name for path in cache_dir.iterdir())
+        assert names == sorted([
+            cache.key(pictures[0], 500),
+            cache.key(pictures[2], 250),
+        ])
+
+    def test_open_reduced(self):
+        """Test that large JPEG images are decoded at a reduced size."""
+        front = fc.parse_picture(image_data(3000, 3000, 'JPEG'), 3)
+        image = fc.open_reduced(front, 500)
+        assert image.size == (1500, 1500)
+
+
+class TestProcessRunner(object):
+    """Test the ProcessRunner class."""
+
+    def test_run(self, tmp_path):
+        """Test running commands."""
+        path = tmp_path / 'test.txt'
+        with fc.ProcessRunner(jobs=2) as runner:
+            runner.run(python('open({!r}, "w").write("ok")'.format(str(path))))
+            output = runner.call(runner.exec(python('print("ok")'), True))
+        assert path.read_text() == 'ok'
+        assert output.strip() == b'ok'
+
+    def test_failure(self):
+        """Test that stderr is part of the error message."""
+        code = 'import sys; sys.stderr.write("broken"); sys.exit(3)'
+        with fc.ProcessRunner() as runner:
+            with pytest.raises(fc.ConversionError, match='status 3. broken'):
+                runner.run(python(code))
+
+    def test_timeout(self):
+        """Test the timeout parameter."""
+        with fc.ProcessRunner(timeout=0.5) as runner:
+            with pytest.raises(fc.ConversionError, match='timed out'):
+                runner.run(python('import time; time.sleep(30)'))
+
+    def test_cancel(self):
+        """Test that a failure cancels the other commands."""
+        start = time.monotonic()
+        with fc.ProcessRunner(jobs=2) as runner:
+            with pytest.raises(fc.ConversionError):
+                runner.run(
+                    python('import time; time.sleep(30)'),
+                    python('import sys; sys.exit(1)'),
+                    python('import time; time.sleep(30)'),
+                )
+        assert time.monotonic() - start < 10
+
+
+class TestScheduling(object):
+    """Test the adaptive concurrency and TempBudget."""
+
+    def test_adapt_jobs(self):
+        """Test the adapt_jobs function."""
+        assert fc.adapt_jobs(4, 8, 0.5, 0.5, True) == 3
+        assert fc.adapt_jobs(1, 8, 0.5, 0.5, True) == 1
+        assert fc.adapt_jobs(4, 8, 0.5, 0.0, True) == 5
+        assert fc.adapt_jobs(4, 8, 0.5, 0.0, False) == 4
+        assert fc.adapt_jobs(8, 8, 0.5, 0.0, True) == 8
+        assert fc.adapt_jobs(4, 8, 1.0, 0.0, True) == 4
+
+    def test_load_fractions(self):
+        """Test the load_fractions function."""
+        before = fc.CpuTimes(1000, 500, 100)
+        after = fc.CpuTimes(1100, 540, 120)
+        busy, iowait = fc.load_fractions(before, after)
+        assert busy == pytest.approx(0.4)
+        assert iowait == pytest.approx(0.2)
+        assert fc.load_fractions(after, after) == (0.0, 0.0)
+
+    def test_set_jobs(self):
+        """Test that set_jobs lets waiting processes start."""
+        with fc.ProcessRunner(jobs=1) as runner:
+            runner.set_jobs(3)
+            start = time.monotonic()
+            runner.run(*[python('import time; time.sleep(1)')] * 3)
+            assert time.monotonic() - start < 2.5
+            assert runner.jobs == 3
+
+    def test_adapt(self):
+        """Test that an adaptive runner stays within its limits."""
+        with fc.ProcessRunner(jobs=2) as runner:
+            runner.adapt(2, interval=0.05)
+            runner.run(*[python('import time; time.sleep(0.3)')] * 4)
+            assert 1 <= runner.jobs <= 2
+
+    def test_temp_budget(self):
+        """Test that reservations wait for space in the TempBudget."""
+        budget = fc.TempBudget(100)
+        events = []
+
+        def reserve(name, size):
+            with budget.reserve(size):
+                events.append(name)
+                time.sleep(0.2)
+                events.append(name)
+
+        with budget.reserve(60):
+            thread = threading.Thread(target=reserve, args=('b', 60))
+            thread.start()
+            time.sleep(0.2)
+            assert events == []
+            assert budget.used == 60
+        thread.join()
+        assert events == ['b', 'b']
+        assert budget.used == 0
+
+    def test_temp_budget_oversized(self):
+        """Test that a reservation above the limit is admitted alone."""
+        budget = fc.TempBudget(100)
+        with budget.reserve(500):
+            assert budget.used == 500
+
+
+def image_data(width, height, fmt):
+    """Return image data of a gradient in the format."""
+    image = Image.linear_gradient('L').resize((width, height))
+    data = io.BytesIO()
+    image.convert('RGB').save(data, format=fmt)
+    return data.getvalue()
+
+
+def python(code):
+    """Return a command line running the Python code."""
+    return [sys.executable, '-c', code]
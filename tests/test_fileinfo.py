@@ -1,5 +1,8 @@
+from mutagen.flac import FLAC, VCFLACDict
+
 from flackup.convert import parse_picture
-from flackup.fileinfo import FileInfo
+from flackup.fileinfo import (
+    FileInfo, HeaderInfo, MAX_PADDING, PADDING_RESERVE, Tags)
 
 
 class TestFileInfo(object):
@@ -19,6 +22,7 @@ class TestFileInfo(object):
         assert streaminfo.sample_bits == 16
         assert streaminfo.sample_rate == 44100
         assert streaminfo.sample_count == 132300
+        assert streaminfo.md5 == '56159cb51bc6001c0c5e44283af5c1ac'
 
     def test_init_empty(self, datadir):
         """Call the constructor with an empty FLAC file."""
@@ -66,6 +70,102 @@ class TestFileInfo(object):
         file.update()
         assert file.get_picture(3) is None
 
+    def test_set_picture_keeps_others(self, datadir):
+        """Test that other pictures keep their description and palette."""
+        path = datadir / 'tagged.flac'
+        data = (datadir / 'cover.png').read_bytes()
+        flac = FLAC(str(path))
+        back = flac.pictures[0]
+        back.type = 4
+        back.desc = 'Back'
+        back.colors = 16
+        flac.clear_pictures()
+        flac.add_picture(back)
+        flac.save()
+        file = FileInfo(path)
+        assert file.set_picture(parse_picture(data, 3)) is True
+        file.update()
+        pictures = {p.type: p for p in FLAC(str(path)).pictures}
+        assert pictures[4].desc == 'Back'
+        assert pictures[4].colors == 16
+        assert pictures[3].data == data
+
+    def test_picture_lazy(self, datadir):
+        """Test that picture data is read only when used."""
+        file = FileInfo(datadir / 'tagged.flac')
+        picture = file.get_picture(3)
+        data = (datadir / 'cover.png').read_bytes()
+        assert picture.length == len(data)
+        assert picture._data is None
+        assert picture == parse_picture(data, 3)
+        assert picture._data is None
+        assert picture.data == data
+
+    def test_update_keeps_pictures(self, datadir):
+        """Test that Pictures stay readable after the file is rewritten."""
+        file = FileInfo(datadir / 'tagged.flac')
+        picture = file.get_picture(3)
+        data = (datadir / 'cover.png').read_bytes()
+        file.tags.update_album({'ALBUM': 'A much longer album title' * 500})
+        assert file.update() is True
+        assert picture._data is None
+        assert picture.data == data
+        assert file.get_picture(3) == picture
+
+    def test_update_no_tags(self, datadir, tmp_path):
+        """Test adding tags to a file without a VORBIS_COMMENT block."""
+        path = tmp_path / 'untagged.flac'
+        path.write_bytes((datadir / 'test.flac').read_bytes())
+        FLAC(str(path)).delete()
+        file = FileInfo(path)
+        assert file.tags.update_album({'ALBUM': 'Album'}) is True
+        file.update()
+        assert FileInfo(path).tags.album_tags() == {'ALBUM': 'Album'}
+
+    def test_update_in_place(self, datadir):
+        """Test that small changes are written into the padding."""
+        path = datadir / 'tagged.flac'
+        size = path.stat().st_size
+        file = FileInfo(path)
+        file.tags.update_album({'ALBUM': 'Another album'})
+        assert file.update() is False
+        assert path.stat().st_size == size
+        assert FileInfo(path).tags.album_tags()['ALBUM'] == 'Another album'
+
+    def test_update_rewrite(self, datadir):
+        """Test that the padding is reserved when the file is rewritten."""
+        file = FileInfo(datadir / 'tagged.flac')
+        file.tags.update_album({'ALBUM': 'x' * 10000})
+        assert file.update() is True
+        assert file.padding == PADDING_RESERVE
+
+    def test_update_min_padding(self, datadir):
+        """Test that the file is rewritten to keep min_padding bytes."""
+        file = FileInfo(datadir / 'test.flac')
+        assert file.update(padding=0, min_padding=8192) is False
+        assert file.update(padding=0, min_padding=10000) is True
+        assert file.padding == 10000
+
+    def test_update_max_padding(self, datadir, tmp_path):
+        """Test that padding beyond one PADDING block is dropped."""
+        data = (datadir / 'test.flac').read_bytes()
+        blocks, offset, last = [b'fLaC'], 4, False
+        while not last:
+            last = bool(data[offset] & 0x80)
+            size = int.from_bytes(data[offset + 1:offset + 4], 'big')
+            if data[offset] & 0x7f != 1:
+                blocks.append(bytes([data[offset] & 0x7f]) +
+                              data[offset + 1:offset + 4 + size])
+            offset += 4 + size
+        padding = MAX_PADDING.to_bytes(3, 'big') + bytes(MAX_PADDING)
+        blocks += [b'\x01' + padding, b'\x81' + padding, data[offset:]]
+        path = tmp_path / 'padded.flac'
+        path.write_bytes(b''.join(blocks))
+        file = FileInfo(path)
+        assert file.padding > MAX_PADDING
+        assert file.update() is True
+        assert file.padding == MAX_PADDING
+
     @staticmethod
     def assert_picture(fileinfo, type_, mime, width, height, depth, data):
         picture = fileinfo.get_picture(type_)
@@ -78,6 +178,69 @@ class TestFileInfo(object):
         assert picture.data == data
 
 
+class TestHeaderInfo(object):
+    """Test the HeaderInfo class."""
+
+    def test_init(self, datadir):
+        """Test that HeaderInfo reads the same metadata as FileInfo."""
+        header = HeaderInfo(datadir / 'tagged.flac')
+        file = FileInfo(datadir / 'tagged.flac')
+        assert header.parse_ok is True
+        assert header.parse_exception is None
+        assert header.streaminfo == file.streaminfo
+        assert header.cuesheet.tracks == file.cuesheet.tracks
+        assert header.cuesheet.is_cd is True
+        assert header.tags.album_tags() == file.tags.album_tags()
+        assert header.tags.track_tags(1) == file.tags.track_tags(1)
+        assert repr(header.summary) == repr(file.summary) == 'OCATP'
+
+    def test_picture(self, datadir):
+        """Test that pictures are located without reading their data."""
+        header = HeaderInfo(datadir / 'tagged.flac')
+        picture = header.get_picture(3)
+        assert picture.mime == 'image/png'
+        assert picture.width == 128
+        assert picture.height == 128
+        assert picture.depth == 24
+        assert len(header.pictures()) == 1
+        assert header.get_picture(4) is None
+        with open(datadir / 'tagged.flac', 'rb') as f:
+            f.seek(picture.offset)
+            data = f.read(picture.length)
+        assert data == FileInfo(datadir / 'tagged.flac').get_picture(3).data
+
+    def test_padding(self, datadir):
+        """Test the total size of the PADDING blocks."""
+        assert HeaderInfo(datadir / 'tagged.flac').padding == 7662
+        assert HeaderInfo(datadir / 'empty.flac').padding == 0
+        assert HeaderInfo(datadir / 'invalid.flac').padding is None
+
+    def test_empty(self, datadir):
+        """Test with an empty FLAC file."""
+        header = HeaderInfo(datadir / 'empty.flac')
+        assert header.parse_ok is True
+        assert header.cuesheet is None
+        assert header.tags.album_tags() == {}
+        assert header.pictures() == ()
+
+    def test_invalid(self, datadir):
+        """Test with an invalid FLAC file."""
+        header = HeaderInfo(datadir / 'invalid.flac')
+        assert header.parse_ok is False
+        assert header.parse_exception is not None
+        assert header.streaminfo is None
+        assert header.pictures() is None
+        assert repr(header.summary) == '-----'
+
+    def test_truncated(self, datadir, tmp_path):
+        """Test with a FLAC file truncated in the PICTURE block."""
+        path = tmp_path / 'truncated.flac'
+        path.write_bytes((datadir / 'tagged.flac').read_bytes()[:1000])
+        header = HeaderInfo(path)
+        assert header.parse_ok is False
+        assert FileInfo(path).parse_ok is False
+
+
 class TestCueSheet(object):
     """Test the CueSheet class."""
 
@@ -177,6 +340,33 @@ class TestTags(object):
         self.assert_track(tags.track_tags(2), 'Track 2', None, None)
         self.assert_track(tags.track_tags(3), None, 'true', 'Terrible')
 
+    def test_save(self):
+        """Test that changes are applied to Vorbis comments on save."""
+        comments = VCFLACDict()
+        comments.extend([
+            ('album', 'Album'),
+            ('TRACK_01_TITLE', 'One'),
+            ('TRACK_01_TITLE', 'Ignored'),
+            ('FOO', 'Bar'),
+        ])
+        tags = Tags(comments)
+        assert tags.album_tags() == {'ALBUM': 'Album'}
+        assert tags.track_tags(1) == {'TITLE': 'One'}
+        assert tags.update_album({'ALBUM': 'Album'}) is False
+        assert tags.changed is False
+        assert tags.update_track(1, {}) is True
+        assert tags.update_track(2, {'TITLE': 'Two'}) is True
+        assert tags.track_tags(2) == {'TITLE': 'Two'}
+        assert len(comments) == 4
+        tags.save(comments)
+        assert tags.changed is False
+        assert list(comments) == [
+            ('album', 'Album'),
+            ('FOO', 'Bar'),
+            ('FLACKUP_VERSION', '1'),
+            ('TRACK_02_TITLE', 'Two'),
+        ]
+
     @staticmethod
     def assert_album(tags, album, artist, genre, date):
         assert tags.get('ALBUM') == album
@@ -0,0 +1,237 @@
+import os
+
+from flackup.convert import Track
+import flackup.manifest as fm
+import flackup.replaygain as rg
+
+
+MD5 = '56159cb51bc6001c0c5e44283af5c1ac'
+
+
+class TestManifest(object):
+    """Test the Manifest class."""
+
+    def test_plan_new(self, tmp_path):
+        """Test the plan for a new Source."""
+        manifest = fm.Manifest(str(tmp_path))
+        tracks = make_tracks(tmp_path)
+        plan = manifest.plan(make_source(), tracks)
+        assert plan.encode == tracks
+        assert plan.changed is True
+
+    def test_plan_untracked(self, tmp_path):
+        """Test that untracked outputs are not overwritten."""
+        manifest = fm.Manifest(str(tmp_path))
+        tracks = make_tracks(tmp_path)
+        touch(tracks[0].path)
+        assert manifest.plan(make_source(), tracks) is None
+
+    def test_plan_unchanged(self, tmp_path):
+        """Test the plan for unchanged outputs, after reloading."""
+        source, tracks = record_tracks(tmp_path)
+        manifest = fm.Manifest(str(tmp_path))
+        plan = manifest.plan(source, tracks)
+        assert plan.keep == tracks
+        assert plan.changed is False
+
+    def test_plan_tags(self, tmp_path):
+        """Test the plan after a tag change in the Source."""
+        source, tracks = record_tracks(tmp_path)
+        source = source._replace(size=2000, mtime=2)
+        tracks[1].tags['GENRE'] = 'Changed'
+        plan = fm.Manifest(str(tmp_path)).plan(source, tracks)
+        assert plan.retag == [tracks[1]]
+        assert plan.keep == [tracks[0]]
+
+    def test_plan_audio(self, tmp_path):
+        """Test the plan after an audio change in the Source."""
+        source, tracks = record_tracks(tmp_path)
+        source = source._replace(md5='1' * 32)
+        plan = fm.Manifest(str(tmp_path)).plan(source, tracks)
+        assert plan.encode == tracks
+
+    def test_plan_no_md5(self, tmp_path):
+        """Test that size and mtime are used without an MD5 signature."""
+        source, tracks = record_tracks(tmp_path, fm.NO_MD5)
+        plan = fm.Manifest(str(tmp_path)).plan(source, tracks)
+        assert plan.keep == tracks
+        source = source._replace(mtime=2)
+        plan = fm.Manifest(str(tmp_path)).plan(source, tracks)
+        assert plan.encode == tracks
+
+    def test_plan_quality(self, tmp_path):
+        """Test the plan after an encoder settings change."""
+        source, tracks = record_tracks(tmp_path)
+        tracks = [t._replace(quality=2) for t in tracks]
+        plan = fm.Manifest(str(tmp_path)).plan(source, tracks)
+        assert plan.encode == tracks
+
+    def test_plan_hidden(self, tmp_path):
+        """Test the plan after a track was hidden."""
+        source, tracks = record_tracks(tmp_path)
+        plan = fm.Manifest(str(tmp_path)).plan(source, tracks[:1])
+        assert plan.delete == [tracks[1].path]
+        assert plan.keep == tracks[:1]
+
+    def test_plan_move(self, tmp_path):
+        """Test the plan after a title change."""
+        source, tracks = record_tracks(tmp_path)
+        renamed = Track(2, str(tmp_path / '02 New.ogg'), {'TITLE': 'New'})
+        plan = fm.Manifest(str(tmp_path)).plan(source, [tracks[0], renamed])
+        assert plan.move == [(tracks[1].path, renamed)]
+        assert plan.delete == []
+        assert plan.tracks == [renamed, tracks[0]]
+
+    def test_plan_resume(self, tmp_path):
+        """Test that journaled outputs are resumed after reloading."""
+        manifest = fm.Manifest(str(tmp_path))
+        source = make_source()
+        tracks = make_tracks(tmp_path)
+        touch(tracks[0].path)
+        gain = rg.GainResult(make_histogram(), 0.5)
+        manifest.journal(source, tracks[0], gain)
+        touch(tracks[1].path)
+        manifest = fm.Manifest(str(tmp_path))
+        assert manifest.plan(source, tracks) is None
+        plan = manifest.plan(source, tracks[:1])
+        assert plan.resume == tracks[:1]
+        assert plan.changed is True
+        assert manifest.gain(tracks[0].path).peak == 0.5
+
+    def test_plan_resume_unrenamed(self, tmp_path):
+        """Test that outputs changed since they were journaled are encoded.
+
+        This happens when the conversion stopped before the journaled output
+        replaced an older one.
+        """
+        source, tracks = record_tracks(tmp_path)
+        source = source._replace(md5='1' * 32)
+        manifest = fm.Manifest(str(tmp_path))
+        partial = tmp_path / 'partial.ogg'
+        partial.write_bytes(b'new')
+        manifest.journal(source, tracks[0], stat=os.stat(partial))
+        plan = fm.Manifest(str(tmp_path)).plan(source, tracks)
+        assert plan.encode == tracks
+        os.replace(partial, tracks[0].path)
+        plan = fm.Manifest(str(tmp_path)).plan(source, tracks)
+        assert plan.resume == tracks[:1]
+        assert plan.encode == tracks[1:]
+
+    def test_journal_close(self, tmp_path):
+        """Test that the journal is removed once its tracks are recorded."""
+        manifest = fm.Manifest(str(tmp_path))
+        source = make_source()
+        tracks = make_tracks(tmp_path)
+        for track in tracks:
+            manifest.journal(source, track)
+        manifest.record(source, tracks[0])
+        manifest.close()
+        journal = tmp_path / fm.JOURNAL_NAME
+        assert len(journal.read_text().splitlines()) == 1
+        manifest = fm.Manifest(str(tmp_path))
+        assert list(manifest.journaled) == ['02 Two.ogg']
+        manifest.record(source, tracks[1])
+        manifest.close()
+        assert not journal.exists()
+
+    def test_load(self, tmp_path):
+        """Test that load reads the records of other Manifests."""
+        manifest = fm.Manifest(str(tmp_path))
+        source, tracks = record_tracks(tmp_path)
+        assert manifest.entries == {}
+        manifest.load()
+        assert list(manifest.entries) == ['01 One.ogg', '02 Two.ogg']
+        other = fm.Manifest(str(tmp_path))
+        other.record(source, tracks[0]._replace(tags={'TITLE': 'New'}))
+        other.save()
+        manifest.load()
+        assert manifest.entries['01 One.ogg']['tags'] == {'TITLE': 'New'}
+        other.remove(tracks[0].path)
+        other.close()
+        manifest.load()
+        assert list(manifest.entries) == ['02 Two.ogg']
+
+    def test_gain(self, tmp_path):
+        """Test that stored ReplayGain histograms are restored."""
+        source, tracks = record_tracks(tmp_path)
+        gain = fm.Manifest(str(tmp_path)).gain(tracks[0].path)
+        assert gain.gain == rg.histogram_gain(make_histogram())
+        assert gain.peak == 0.5
+
+    def test_close(self, tmp_path):
+        """Test that close rewrites the file without removed records."""
+        source, tracks = record_tracks(tmp_path)
+        manifest = fm.Manifest(str(tmp_path))
+        manifest.remove(tracks[0].path)
+        manifest.close()
+        lines = (tmp_path / fm.MANIFEST_NAME).read_text().splitlines()
+        assert len(lines) == 1
+        assert list(fm.Manifest(str(tmp_path)).entries) == ['02 Two.ogg']
+
+
+class TestPrune(object):
+    """Test the prune function."""
+
+    def test_prune(self, tmp_path):
+        """Test that directories with only a cover are removed."""
+        album = tmp_path / 'Artist' / 'Album'
+        album.mkdir(parents=True)
+        touch(album / 'cover.jpg')
+        fm.prune(str(album))
+        assert not (tmp_path / 'Artist').exists()
+
+    def test_prune_covers(self, tmp_path):
+        """Test pruning with several cover names."""
+        album = tmp_path / 'Album'
+        album.mkdir()
+        touch(album / 'cover.jpg')
+        touch(album / 'thumb.jpg')
+        fm.prune(str(album))
+        assert album.exists()
+        fm.prune(str(album), ['cover.jpg', 'thumb.jpg'])
+        assert not album.exists()
+
+    def test_prune_tracks(self, tmp_path):
+        """Test that directories with tracks are kept."""
+        album = tmp_path / 'Album'
+        album.mkdir()
+        touch(album / '01 One.ogg')
+        fm.prune(str(album))
+        assert album.exists()
+
+
+def make_source(md5=MD5):
+    """Return a test Source."""
+    return fm.Source('/music/test.flac', 1000, 1, md5)
+
+
+def make_tracks(base):
+    """Return two test Tracks."""
+    return [
+        Track(1, str(base / '01 One.ogg'), {'TITLE': 'One'}),
+        Track(2, str(base / '02 Two.ogg'), {'TITLE': 'Two'}),
+    ]
+
+
+def make_histogram():
+    """Return a test ReplayGain histogram."""
+    histogram = rg.dense_histogram([[100, 20], [500, 10]])
+    return histogram
+
+
+def record_tracks(base, md5=MD5):
+    """Record and create two test Tracks, returning the Source and Tracks."""
+    manifest = fm.Manifest(str(base))
+    source = make_source(md5)
+    tracks = make_tracks(base)
+    gain = rg.GainResult(make_histogram(), 0.5)
+    for track in tracks:
+        touch(track.path)
+        manifest.record(source, track, gain)
+    manifest.close()
+    return source, tracks
+
+
+def touch(path):
+    """Create an empty file."""
+    open(str(path), 'w').close()
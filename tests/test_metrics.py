@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from flackup.metrics import Metrics, Stage, measure
+
+
+class TestMetrics(object):
+    """Test the Metrics class."""
+
+    def test_stage(self):
+        """Test that stages are measured and added up."""
+        metrics = Metrics()
+        for _ in range(2):
+            with metrics.stage('encode', audio=10) as stage:
+                time.sleep(0.01)
+                stage.read += 100
+                stage.written += 10
+        encode = metrics.stages['encode']
+        assert encode.wall >= 0.02
+        assert encode.read == 200
+        assert encode.written == 20
+        assert encode.audio == 20
+        assert encode.rtf == pytest.approx(encode.wall / 20)
+
+    def test_stage_error(self):
+        """Test that a stage is recorded in case of errors."""
+        metrics = Metrics()
+        with pytest.raises(ValueError):
+            with metrics.stage('decode'):
+                raise ValueError()
+        assert 'decode' in metrics.stages
+
+    def test_to_dict(self):
+        """Test the order and contents of to_dict."""
+        metrics = Metrics()
+        with metrics.stage('cover'):
+            pass
+        with metrics.stage('decode', audio=1):
+            pass
+        result = metrics.to_dict()
+        assert list(result) == ['decode', 'cover']
+        assert result['cover']['rtf'] is None
+        assert result['decode']['audio'] == 1
+
+    def test_total(self):
+        """Test that overlapping stages are not added up in the total."""
+        metrics = Metrics()
+        with metrics.overall(audio=2):
+            with metrics.stage('encode', audio=2) as stage:
+                stage.written = 5
+                with metrics.stage('replaygain', audio=2):
+                    time.sleep(0.01)
+        total = metrics.total()
+        assert total.audio == 2
+        assert total.written == 5
+        assert metrics.stages['encode'].wall <= total.wall
+        assert total.wall < metrics.stages['encode'].wall * 2
+
+    def test_total_add(self):
+        """Test the total of Metrics added for a summary."""
+        summary = Metrics()
+        with summary.overall():
+            for _ in range(3):
+                metrics = Metrics()
+                with metrics.overall(audio=2):
+                    pass
+                summary.add(metrics)
+        assert summary.total().audio == 6
+
+    def test_add(self):
+        """Test adding Metrics for a summary."""
+        summary = Metrics()
+        for _ in range(3):
+            metrics = Metrics()
+            stage = Stage()
+            stage.written = 5
+            metrics.add_stage('encode', stage)
+            summary.add(metrics)
+        assert summary.stages['encode'].written == 15
+
+    def test_measure_none(self):
+        """Test the measure function without Metrics."""
+        with measure(None, 'decode') as stage:
+            stage.read += 1
@@ -0,0 +1,46 @@
+import io
+
+import flackup.paths as fp
+
+
+class TestFindFlac(object):
+    """Test the find_flac and walk_flac functions."""
+
+    def test_find_flac(self, tmp_path):
+        """Test that hidden and excluded directories are skipped."""
+        for name in ['a.flac', 'b/c.FLAC', '.d/e.flac', 'r/f.flac', 'g.ogg']:
+            path = tmp_path / name
+            path.parent.mkdir(exist_ok=True)
+            path.write_bytes(b'')
+        paths = fp.find_flac(str(tmp_path), [str(tmp_path / 'r')])
+        assert paths == [str(tmp_path / 'a.flac'), str(tmp_path / 'b/c.FLAC')]
+
+    def test_walk_flac(self, tmp_path):
+        """Test that each directory is listed before its sub-directories."""
+        for name in ['b/a/x.flac', 'b/z.flac', 'a.flac', 'c/y.flac']:
+            path = tmp_path / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b'')
+        (tmp_path / 'link').symlink_to(tmp_path / 'b')
+        paths = fp.walk_flac(str(tmp_path))
+        assert next(paths) == str(tmp_path / 'a.flac')
+        assert list(paths) == [
+            str(tmp_path / 'b/z.flac'),
+            str(tmp_path / 'b/a/x.flac'),
+            str(tmp_path / 'c/y.flac'),
+        ]
+
+
+class TestReadPaths(object):
+    """Test the read_paths function."""
+
+    def test_read_paths(self, monkeypatch):
+        """Test that paths split across chunks are joined."""
+        monkeypatch.setattr(fp, 'PATHS_CHUNK', 3)
+        f = io.BytesIO(b'a.flac\n\nb/c.flac\nd.flac')
+        assert list(fp.read_paths(f)) == ['a.flac', 'b/c.flac', 'd.flac']
+
+    def test_read_paths_null(self):
+        """Test NUL separated paths with newlines."""
+        f = io.BytesIO(b'a\nb.flac\0c.flac\0')
+        assert list(fp.read_paths(f, b'\0')) == ['a\nb.flac', 'c.flac']
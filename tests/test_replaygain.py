@@ -0,0 +1,141 @@
+import numpy as np
+import pytest
+
+from flackup.fileinfo import StreamInfo
+import flackup.replaygain as rg
+
+
+CD = StreamInfo(2, 16, 44100, 0)
+
+
+class TestGainAnalysis(object):
+    """Test the GainAnalysis class."""
+
+    def test_silence(self):
+        """Test the analysis of digital silence."""
+        analysis = rg.GainAnalysis(CD)
+        analysis.feed(bytes(44100 * 4))
+        analysis.finish()
+        assert analysis.gain == pytest.approx(rg.PINK_REF)
+        assert analysis.peak == 0.0
+
+    def test_empty(self):
+        """Test the analysis of too few samples."""
+        analysis = rg.GainAnalysis(CD)
+        analysis.feed(bytes(100 * 4))
+        analysis.finish()
+        assert analysis.gain is None
+
+    def test_chunks(self):
+        """Test that chunk sizes do not change the result."""
+        samples = noise(3 * 44100, 3000)
+        whole = rg.GainAnalysis(CD)
+        whole.feed(samples.tobytes())
+        whole.finish()
+        chunked = rg.GainAnalysis(CD)
+        data = samples.tobytes()
+        for offset in range(0, len(data), 12345):
+            chunked.feed(data[offset:offset + 12345])
+        chunked.finish()
+        assert chunked.gain == whole.gain
+        assert chunked.peak == whole.peak
+
+    def test_level(self):
+        """Test that louder samples get a lower gain."""
+        quiet = rg.GainAnalysis(CD)
+        quiet.feed(noise(44100, 1000).tobytes())
+        loud = rg.GainAnalysis(CD)
+        loud.feed(noise(44100, 10000).tobytes())
+        difference = quiet.finish().gain - loud.finish().gain
+        assert difference == pytest.approx(20, abs=0.1)
+
+    @pytest.mark.parametrize('frequency', [100, 1000, 5000])
+    def test_tone(self, frequency):
+        """Compare the gain of a tone with the reference filter response.
+
+        The RMS of a filtered tone is its amplitude times the filter's gain
+        at its frequency, over the square root of 2, so the reference
+        implementation gives PINK_REF minus that RMS in dB.
+        """
+        analysis = rg.GainAnalysis(CD)
+        analysis.feed(tone(3 * 44100, frequency, 10000).tobytes())
+        analysis.finish()
+        rms = 10000 * response(CD.sample_rate, frequency) / np.sqrt(2)
+        expected = rg.PINK_REF - 20 * np.log10(rms)
+        assert analysis.gain == pytest.approx(expected, abs=0.1)
+
+    @pytest.mark.parametrize('loud_windows, level', [(20, 10000), (2, 1000)])
+    def test_percentile(self, loud_windows, level):
+        """Test that the loudest 5% of the RMS windows set the gain."""
+        window = int(44100 * rg.RMS_WINDOW)
+        quiet = tone((200 - loud_windows) * window, 1000, 1000)
+        loud = tone(loud_windows * window, 1000, 10000)
+        analysis = rg.GainAnalysis(CD)
+        analysis.feed(np.concatenate((quiet, loud)).tobytes())
+        analysis.finish()
+        rms = level * response(CD.sample_rate, 1000) / np.sqrt(2)
+        expected = rg.PINK_REF - 20 * np.log10(rms)
+        assert analysis.gain == pytest.approx(expected, abs=0.1)
+
+    def test_filter(self):
+        """Compare the block filter with the reference IIR filter."""
+        samples = noise(4000, 3000)
+        analysis = rg.GainAnalysis(CD)
+        filtered = analysis._filter(samples.astype(float))
+        yule_b, yule_a, butter_b, butter_a = rg.FILTERS[CD.sample_rate]
+        for channel in range(CD.channels):
+            reference = rg.lfilter(yule_b, yule_a, list(samples[:, channel]))
+            reference = rg.lfilter(butter_b, butter_a, reference)
+            assert np.allclose(filtered[:, channel], reference, atol=1e-6)
+
+    def test_album_gain(self):
+        """Test the album_gain function."""
+        quiet = rg.GainAnalysis(CD)
+        quiet.feed(noise(44100, 1000).tobytes())
+        loud = rg.GainAnalysis(CD)
+        loud.feed(noise(44100, 10000).tobytes())
+        analyses = [quiet.finish(), loud.finish()]
+        gain, peak = rg.album_gain(analyses)
+        assert loud.gain <= gain < loud.gain + 1
+        assert peak == loud.peak
+
+    def test_sparse_histogram(self):
+        """Test that a GainResult from a sparse histogram has the same gain."""
+        analysis = rg.GainAnalysis(CD)
+        analysis.feed(noise(44100, 3000).tobytes())
+        analysis.finish()
+        bins = rg.sparse_histogram(analysis.histogram)
+        assert len(bins) < 100
+        result = rg.GainResult(rg.dense_histogram(bins), analysis.peak)
+        assert result.gain == analysis.gain
+        assert rg.album_gain([result]) == (analysis.gain, analysis.peak)
+
+    def test_unsupported(self):
+        """Test an unsupported sample rate."""
+        stream = StreamInfo(2, 16, 22050, 0)
+        assert rg.supported(stream) is False
+        with pytest.raises(ValueError):
+            rg.GainAnalysis(stream)
+
+
+def noise(count, level):
+    """Return stereo 16 bit noise samples."""
+    rng = np.random.default_rng(42)
+    samples = rng.standard_normal((count, 2)) * level
+    return np.clip(samples, -32768, 32767).astype('<i2')
+
+
+def tone(count, frequency, amplitude):
+    """Return stereo 16 bit samples of a sine tone."""
+    phase = 2 * np.pi * frequency * np.arange(count) / CD.sample_rate
+    samples = np.round(amplitude * np.sin(phase))
+    return np.repeat(samples[:, np.newaxis], 2, axis=1).astype('<i2')
+
+
+def response(sample_rate, frequency):
+    """Return the gain of the reference equal loudness filter."""
+    z = np.exp(-2j * np.pi * frequency / sample_rate)
+    gain = 1.0
+    for b, a in zip(*[iter(rg.FILTERS[sample_rate])] * 2):
+        gain *= np.polyval(b[::-1], z) / np.polyval(a[::-1], z)
+    return abs(gain)
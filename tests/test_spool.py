@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+
+import flackup.spool as sp
+
+
+class TestSpool(object):
+    """Test the Spool class."""
+
+    def test_enqueue(self, tmp_path):
+        """Test that albums are only queued once."""
+        spool = sp.Spool(str(tmp_path))
+        assert spool.enqueue({'path': '/music/a.flac'}) is not None
+        assert spool.enqueue({'path': '/music/a.flac'}) is None
+        assert spool.enqueue({'path': '/music/b.flac'}) is not None
+        assert len(spool.names(sp.PENDING)) == 2
+
+    def test_enqueue_queued(self, tmp_path):
+        """Test enqueuing several jobs with the set of queued keys."""
+        spool = sp.Spool(str(tmp_path))
+        spool.enqueue({'path': '/music/a.flac'})
+        queued = spool.queued_keys()
+        assert spool.enqueue({'path': '/music/a.flac'}, queued) is None
+        assert spool.enqueue({'path': '/music/b.flac'}, queued) is not None
+        assert spool.enqueue({'path': '/music/b.flac'}, queued) is None
+        assert len(spool.names(sp.PENDING)) == 2
+
+    def test_claim(self, tmp_path):
+        """Test claiming and finishing jobs in order."""
+        spool = sp.Spool(str(tmp_path))
+        spool.enqueue({'path': '/music/a.flac'})
+        spool.enqueue({'path': '/music/b.flac'})
+        claim = spool.claim('host:1')
+        assert claim.job['path'] == '/music/a.flac'
+        assert os.path.exists(claim.lock)
+        spool.finish(claim, {'lines': []}, ok=True)
+        claim = spool.claim('host:1')
+        assert claim.job['path'] == '/music/b.flac'
+        spool.finish(claim, {'lines': ['ERROR']})
+        assert spool.claim('host:1') is None
+        jobs = spool.status()
+        assert [len(jobs[state]) for state in sp.STATES] == [0, 0, 1, 1]
+        assert jobs[sp.DONE][0]['result'] == {'lines': []}
+        assert os.listdir(str(tmp_path / sp.CLAIMED)) == []
+
+    def test_claim_concurrent(self, tmp_path):
+        """Test that each job is claimed by one of several workers."""
+        spool = sp.Spool(str(tmp_path))
+        for number in range(50):
+            spool.enqueue({'path': '/music/{}.flac'.format(number)})
+        claimed = []
+
+        def work(name):
+            worker = sp.Spool(str(tmp_path))
+            while True:
+                claim = worker.claim(name)
+                if claim is None:
+                    return
+                claimed.append(claim.job['path'])
+                worker.finish(claim, {}, ok=True)
+
+        threads = [
+            threading.Thread(target=work, args=('host:{}'.format(n),))
+            for n in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(claimed) == 50
+        assert len(set(claimed)) == 50
+
+    def test_recover_stale(self, tmp_path):
+        """Test that claims without heartbeat are queued again."""
+        spool = sp.Spool(str(tmp_path))
+        spool.enqueue({'path': '/music/a.flac'})
+        claim = spool.claim('other-host:1')
+        assert spool.recover(stale=60) == []
+        old = time.time() - 120
+        os.utime(claim.lock, (old, old))
+        assert spool.recover(stale=60) == [claim.name]
+        assert not os.path.exists(claim.lock)
+        assert spool.claim('host:2').name == claim.name
+
+    def test_finish_lost(self, tmp_path):
+        """Test that a recovered claim is not finished by its old worker."""
+        spool = sp.Spool(str(tmp_path))
+        spool.enqueue({'path': '/music/a.flac'})
+        claim = spool.claim('other-host:1')
+        old = time.time() - 120
+        os.utime(claim.lock, (old, old))
+        spool.recover(stale=60)
+        assert spool.owns(claim) is False
+        new_claim = spool.claim('host:2')
+        assert spool.finish(claim, {}, ok=True) is False
+        assert spool.owns(new_claim) is True
+        assert os.path.exists(new_claim.lock)
+        assert spool.finish(new_claim, {}, ok=True) is True
+        assert len(spool.names(sp.DONE)) == 1
+
+    def test_recover_dead(self, tmp_path):
+        """Test that claims of dead processes on this host are recovered."""
+        spool = sp.Spool(str(tmp_path))
+        spool.enqueue({'path': '/music/a.flac'})
+        claim = spool.claim(sp.worker_id())
+        assert spool.recover() == []
+        dead = '{}:{}'.format(sp.worker_id().rpartition(':')[0], 2 ** 22 + 1)
+        sp.write_json(claim.lock, {'worker': dead})
+        assert spool.recover() == [claim.name]
+
+    def test_heartbeat(self, tmp_path):
+        """Test that the heartbeat updates the lock file."""
+        spool = sp.Spool(str(tmp_path))
+        spool.enqueue({'path': '/music/a.flac'})
+        claim = spool.claim('host:1')
+        old = time.time() - 120
+        os.utime(claim.lock, (old, old))
+        with spool.heartbeat(claim, interval=0.05) as lost:
+            time.sleep(0.2)
+        assert os.stat(claim.lock).st_mtime > old + 60
+        assert not lost.is_set()
+
+    def test_heartbeat_lost(self, tmp_path):
+        """Test that the heartbeat reports a claim taken by another worker."""
+        spool = sp.Spool(str(tmp_path))
+        spool.enqueue({'path': '/music/a.flac'})
+        claim = spool.claim('host:1')
+        with spool.heartbeat(claim, interval=0.05) as lost:
+            sp.write_json(claim.lock, {'worker': 'host:2'})
+            assert lost.wait(5)
+        assert sp.read_json(claim.lock) == {'worker': 'host:2'}
@@ -0,0 +1,81 @@
+import os
+import time
+
+import flackup.watch as fw
+
+
+class TestWatcher(object):
+    """Test the Watcher class."""
+
+    def test_complete(self, tmp_path):
+        """Test that files are reported once closed and settled."""
+        with fw.Watcher(str(tmp_path), settle=0.2) as watcher:
+            path = tmp_path / 'album.flac'
+            with open(path, 'wb') as f:
+                f.write(b'fLaC')
+                f.flush()
+                assert poll(watcher, 0.5) == []
+            assert poll(watcher) == [str(path)]
+            assert poll(watcher, 0.5) == []
+
+    def test_done(self, tmp_path):
+        """Test that processed files are only reported after a change."""
+        with fw.Watcher(str(tmp_path), settle=0.1) as watcher:
+            path = tmp_path / 'album.flac'
+            path.write_bytes(b'fLaC')
+            assert poll(watcher) == [str(path)]
+            path.write_bytes(b'fLaC1')
+            assert poll(watcher, 0.5) == []
+            watcher.done(str(path))
+            mtime = os.stat(path).st_mtime_ns
+            path.write_bytes(b'fLaC1')
+            os.utime(path, ns=(mtime, mtime))
+            assert poll(watcher, 0.5) == []
+            path.write_bytes(b'fLaC12')
+            assert poll(watcher) == [str(path)]
+
+    def test_done_forgotten(self, tmp_path):
+        """Test that processed files are forgotten once handled."""
+        with fw.Watcher(str(tmp_path), settle=0.1) as watcher:
+            paths = []
+            for number in range(3):
+                path = tmp_path / '{}.flac'.format(number)
+                path.write_bytes(b'fLaC')
+                paths.append(str(path))
+            assert poll(watcher) == paths
+            for path in paths:
+                watcher.done(path)
+            assert poll(watcher, 0.3) == []
+            assert watcher._done == {}
+
+    def test_new_directory(self, tmp_path):
+        """Test that new directories are watched."""
+        with fw.Watcher(str(tmp_path), settle=0.1) as watcher:
+            album = tmp_path / 'Artist' / 'Album'
+            album.mkdir(parents=True)
+            (album / 'early.flac').write_bytes(b'fLaC')
+            poll(watcher)
+            (album / 'late.flac').write_bytes(b'fLaC')
+            assert poll(watcher) == [str(album / 'late.flac')]
+
+    def test_moved(self, tmp_path):
+        """Test that moved in files are reported and others ignored."""
+        inbox = tmp_path / 'inbox'
+        review = inbox / 'review'
+        review.mkdir(parents=True)
+        with fw.Watcher(str(inbox), settle=0.1, exclude=[review]) as watcher:
+            (tmp_path / 'album.flac').write_bytes(b'fLaC')
+            (tmp_path / 'album.flac').rename(inbox / 'album.flac')
+            (review / 'other.flac').write_bytes(b'fLaC')
+            (inbox / 'notes.txt').write_text('notes')
+            assert poll(watcher) == [str(inbox / 'album.flac')]
+
+
+def poll(watcher, timeout=5):
+    """Poll the Watcher until files are reported or timeout expires."""
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        paths = watcher.poll(0.1)
+        if paths:
+            return paths
+    return []